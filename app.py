@@ -1,15 +1,22 @@
-from flask import Flask, render_template, jsonify, request
-import os, csv, json
+from flask import Flask, render_template, jsonify, request, Response, g, send_file, has_request_context, stream_with_context
+import os, csv, json, math
+import bisect, threading, time, collections, hashlib, urllib.request, urllib.error
+import cProfile, pstats, io, functools, random, uuid, heapq, hmac
+import sys, tracemalloc, contextlib, contextvars, sqlite3, unicodedata, zlib, shutil, mmap, struct
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
+import numpy as np
 import re
+from timeline import timeline_from_env
 
 app = Flask(__name__)
 
 # ---------- 共通パス ----------
 BASE = os.path.dirname(__file__)
-DATA_DIR = os.path.join(BASE, "data")
-BASE_P = Path(__file__).resolve().parent / "data"
+# WEBAPP_DATA_DIR で別データセット（合成データ等）に切替可能
+DATA_DIR = os.environ.get("WEBAPP_DATA_DIR", os.path.join(BASE, "data"))
+BASE_P = Path(DATA_DIR).resolve()
 
 POI_CSV = BASE_P / "poi_list.csv"
 DESIRED_CSV = BASE_P / "desired_example.csv"
@@ -20,6 +27,10 @@ POI_PREF_CSV = BASE_P / "poi_preference_by_type.csv"
 TRANSPORT_PREF_CSV = BASE_P / "transport_preference_by_type.csv"
 PERSUASIVE_TEXT_JSON = BASE_P / "persuasive_text.json"
 PERSUASIVE_TEXT_EN_JSON = BASE_P / "persuasive_text_en.json" 
+SOLUTIONS_CSV = BASE_P / "optimal_solutions.csv"
+
+# slot番号 → 時刻・時間帯の混雑度（取込み・採点・表示で共有、WEBAPP_SLOT_* で変更可）
+TIMELINE = timeline_from_env()
 
 
 # ---------- ユーティリティ ----------
@@ -60,6 +71,14 @@ def load_poi_data():
 
 def load_user_types():
     """user_type.csvを読み込み"""
+    if USE_SQLITE:
+        return _sqlite_load_user_types()
+    snap = current_snapshot()
+    if snap is not None:
+        return snap.user_types
+    return _csv_load_user_types()
+
+def _csv_load_user_types():
     user_types = {}
     if not USER_TYPE_CSV.exists():
         return user_types
@@ -72,6 +91,14 @@ def load_user_types():
 
 def load_poi_preferences():
     """poi_preference_by_type.csvを読み込み"""
+    if USE_SQLITE:
+        return _sqlite_load_preferences("poi_preferences", "poi_id")
+    snap = current_snapshot()
+    if snap is not None:
+        return snap.poi_prefs
+    return _csv_load_poi_preferences()
+
+def _csv_load_poi_preferences():
     prefs = {}
     if not POI_PREF_CSV.exists():
         return prefs
@@ -87,6 +114,14 @@ def load_poi_preferences():
 
 def load_transport_preferences():
     """transport_preference_by_type.csvを読み込み"""
+    if USE_SQLITE:
+        return _sqlite_load_preferences("transport_preferences", "mode")
+    snap = current_snapshot()
+    if snap is not None:
+        return snap.transport_prefs
+    return _csv_load_transport_preferences()
+
+def _csv_load_transport_preferences():
     prefs = {}
     if not TRANSPORT_PREF_CSV.exists():
         return prefs
@@ -100,24 +135,1062 @@ def load_transport_preferences():
             prefs[col][mode] = float(row[col])
     return prefs
 
-def load_persuasive_texts():
-    """persuasive_text.jsonを読み込み"""
-    if not PERSUASIVE_TEXT_JSON.exists():
+def load_persuasive_texts(path=PERSUASIVE_TEXT_JSON):
+    """persuasive_text.json（英語版は path に persuasive_text_en.json）を読み込み"""
+    if not path.exists():
         return {}
     try:
-        with open(PERSUASIVE_TEXT_JSON, 'r', encoding='utf-8') as f:
+        with open(path, 'r', encoding='utf-8') as f:
             return json.load(f)
     except:
         return {}
 
+# ---------- SQLite ストア（CSVから取込み、索引付きで参照） ----------
+# WEBAPP_STORE=sqlite のとき、ローダーとプラン読込をCSVではなくSQLiteから行う
+USE_SQLITE = os.environ.get("WEBAPP_STORE", "csv") == "sqlite"
+SQLITE_DB = Path(os.environ.get("WEBAPP_SQLITE_DB", BASE_P / "webapp.sqlite3"))
+SQLITE_CHUNK_ROWS = 200_000
+_SQLITE_LOCAL = threading.local()
+
+SQLITE_SCHEMA = """
+CREATE TABLE pois (
+    poi_id   INTEGER PRIMARY KEY,
+    name     TEXT NOT NULL,
+    category TEXT NOT NULL,
+    lat      REAL NOT NULL,
+    lng      REAL NOT NULL
+);
+CREATE TABLE poi_preferences (
+    user_type TEXT NOT NULL,
+    poi_id    INTEGER NOT NULL,
+    score     REAL NOT NULL,
+    PRIMARY KEY (user_type, poi_id)
+);
+CREATE TABLE transport_preferences (
+    user_type TEXT NOT NULL,
+    mode      TEXT NOT NULL,
+    score     REAL NOT NULL,
+    PRIMARY KEY (user_type, mode)
+);
+CREATE TABLE user_types (
+    user      TEXT PRIMARY KEY,
+    user_type TEXT NOT NULL
+);
+CREATE TABLE plan_slots (
+    row_no     INTEGER NOT NULL,
+    source     TEXT NOT NULL,     -- desired / proposal / solutions
+    solution   TEXT NOT NULL,
+    user       TEXT NOT NULL,
+    slot       TEXT NOT NULL,
+    slot_order INTEGER NOT NULL,
+    poi_name   TEXT NOT NULL,
+    poi_id     INTEGER,
+    transport  TEXT NOT NULL
+);
+"""
+SQLITE_INDEXES = """
+CREATE INDEX idx_plan_user ON plan_slots (source, user, solution, slot_order);
+CREATE INDEX idx_plan_poi  ON plan_slots (poi_id, slot_order);
+"""
+
+def _sqlite_sources() -> dict:
+    return {DESIRED_CSV: "desired", PROPOSAL_CSV: "proposal", SOLUTIONS_CSV: "solutions"}
+
+def build_sqlite_store(db_path: Path = None) -> dict:
+    """
+    CSV一式をSQLiteへ取込み（一時ファイルに作ってから置換）
+    プランCSVは分割読込するので、全件がメモリに載らなくてもよい
+    """
+    db_path = Path(db_path or SQLITE_DB)
+    tmp_path = db_path.with_suffix(db_path.suffix + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    counts = {}
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript("PRAGMA journal_mode = OFF; PRAGMA synchronous = OFF;" + SQLITE_SCHEMA)
+
+        df = pd.read_csv(POI_CSV, encoding="utf-8-sig")
+        idc   = _pick_col(df.columns, "PoI_ID","poi_id","id")
+        namec = _pick_col(df.columns, "施設名","name","名称")
+        catc  = _pick_col(df.columns, "カテゴリ","category")
+        latc  = _pick_col(df.columns, "Latitude","latitude","緯度")
+        lngc  = _pick_col(df.columns, "Longitude","longitude","経度")
+        pois = list(zip(df[idc].astype(int), df[namec].astype(str),
+                        df[catc].astype(str) if catc else ["その他"] * len(df),
+                        df[latc].astype(float), df[lngc].astype(float)))
+        conn.executemany("INSERT INTO pois VALUES (?,?,?,?,?)", [tuple(map(_sqlite_py, p)) for p in pois])
+        resolver = PoiResolver({int(p[0]): {"name": p[1]} for p in pois}, load_poi_aliases())
+        counts["pois"] = len(pois)
+
+        if POI_PREF_CSV.exists():
+            df = pd.read_csv(POI_PREF_CSV, encoding="utf-8-sig").melt(id_vars="PoI_ID", var_name="t", value_name="v")
+            conn.executemany("INSERT INTO poi_preferences VALUES (?,?,?)",
+                             zip(df["t"], df["PoI_ID"].astype(int).tolist(), df["v"].astype(float).tolist()))
+            counts["poi_preferences"] = len(df)
+        if TRANSPORT_PREF_CSV.exists():
+            df = pd.read_csv(TRANSPORT_PREF_CSV, encoding="utf-8-sig")
+            df = df.melt(id_vars="transport mode", var_name="t", value_name="v")
+            conn.executemany("INSERT INTO transport_preferences VALUES (?,?,?)",
+                             zip(df["t"], df["transport mode"].astype(str).str.strip(), df["v"].astype(float).tolist()))
+            counts["transport_preferences"] = len(df)
+        if USER_TYPE_CSV.exists():
+            df = pd.read_csv(USER_TYPE_CSV, encoding="utf-8-sig")
+            conn.executemany("INSERT INTO user_types VALUES (?,?)",
+                             zip("User_" + df["User_ID"].astype(str), df["User_Type"].astype(str)))
+            counts["user_types"] = len(df)
+
+        for path, source in _sqlite_sources().items():
+            if not path.exists():
+                continue
+            n = 0
+            for chunk in pd.read_csv(path, encoding="utf-8-sig", dtype=str, chunksize=SQLITE_CHUNK_ROWS):
+                chunk = chunk.fillna("")
+                if not {"Slot","POI","Transport"}.issubset(chunk.columns):
+                    break
+                slot = chunk["Slot"].str.strip().str.lower()
+                poi = chunk["POI"].str.strip()
+                poi_id = poi.map({n: resolver.get(n) for n in poi.unique()})
+                conn.executemany("INSERT INTO plan_slots VALUES (?,?,?,?,?,?,?,?,?)", zip(
+                    range(n, n + len(chunk)),
+                    [source] * len(chunk),
+                    chunk["Solution"] if "Solution" in chunk.columns else [""] * len(chunk),
+                    chunk["User"] if "User" in chunk.columns else [""] * len(chunk),
+                    slot,
+                    slot.map(_slot_order_key),
+                    poi,
+                    [None if pd.isna(v) else int(v) for v in poi_id],
+                    chunk["Transport"].str.strip(),
+                ))
+                n += len(chunk)
+            counts[f"plan_slots[{source}]"] = n
+
+        counts["poi_names"] = audit_plan_poi_names(list(_sqlite_sources()), resolver)
+        conn.executescript(SQLITE_INDEXES + "ANALYZE;")
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, db_path)
+    return counts
+
+def _sqlite_py(v):
+    """numpy スカラー → Python 値（sqlite3 が受け付ける型）"""
+    return v.item() if isinstance(v, np.generic) else v
+
+def _sqlite_conn() -> sqlite3.Connection:
+    """
+    スレッドごとの読取専用接続（fork 後・DB ファイルの置換後は作り直す）
+    build_sqlite_store は別ファイルに作って置換するので、開いたままの接続は旧DBを読み続ける
+    """
+    st = SQLITE_DB.stat()
+    key = (os.getpid(), st.st_ino, st.st_mtime_ns)
+    conn = getattr(_SQLITE_LOCAL, "conn", None)
+    if conn is None or _SQLITE_LOCAL.key != key:
+        if conn is not None and _SQLITE_LOCAL.key[0] == key[0]:
+            conn.close()
+        conn = sqlite3.connect(SQLITE_DB.resolve().as_uri() + "?mode=ro", uri=True)
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute("PRAGMA mmap_size = 268435456")
+        _SQLITE_LOCAL.conn, _SQLITE_LOCAL.key = conn, key
+    return conn
+
+def _sqlite_load_poi_master():
+    m = {
+        poi_id: {"name": name, "category": cat, "lat": lat, "lng": lng}
+        for poi_id, name, cat, lat, lng in _sqlite_conn().execute("SELECT * FROM pois ORDER BY poi_id")
+    }
+    return m, get_poi_resolver(m)
+
+def _sqlite_load_user_types():
+    return dict(_sqlite_conn().execute("SELECT user, user_type FROM user_types"))
+
+def _sqlite_load_preferences(table: str, key: str):
+    prefs = {}
+    for user_type, k, score in _sqlite_conn().execute(f"SELECT user_type, {key}, score FROM {table}"):
+        prefs.setdefault(user_type, {})[k] = score
+    return prefs
+
+def _sqlite_read_plan(source: str, user_filter=None) -> list:
+    """_read_plan_slots と同じ形式。ユーザー指定時は索引で該当行だけ読む"""
+    sql = "SELECT slot, poi_name, poi_id, transport FROM plan_slots WHERE source = ?"
+    params = [source]
+    if user_filter:
+        sql += " AND user = ?"
+        params.append(user_filter)
+    return [
+        PlanSlot(_SLOT_LABELS.id(slot), _POI_NAMES.id(poi_name), poi_id, _MODES.id(transport.lower()))
+        for slot, poi_name, poi_id, transport in _sqlite_conn().execute(sql + " ORDER BY row_no", params)
+    ]
+
+def sqlite_poi_slot_counts(poi_id: int, source: str = "solutions", solution: str = "Solution_1") -> list:
+    """POI別・スロット別の計画訪問者数（(poi_id, slot_order) 索引を使う）"""
+    rows = _sqlite_conn().execute(
+        "SELECT slot, COUNT(*) FROM plan_slots WHERE poi_id = ? AND source = ? AND solution = ?"
+        " GROUP BY slot_order, slot ORDER BY slot_order",
+        (poi_id, source, solution))
+    return [{"slot": slot, "visits": n} for slot, n in rows]
+
+@app.route("/api/poi_visits")
+def api_poi_visits():
+    if not (USE_SQLITE and SQLITE_DB.exists()):
+        return jsonify({"error": "SQLite ストアが無効です（WEBAPP_STORE=sqlite）"}), 404
+    poi_id = request.args.get("poi_id", "").strip()
+    if not poi_id.isdigit():
+        return jsonify({"error": "poi_id には数字を指定してください"}), 400
+    source = request.args.get("source", "solutions")
+    if source not in ("desired", "proposal", "solutions"):
+        return jsonify({"error": "source は desired / proposal / solutions のいずれかです"}), 400
+    solution = request.args.get("solution", "Solution_1")
+    return jsonify({"poi_id": int(poi_id), "source": source, "solution": solution,
+                    "visits": sqlite_poi_slot_counts(int(poi_id), source, solution)})
+
+# ---------- 診断用エンドポイント（/debug/* とプロファイル要求ヘッダ） ----------
+# 既定では無効（404、X-Profile / X-Memory-Profile ヘッダも無視）。WEBAPP_DEBUG_ENDPOINTS=1 で有効化し、
+# WEBAPP_DEBUG_TOKEN を設定した場合は X-Debug-Token ヘッダの一致も必要
+DEBUG_ENDPOINTS = os.environ.get("WEBAPP_DEBUG_ENDPOINTS", "") == "1"
+DEBUG_TOKEN = os.environ.get("WEBAPP_DEBUG_TOKEN", "")
+DEBUG_TOKEN_HEADER = "X-Debug-Token"
+
+def debug_allowed() -> bool:
+    if not DEBUG_ENDPOINTS:
+        return False
+    return not DEBUG_TOKEN or hmac.compare_digest(request.headers.get(DEBUG_TOKEN_HEADER, ""), DEBUG_TOKEN)
+
+def debug_only(view):
+    """診断用ビュー（無効時・トークン不一致時は 404）"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not debug_allowed():
+            return jsonify({"error": "not found"}), 404
+        return view(*args, **kwargs)
+    return wrapper
+
+# ---------- データスナップショット（プロセス間で共有、無停止で切替） ----------
+# 元データ（POI・ユーザータイプ・嗜好表・複数解）を版ごとのディレクトリへ書き出し、
+# 各ワーカーは配列を mmap で読む（ページキャッシュを共有するので実体は1つ）。
+# 版名は元ファイルの (更新時刻, サイズ) から決まり、最初に変更に気付いたワーカーが
+# 一時ディレクトリに作って rename で公開する。作成中も他のワーカーは旧版で応答を続け、
+# 新版が揃った時点で参照を1回の代入で差し替える（処理中のリクエストは旧版のまま）
+# 版の作成に失敗したとき（書き込み途中の CSV など）は旧版のまま応答し、
+# SNAPSHOT_RETRY_INTERVAL 秒後に作り直す。旧版が無ければ CSV から直接読む
+# 既定は無効（WEBAPP_SNAPSHOT=1 で有効。実行中に SNAPSHOT_DIR へ書き込む）
+USE_SNAPSHOT = os.environ.get("WEBAPP_SNAPSHOT", "0") == "1" and not USE_SQLITE
+SNAPSHOT_DIR = Path(os.environ.get("WEBAPP_SNAPSHOT_DIR", BASE_P / ".snapshots"))
+SNAPSHOT_CHECK_INTERVAL = float(os.environ.get("WEBAPP_SNAPSHOT_CHECK_S", "1.0"))
+SNAPSHOT_RETRY_INTERVAL = float(os.environ.get("WEBAPP_SNAPSHOT_RETRY_S", "30"))
+SNAPSHOT_KEEP = 2                 # 残しておく版の数
+SNAPSHOT_ARRAYS = ("poi", "mode", "base", "penalized", "valid")
+SNAPSHOT_FORMAT = 2               # 書き出す内容を変えたら上げる（版名に含める）
+_SNAPSHOT = None
+_SNAPSHOT_NEXT_CHECK = 0.0        # 次に元データを確認する時刻（time.monotonic）
+_SNAPSHOT_LOCK = threading.Lock()
+
+try:
+    import fcntl
+except ImportError:               # Windows: ロックなし（同時に作っても rename で1つに決まる）
+    fcntl = None
+
+def _snapshot_sources() -> dict:
+    # 希望案は未登録ユーザーのタイプ推定（テンソルの嗜好値）に使う
+    paths = [POI_CSV, USER_TYPE_CSV, POI_PREF_CSV, TRANSPORT_PREF_CSV, SOLUTIONS_CSV, POI_ALIAS_CSV, DESIRED_CSV]
+    out = {}
+    for p in paths:
+        try:
+            st = p.stat()
+            out[p.name] = [st.st_mtime_ns, st.st_size]
+        except FileNotFoundError:
+            out[p.name] = None
+    return out
+
+def _snapshot_version(sources: dict) -> str:
+    return uuid.uuid5(uuid.NAMESPACE_URL, json.dumps([SNAPSHOT_FORMAT, sources], sort_keys=True)).hex[:16]
+
+class DataSnapshot:
+    """1つの版の元データ。属性は読み取り専用として扱う"""
+    __slots__ = ("version", "sources", "created", "poi_master", "user_types",
+                 "poi_prefs", "transport_prefs", "tensors")
+
+    @classmethod
+    def load(cls, path: Path) -> "DataSnapshot":
+        meta = load_json(path / "meta.json")
+        snap = cls()
+        snap.version = meta["version"]
+        snap.sources = meta["sources"]
+        snap.created = meta["created"]
+        snap.poi_master = {int(pid): info for pid, info in meta["poi_master"]}
+        snap.user_types = meta["user_types"]
+        snap.poi_prefs = {t: {int(pid): v for pid, v in col} for t, col in meta["poi_prefs"].items()}
+        snap.transport_prefs = meta["transport_prefs"]
+        snap.tensors = None
+        if meta["tensors"] is not None:
+            t = dict(meta["tensors"])
+            for name in SNAPSHOT_ARRAYS:
+                t[name] = np.load(path / f"{name}.npy", mmap_mode="r")
+            t["available"] = t["valid"].any(axis=2)
+            t["slot_congestion"] = _congestion_base_array(t["slots"])
+            snap.tensors = t
+        return snap
+
+def build_snapshot(sources: dict = None) -> Path:
+    """現在の元データから版を作って公開し、そのディレクトリを返す（既にあれば何もしない）"""
+    sources = sources or _snapshot_sources()
+    version = _snapshot_version(sources)
+    final = SNAPSHOT_DIR / version
+    if (final / "meta.json").exists():
+        return final
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+
+    poi_master = _csv_load_poi_master() if POI_CSV.exists() else {}
+    user_types = _csv_load_user_types()
+    poi_prefs = _csv_load_poi_preferences()
+    transport_prefs = _csv_load_transport_preferences()
+    resolver = PoiResolver(poi_master, load_poi_aliases())
+    log_poi_name_audit(resolver, background=False)
+    tensors = None
+    if SOLUTIONS_CSV.exists():
+        inferred = _infer_desired_types(resolver, _build_type_model(poi_prefs, transport_prefs))
+        tensors = _load_solution_tensors(SOLUTIONS_CSV, resolver, with_inferred_types(user_types, inferred),
+                                         poi_prefs, transport_prefs)
+
+    tmp = SNAPSHOT_DIR / f".{version}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir()
+    meta = {
+        "version": version,
+        "sources": sources,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "poi_master": list(poi_master.items()),
+        "user_types": user_types,
+        "poi_prefs": {t: list(col.items()) for t, col in poi_prefs.items()},
+        "transport_prefs": transport_prefs,
+        "tensors": None if tensors is None else {
+            "users": tensors["users"], "solutions": tensors["solutions"],
+            "slots": tensors["slots"], "n_poi": tensors["n_poi"],
+        },
+    }
+    if tensors is not None:
+        for name in SNAPSHOT_ARRAYS:
+            np.save(tmp / f"{name}.npy", np.ascontiguousarray(tensors[name]))
+    (tmp / "meta.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+    try:
+        os.rename(tmp, final)
+    except OSError:               # 他のプロセスが先に公開した
+        shutil.rmtree(tmp, ignore_errors=True)
+    _prune_snapshots(keep=version)
+    return final
+
+def _prune_snapshots(keep: str):
+    """古い版を削除（mmap 中のワーカーがあっても Linux では読み続けられる）"""
+    dirs = sorted((d for d in SNAPSHOT_DIR.iterdir() if d.is_dir() and not d.name.startswith(".")),
+                  key=lambda d: d.stat().st_mtime, reverse=True)
+    for d in [d for d in dirs if d.name != keep][SNAPSHOT_KEEP - 1:]:
+        shutil.rmtree(d, ignore_errors=True)
+
+@contextlib.contextmanager
+def _snapshot_build_lock(blocking: bool):
+    """版の作成はプロセス間で1つだけ。blocking=False で取れなければ False を返す"""
+    if fcntl is None:
+        yield True
+        return
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    with open(SNAPSHOT_DIR / ".lock", "w") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _refresh_snapshot():
+    """元データが変わっていれば新しい版へ切替（作成中なら旧版のまま）"""
+    global _SNAPSHOT
+    sources = _snapshot_sources()
+    if _SNAPSHOT is not None and _SNAPSHOT.sources == sources:
+        return
+    path = SNAPSHOT_DIR / _snapshot_version(sources)
+    if not (path / "meta.json").exists():
+        with _snapshot_build_lock(blocking=_SNAPSHOT is None) as locked:
+            if not locked:
+                return
+            with trace_span("snapshot.build"):
+                path = build_snapshot(sources)
+    _SNAPSHOT = DataSnapshot.load(path)
+
+def get_snapshot():
+    """
+    現在の版（まだ版が無ければ None）。元データの確認は SNAPSHOT_CHECK_INTERVAL 秒に1回、
+    版の作成に失敗したら旧版のまま SNAPSHOT_RETRY_INTERVAL 秒待つ。
+    リクエスト内では最初に取った版を使い続ける（途中で版が混ざらないように）
+    """
+    global _SNAPSHOT_NEXT_CHECK
+    if has_request_context() and "snapshot" in g:
+        return g.snapshot
+    if time.monotonic() >= _SNAPSHOT_NEXT_CHECK:
+        with _SNAPSHOT_LOCK:
+            now = time.monotonic()
+            if now >= _SNAPSHOT_NEXT_CHECK:
+                try:
+                    _refresh_snapshot()
+                    _SNAPSHOT_NEXT_CHECK = now + SNAPSHOT_CHECK_INTERVAL
+                except Exception:
+                    app.logger.exception("snapshot refresh failed; keeping version %s",
+                                         _SNAPSHOT.version if _SNAPSHOT is not None else None)
+                    _SNAPSHOT_NEXT_CHECK = now + SNAPSHOT_RETRY_INTERVAL
+    snap = _SNAPSHOT
+    if has_request_context():
+        g.snapshot = snap
+    return snap
+
+def current_snapshot():
+    """スナップショット無効時・まだ版が無いときは None（呼び出し側は CSV から読む）"""
+    return get_snapshot() if USE_SNAPSHOT else None
+
+def get_solution_tensors() -> dict:
+    """optimal_solutions.csv のテンソル（スナップショット有効時は共有の版から）"""
+    snap = current_snapshot()
+    if snap is not None:
+        return snap.tensors
+    _, name_map = _load_poi_master_for_geo()
+    return _load_solution_tensors(SOLUTIONS_CSV, name_map, with_inferred_types(load_user_types(), inferred_user_types()),
+                                  load_poi_preferences(), load_transport_preferences())
+
+@app.route("/debug/snapshot")
+@debug_only
+def debug_snapshot():
+    if not USE_SNAPSHOT:
+        return jsonify({"enabled": False})
+    snap = get_snapshot()
+    if snap is None:
+        return jsonify({"enabled": True, "version": None, "dir": str(SNAPSHOT_DIR), "pid": os.getpid()})
+    return jsonify({
+        "enabled": True,
+        "version": snap.version,
+        "created": snap.created,
+        "sources": snap.sources,
+        "dir": str(SNAPSHOT_DIR),
+        "pid": os.getpid(),
+    })
+
+# ---------- 計測（ルート別レイテンシ・件数・サイズ・キャッシュ命中率） ----------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class _Histogram:
+    """累積バケット付きヒストグラム（Prometheus形式）"""
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+_METRICS_LOCK = threading.Lock()
+_REQUEST_LATENCY = {}   # route -> _Histogram（秒）
+_PHASE_LATENCY = {}     # (route, phase) -> _Histogram（秒）
+_RESPONSE_SIZE = {}     # route -> _Histogram（バイト）
+_REQUEST_COUNT = {}     # (route, method, status) -> 件数
+_CACHE_COUNT = {}       # (cache, "hit"/"miss") -> 件数
+# 事前計算（warm_caches）中は True。起動直後・データ更新直後の数値に合成トラフィックを混ぜないよう、
+# レイテンシ・キャッシュ命中の記録とプロファイル採取を行わない
+_WARMING = contextvars.ContextVar("warming", default=False)
+
+def _route_label() -> str:
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+def observe_phase(phase: str, seconds: float):
+    """リクエスト内の処理段階（load/score/serialize 等）の所要時間を記録"""
+    if _WARMING.get():
+        return
+    key = (_route_label(), phase)
+    with _METRICS_LOCK:
+        if key not in _PHASE_LATENCY:
+            _PHASE_LATENCY[key] = _Histogram(LATENCY_BUCKETS)
+        _PHASE_LATENCY[key].observe(seconds)
+    memory_checkpoint()
+
+def record_cache(cache: str, hit: bool):
+    """キャッシュ命中/ミスを記録"""
+    if _WARMING.get():
+        return
+    key = (cache, "hit" if hit else "miss")
+    with _METRICS_LOCK:
+        _CACHE_COUNT[key] = _CACHE_COUNT.get(key, 0) + 1
+
+@app.before_request
+def _metrics_start():
+    g.metrics_t0 = time.perf_counter()
+
+@app.after_request
+def _metrics_finish(response):
+    t0 = g.pop("metrics_t0", None)
+    if t0 is None or _WARMING.get():
+        return response
+    elapsed = time.perf_counter() - t0
+    route = _route_label()
+    size = None if response.is_streamed else response.calculate_content_length()
+    with _METRICS_LOCK:
+        if route not in _REQUEST_LATENCY:
+            _REQUEST_LATENCY[route] = _Histogram(LATENCY_BUCKETS)
+            _RESPONSE_SIZE[route] = _Histogram(SIZE_BUCKETS)
+        _REQUEST_LATENCY[route].observe(elapsed)
+        if size is not None:
+            _RESPONSE_SIZE[route].observe(size)
+        key = (route, request.method, response.status_code)
+        _REQUEST_COUNT[key] = _REQUEST_COUNT.get(key, 0) + 1
+    return response
+
+def _prom_labels(**labels) -> str:
+    body = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels.items()
+    )
+    return "{" + body + "}"
+
+def _prom_histogram(lines: list, name: str, hist: _Histogram, **labels):
+    cum = 0
+    for bound, n in zip(hist.buckets, hist.counts):
+        cum += n
+        lines.append(f"{name}_bucket{_prom_labels(**labels, le=bound)} {cum}")
+    lines.append(f"{name}_bucket{_prom_labels(**labels, le='+Inf')} {hist.count}")
+    lines.append(f"{name}_sum{_prom_labels(**labels)} {hist.total:.6f}")
+    lines.append(f"{name}_count{_prom_labels(**labels)} {hist.count}")
+
+def render_metrics() -> str:
+    """Prometheus テキスト形式で出力"""
+    lines = []
+    with _METRICS_LOCK:
+        lines += ["# HELP webapp_requests_total リクエスト件数",
+                  "# TYPE webapp_requests_total counter"]
+        for (route, method, status), n in sorted(_REQUEST_COUNT.items()):
+            lines.append(f"webapp_requests_total{_prom_labels(route=route, method=method, status=status)} {n}")
+
+        lines += ["# HELP webapp_request_duration_seconds ルート別レイテンシ",
+                  "# TYPE webapp_request_duration_seconds histogram"]
+        for route, hist in sorted(_REQUEST_LATENCY.items()):
+            _prom_histogram(lines, "webapp_request_duration_seconds", hist, route=route)
+
+        lines += ["# HELP webapp_phase_duration_seconds 処理段階別レイテンシ",
+                  "# TYPE webapp_phase_duration_seconds histogram"]
+        for (route, phase), hist in sorted(_PHASE_LATENCY.items()):
+            _prom_histogram(lines, "webapp_phase_duration_seconds", hist, route=route, phase=phase)
+
+        lines += ["# HELP webapp_response_size_bytes レスポンスサイズ",
+                  "# TYPE webapp_response_size_bytes histogram"]
+        for route, hist in sorted(_RESPONSE_SIZE.items()):
+            if hist.count:
+                _prom_histogram(lines, "webapp_response_size_bytes", hist, route=route)
+
+        lines += ["# HELP webapp_cache_requests_total キャッシュ参照件数",
+                  "# TYPE webapp_cache_requests_total counter"]
+        for (cache, result), n in sorted(_CACHE_COUNT.items()):
+            lines.append(f"webapp_cache_requests_total{_prom_labels(cache=cache, result=result)} {n}")
+
+        lines += ["# HELP webapp_cache_hit_ratio キャッシュ命中率",
+                  "# TYPE webapp_cache_hit_ratio gauge"]
+        for cache in sorted({c for c, _ in _CACHE_COUNT}):
+            hit = _CACHE_COUNT.get((cache, "hit"), 0)
+            miss = _CACHE_COUNT.get((cache, "miss"), 0)
+            lines.append(f"webapp_cache_hit_ratio{_prom_labels(cache=cache)} {hit / (hit + miss):.4f}")
+    return "\n".join(lines) + "\n"
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+# ---------- リクエスト単位のCPUプロファイル（ヘッダまたはサンプリングで有効化） ----------
+PROFILE_DIR = Path(os.environ.get("WEBAPP_PROFILE_DIR", Path(BASE) / "profiles"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("WEBAPP_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_KEEP = int(os.environ.get("WEBAPP_PROFILE_KEEP", "50"))
+PROFILE_HEADER = "X-Profile"
+_PROFILE_NAME_RE = re.compile(r"^[\w.-]+\.prof$")
+
+def _should_profile() -> bool:
+    if request.headers.get(PROFILE_HEADER, "").strip().lower() in ("1", "true", "yes") and debug_allowed():
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def _save_profile(prof: cProfile.Profile, elapsed: float) -> str:
+    """pstats形式で保存し、古いものから削除して PROFILE_KEEP 件に保つ"""
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    slug = re.sub(r"[^\w]+", "_", _route_label()).strip("_") or "root"
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}_{slug}_{int(elapsed * 1000)}ms_{uuid.uuid4().hex[:8]}.prof"
+    prof.dump_stats(str(PROFILE_DIR / name))
+    files = sorted(PROFILE_DIR.glob("*.prof"), key=lambda p: p.stat().st_mtime)
+    for old in files[:-PROFILE_KEEP]:
+        old.unlink(missing_ok=True)
+    return name
+
+def profiled(view):
+    """対象ビューを cProfile 付きで実行（X-Profile: 1 またはサンプリング時のみ）"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if _WARMING.get() or not _should_profile():
+            return view(*args, **kwargs)
+        prof = cProfile.Profile()
+        t0 = time.perf_counter()
+        try:
+            response = prof.runcall(view, *args, **kwargs)
+        finally:
+            name = _save_profile(prof, time.perf_counter() - t0)
+        response = app.make_response(response)
+        response.headers["X-Profile-Id"] = name
+        return response
+    return wrapper
+
+@app.route("/debug/profiles")
+@debug_only
+def debug_profiles():
+    if not PROFILE_DIR.exists():
+        return jsonify({"profiles": []})
+    files = sorted(PROFILE_DIR.glob("*.prof"), key=lambda p: p.stat().st_mtime, reverse=True)
+    return jsonify({"profiles": [
+        {"name": p.name, "bytes": p.stat().st_size,
+         "created": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(p.stat().st_mtime))}
+        for p in files
+    ]})
+
+@app.route("/debug/profiles/<name>")
+@debug_only
+def debug_profile(name):
+    path = PROFILE_DIR / name
+    if not _PROFILE_NAME_RE.match(name) or not path.exists():
+        return jsonify({"error": f"profile not found: {name}"}), 404
+    if request.args.get("format") == "text":
+        out = io.StringIO()
+        pstats.Stats(str(path), stream=out).sort_stats("cumulative").print_stats(40)
+        return Response(out.getvalue(), mimetype="text/plain; charset=utf-8")
+    return send_file(path, mimetype="application/octet-stream", as_attachment=True, download_name=name)
+
+# ---------- 同一リクエストの集約（single-flight） ----------
+# 同じ URL のリクエストが処理中に重なったら、後から来た分は先行の処理を待って
+# 同じ応答本文を返す（多数の参加者が同時に同じユーザーを開いたときの重複計算を防ぐ）
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """キーごとに実行中の呼び出しを1つにまとめる"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, fn):
+        """
+        (結果, 自分が実行したか) を返す。実行側の例外は待っていた側にも送出
+        （KeyboardInterrupt・greenlet の終了など Exception 以外で中断した場合は RuntimeError）
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if isinstance(flight.error, Exception):
+                raise flight.error
+            if flight.error is not None:
+                raise RuntimeError(f"single-flight の実行側が中断しました: {flight.error!r}") from flight.error
+            return flight.result, False
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result, True
+
+_SINGLE_FLIGHT = SingleFlight()
+
+def coalesced(view):
+    """同じパス・クエリの同時リクエストを1回の実行にまとめる（応答は本文・ステータスを複製）"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        def run():
+            response = app.make_response(view(*args, **kwargs))
+            return response.get_data(), response.status_code, response.mimetype
+        key = (view.__name__, request.path, request.query_string)
+        (body, status, mimetype), leader = _SINGLE_FLIGHT.do(key, run)
+        record_cache("singleflight", not leader)
+        return Response(body, status=status, mimetype=mimetype)
+    return wrapper
+
+# ---------- 応答キャッシュ（元データが変わるまで応答本文を再利用） ----------
+RESPONSE_CACHE_MAX = int(os.environ.get("WEBAPP_RESPONSE_CACHE_MAX", "50000"))
+_RESPONSE_CACHE = collections.OrderedDict()   # (view, path, query) -> (signature, body, status, mimetype)
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+def cached_response(signature):
+    """
+    成功応答を (ビュー, パス, クエリ) ごとに保持し、signature() が同じ間は再利用する
+    件数が RESPONSE_CACHE_MAX を超えたら古いものから捨てる
+    """
+    def deco(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (view.__name__, request.path, request.query_string)
+            sig = signature()
+            with _RESPONSE_CACHE_LOCK:
+                entry = _RESPONSE_CACHE.get(key)
+                if entry is not None and entry[0] == sig:
+                    _RESPONSE_CACHE.move_to_end(key)
+            hit = entry is not None and entry[0] == sig
+            record_cache(view.__name__, hit)
+            if hit:
+                return Response(entry[1], status=entry[2], mimetype=entry[3])
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                with _RESPONSE_CACHE_LOCK:
+                    _RESPONSE_CACHE[key] = (sig, response.get_data(), response.status_code, response.mimetype)
+                    _RESPONSE_CACHE.move_to_end(key)
+                    while len(_RESPONSE_CACHE) > RESPONSE_CACHE_MAX:
+                        _RESPONSE_CACHE.popitem(last=False)
+            return response
+        return wrapper
+    return deco
+
+def _compare_signature() -> tuple:
+    """比較ビューの応答が依存する元データ"""
+    return _source_signature(POI_CSV, POI_ALIAS_CSV, DESIRED_CSV, PROPOSAL_CSV, USER_TYPE_CSV,
+                           POI_PREF_CSV, TRANSPORT_PREF_CSV, PERSUASIVE_TEXT_JSON, PERSUASIVE_TEXT_EN_JSON)
+
+# ---------- メモリ診断（tracemalloc によるピーク・確保箇所の計測） ----------
+MEMORY_TRACE_ALWAYS = os.environ.get("WEBAPP_TRACEMALLOC", "") == "1"
+MEMORY_HEADER = "X-Memory-Profile"
+MEMORY_TOP_N = 10
+_MEMORY_LOCK = threading.Lock()   # tracemalloc はプロセス全体なので同時に1リクエストだけ計測
+_MEMORY_REPORTS = {}              # route -> 直近/最大ピークと確保箇所
+
+@app.before_request
+def _memory_start():
+    wanted = MEMORY_TRACE_ALWAYS or (request.headers.get(MEMORY_HEADER, "").strip().lower() in ("1", "true", "yes")
+                                     and debug_allowed())
+    if not wanted or not _MEMORY_LOCK.acquire(blocking=False):
+        return
+    g.memory_trace = {"current": 0, "snapshot": None}
+    tracemalloc.start()
+
+def memory_checkpoint():
+    """計測中なら、これまでで最大の生存メモリ時点のスナップショットを残す"""
+    state = g.get("memory_trace")
+    if state is None:
+        return
+    current, _ = tracemalloc.get_traced_memory()
+    if current >= state["current"]:
+        state["current"] = current
+        state["snapshot"] = tracemalloc.take_snapshot()
+
+@app.after_request
+def _memory_finish(response):
+    state = g.get("memory_trace")
+    if state is None:
+        return response
+    memory_checkpoint()
+    _, peak = tracemalloc.get_traced_memory()
+    snapshot = state["snapshot"].filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ])
+    top = [
+        {"site": f"{s.traceback[0].filename}:{s.traceback[0].lineno}", "bytes": s.size, "count": s.count}
+        for s in snapshot.statistics("lineno")[:MEMORY_TOP_N]
+    ]
+    route = _route_label()
+    with _METRICS_LOCK:
+        prev = _MEMORY_REPORTS.get(route, {"requests": 0, "max_peak_bytes": 0})
+        _MEMORY_REPORTS[route] = {
+            "requests": prev["requests"] + 1,
+            "last_peak_bytes": peak,
+            "max_peak_bytes": max(prev["max_peak_bytes"], peak),
+            "top_sites": top,
+        }
+    response.headers["X-Memory-Peak"] = str(peak)
+    return response
+
+@app.teardown_request
+def _memory_stop(exc=None):
+    if g.pop("memory_trace", None) is not None:
+        tracemalloc.stop()
+        _MEMORY_LOCK.release()
+
+def _deep_sizeof(obj) -> int:
+    """コンテナをたどった概算サイズ（共有オブジェクトは1回だけ数える）"""
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        if isinstance(o, np.ndarray):
+            total += o.nbytes + sys.getsizeof(o) if o.base is None else sys.getsizeof(o)
+            continue
+        if isinstance(o, pd.DataFrame):
+            total += int(o.memory_usage(deep=True).sum())
+            continue
+        total += sys.getsizeof(o)
+        if type(o).__module__ == __name__ and not isinstance(o, type):
+            # このモジュールのクラス（PlanSlot・PoiResolver・索引など）は属性をたどる
+            stack.extend(getattr(o, k, None) for k in getattr(type(o), "__slots__", ()))
+            stack.extend(getattr(o, "__dict__", {}).values())
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+    return total
+
+def _rss_bytes():
+    """プロセスの常駐メモリ（Linux は /proc、その他は最大RSS）"""
+    status = Path("/proc/self/status")
+    if status.exists():
+        for line in status.read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def data_snapshot_sizes() -> dict:
+    """
+    メモリ上にある元データ・キャッシュの概算（バイト）。計測のために読み込み直すことはしない
+    mmap の配列（スナップショットの版・best.pack）はヒープではないので mapped に別計上
+    """
+    with _RESPONSE_CACHE_LOCK:
+        responses = dict(_RESPONSE_CACHE)
+    with _ROUTE_CACHE_LOCK:
+        routes = dict(_ROUTE_CACHE)
+    with _COMPARE_PLAN_LOCK:
+        plans = dict(_COMPARE_PLAN_CACHE)
+    snap = _SNAPSHOT
+    parts = {
+        "snapshot": snap,
+        "poi_resolver": dict(_RESOLVER_CACHE),
+        "poi_spatial_index": dict(_SPATIAL_CACHE),
+        "interned_strings": [_SLOT_LABELS.values, _POI_NAMES.values, _MODES.values, _SLOT_INFO],
+        "response_cache": responses,
+        "route_cache": routes,
+        "compare_plan_cache": plans,
+        "plan_ranks": dict(_PLAN_RANK_CACHE),
+        "type_sensitivity": dict(_SENSITIVITY_CACHE),
+        "type_inference": [dict(_TYPE_MODEL_CACHE), dict(_INFERRED_TYPES_CACHE)],
+        "heatmap_cache": dict(_HEATMAP_CACHE),
+        "cluster_cache": dict(_CLUSTER_CACHE),
+        "recommend_cache": dict(_RECOMMEND_CACHE),
+    }
+    sizes = {k: _deep_sizeof(v) for k, v in parts.items()}
+    sizes["total"] = sum(sizes.values())
+
+    tensors = snap.tensors if snap is not None and snap.tensors is not None else {}
+    archive = _PLAN_ARCHIVE
+    mapped = {
+        "snapshot_arrays": sum(a.nbytes for a in tensors.values() if isinstance(a, np.memmap)),
+        "plan_archive": len(archive.mm) if archive is not None else 0,
+    }
+    mapped["total"] = sum(mapped.values())
+    sizes["mapped"] = mapped
+    return sizes
+
+@app.route("/debug/memory")
+@debug_only
+def debug_memory():
+    with _METRICS_LOCK:
+        endpoints = {k: dict(v) for k, v in _MEMORY_REPORTS.items()}
+    return jsonify({
+        "rss_bytes": _rss_bytes(),
+        "data_snapshot_bytes": data_snapshot_sizes(),
+        "endpoints": endpoints,
+    })
+
+# ---------- トレース（入れ子スパンを OpenTelemetry 互換の JSONL で出力） ----------
+TRACE_ENABLED = os.environ.get("WEBAPP_TRACE", "") == "1"
+TRACE_FILE = Path(os.environ.get("WEBAPP_TRACE_FILE", Path(BASE) / "traces" / "spans.jsonl"))
+_TRACE_LOCK = threading.Lock()
+_CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    """1区間の記録。to_otel() で OTLP/JSON の span 形式に変換"""
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "kind",
+                 "start_ns", "end_ns", "attributes", "status")
+
+    def __init__(self, name: str, parent=None, kind: str = "SPAN_KIND_INTERNAL"):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = {}
+        self.status = {"code": "STATUS_CODE_UNSET"}
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_otel(self) -> dict:
+        out = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": _otel_value(v)} for k, v in self.attributes.items()],
+            "status": self.status,
+        }
+        if self.parent_id:
+            out["parentSpanId"] = self.parent_id
+        return out
+
+def _otel_value(v) -> dict:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, (int, np.integer)):
+        return {"intValue": str(int(v))}
+    if isinstance(v, (float, np.floating)):
+        return {"doubleValue": float(v)}
+    return {"stringValue": str(v)}
+
+def _export_spans(spans: list):
+    TRACE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    lines = "".join(json.dumps(s.to_otel(), ensure_ascii=False) + "\n" for s in spans)
+    with _TRACE_LOCK, open(TRACE_FILE, "a", encoding="utf-8") as f:
+        f.write(lines)
+
+def trace_attributes(**attributes):
+    """現在のスパンに属性を付与"""
+    span = _CURRENT_SPAN.get()
+    if span is not None:
+        span.set(**attributes)
+
+@contextlib.contextmanager
+def trace_span(name: str, **attributes):
+    """
+    処理段階を囲むスパン。リクエスト内では処理段階メトリクスにも記録し、
+    スパンはリクエスト終了時にまとめて書き出す
+    """
+    span = Span(name, _CURRENT_SPAN.get())
+    span.set(**attributes)
+    token = _CURRENT_SPAN.set(span)
+    t0 = time.perf_counter()
+    try:
+        yield span
+    except Exception as e:
+        span.status = {"code": "STATUS_CODE_ERROR", "message": str(e)}
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        _CURRENT_SPAN.reset(token)
+        if has_request_context():
+            observe_phase(name, time.perf_counter() - t0)
+            if TRACE_ENABLED:
+                g.setdefault("trace_spans", []).append(span)
+        elif TRACE_ENABLED:
+            _export_spans([span])
+
+@app.before_request
+def _trace_start():
+    if not TRACE_ENABLED:
+        return
+    span = Span(f"{request.method} {_route_label()}", kind="SPAN_KIND_SERVER")
+    span.set(**{"http.method": request.method, "http.route": _route_label(), "http.target": request.full_path})
+    g.trace_root = (span, _CURRENT_SPAN.set(span))
+
+@app.after_request
+def _trace_status(response):
+    root = g.get("trace_root")
+    if root is not None:
+        root[0].set(**{"http.status_code": response.status_code})
+        if response.status_code >= 500:
+            root[0].status = {"code": "STATUS_CODE_ERROR"}
+    return response
+
+@app.teardown_request
+def _trace_finish(exc=None):
+    root = g.pop("trace_root", None)
+    if root is None:
+        return
+    span, token = root
+    span.end_ns = time.time_ns()
+    if exc is not None:
+        span.status = {"code": "STATUS_CODE_ERROR", "message": str(exc)}
+    _CURRENT_SPAN.reset(token)
+    _export_spans(g.pop("trace_spans", []) + [span])
+
+# ---------- プランアーカイブ（plans/best.pack を mmap して応答本文をそのまま返す） ----------
+# 構成は scripts/csv_to_plans.py を参照。ファイルが置き換わったら開き直す
+PLAN_ARCHIVE = BASE_P / "plans" / "best.pack"
+PLAN_USER_MIN = int(os.environ.get("WEBAPP_PLAN_USER_MIN", "1"))
+PLAN_USER_MAX = int(os.environ.get("WEBAPP_PLAN_USER_MAX", "30"))
+_PACK_MAGIC = b"PLANPAK1"
+_PACK_HEADER = struct.Struct("<8sIQ")
+_PACK_INDEX_DTYPE = np.dtype([("user", "<u4"), ("offset", "<u8"), ("length", "<u4")])
+_PLAN_ARCHIVE = None
+_PLAN_ARCHIVE_LOCK = threading.Lock()
+
+class PlanArchive:
+    """best.pack の読み取り。索引は mmap 上の配列をそのまま二分探索する"""
+    __slots__ = ("signature", "file", "mm", "users", "offsets", "lengths")
+
+    def __init__(self, path: Path):
+        self.signature = _data_signature(path)
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, index_offset = _PACK_HEADER.unpack_from(self.mm, 0)
+        if magic != _PACK_MAGIC:
+            raise ValueError(f"plan archive ではありません: {path}")
+        index = np.frombuffer(self.mm, dtype=_PACK_INDEX_DTYPE, count=n, offset=index_offset)
+        self.users, self.offsets, self.lengths = index["user"], index["offset"], index["length"]
+
+    def get(self, uid: int):
+        """ユーザーの応答本文（bytes）。なければ None"""
+        i = int(np.searchsorted(self.users, uid))
+        if i >= len(self.users) or self.users[i] != uid:
+            return None
+        start = int(self.offsets[i])
+        return self.mm[start:start + int(self.lengths[i])]
+
+def get_plan_archive():
+    """best.pack（なければ None）。置き換えられていたら開き直す"""
+    global _PLAN_ARCHIVE
+    sig = _data_signature(PLAN_ARCHIVE)
+    archive = _PLAN_ARCHIVE
+    if archive is not None and archive.signature == sig:
+        return archive
+    with _PLAN_ARCHIVE_LOCK:
+        if _PLAN_ARCHIVE is None or _PLAN_ARCHIVE.signature != sig:
+            # 旧版の mmap は参照中のリクエストがあり得るので閉じずに GC に任せる
+            _PLAN_ARCHIVE = PlanArchive(PLAN_ARCHIVE) if sig[0] is not None else None
+        return _PLAN_ARCHIVE
+
 # ---------- 既存：単一地図UI ----------
 @app.route("/")
 def index():
-    pois = load_poi_data()
-    return render_template("index.html", pois=pois)
+    # POIは表示範囲ぶんだけ /api/pois から取得する
+    return render_template("index.html", timeline=TIMELINE.to_dict())
 
 
 @app.route("/api/plan")
+@profiled
 def api_plan():
     user = request.args.get("user", "").strip()
     kind = "best"
@@ -125,15 +1198,173 @@ def api_plan():
     if not user.isdigit():
         return jsonify({"error": "user には数字を指定してください"}), 400
     uid = int(user)
-    if uid < 1 or uid > 30:
-        return jsonify({"error": "user は 1〜30 の範囲で指定してください"}), 400
+    if uid < PLAN_USER_MIN or uid > PLAN_USER_MAX:
+        return jsonify({"error": f"user は {PLAN_USER_MIN}〜{PLAN_USER_MAX} の範囲で指定してください"}), 400
+    if "k" in request.args:
+        return _api_plan_topk(uid)
+
+    archive = get_plan_archive()
+    if archive is not None:
+        body = archive.get(uid)
+        if body is None:
+            return jsonify({"error": f"plan not found: user {uid} in {PLAN_ARCHIVE}"}), 404
+        return Response(body, mimetype="application/json")
 
+    # アーカイブがなければ従来の <user>/best.json
     plan_path = os.path.join(DATA_DIR, "plans", str(uid), f"{kind}.json")
     if not os.path.exists(plan_path):
         return jsonify({"error": f"plan not found: {plan_path}"}), 404
 
     return jsonify(load_json(plan_path))
 
+# ---------- POIの空間索引（格子）と範囲・近傍検索 ----------
+POI_QUERY_LIMIT = 2000        # 1回の範囲検索で返す最大件数
+_SPATIAL_CACHE = {}
+_EARTH_M = 6371000.0
+
+def _haversine_m(lat: float, lng: float, lat2: np.ndarray, lng2: np.ndarray) -> np.ndarray:
+    """haversine 距離（m）"""
+    p1, p2 = np.radians(lat), np.radians(lat2)
+    dp, dl = p2 - p1, np.radians(lng2 - lng)
+    a = np.sin(dp / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(dl / 2) ** 2
+    return 2 * _EARTH_M * np.arcsin(np.sqrt(a))
+
+class PoiGridIndex:
+    """
+    POI座標の格子索引。1セルに平均数件入る幅で区切り、
+    範囲検索は重なるセルだけ、近傍検索は内側のセルから順に調べる
+    """
+
+    def __init__(self, pois: list):
+        self.pois = pois
+        self.lat = np.array([p["lat"] for p in pois], dtype=np.float64)
+        self.lng = np.array([p["lng"] for p in pois], dtype=np.float64)
+        self.category = np.array([p["category"] for p in pois], dtype=object)
+        n = len(pois)
+        if n == 0:
+            self.lat0 = self.lng0 = 0.0
+            self.size = 1.0
+            self.cells = {}
+            return
+        self.lat0, self.lng0 = float(self.lat.min()), float(self.lng.min())
+        span = max(float(self.lat.max()) - self.lat0, float(self.lng.max()) - self.lng0, 1e-4)
+        self.size = span / max(1, int(np.sqrt(n / 4)))
+        iy = ((self.lat - self.lat0) // self.size).astype(int)
+        ix = ((self.lng - self.lng0) // self.size).astype(int)
+        self.cells = {}
+        for i, key in enumerate(zip(iy.tolist(), ix.tolist())):
+            self.cells.setdefault(key, []).append(i)
+        self.cells = {k: np.array(v) for k, v in self.cells.items()}
+        self.max_ring = int(span // self.size) + 1
+
+    def _cell(self, lat: float, lng: float):
+        return int((lat - self.lat0) // self.size), int((lng - self.lng0) // self.size)
+
+    def bbox(self, south: float, west: float, north: float, east: float, category=None) -> np.ndarray:
+        """矩形内のPOIの添字"""
+        y0, x0 = self._cell(south, west)
+        y1, x1 = self._cell(north, east)
+        if (y1 - y0 + 1) * (x1 - x0 + 1) <= len(self.cells):
+            parts = [self.cells[(y, x)] for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)
+                     if (y, x) in self.cells]
+        else:
+            parts = [v for (y, x), v in self.cells.items() if y0 <= y <= y1 and x0 <= x <= x1]
+        if not parts:
+            return np.array([], dtype=int)
+        idx = np.concatenate(parts)
+        mask = ((self.lat[idx] >= south) & (self.lat[idx] <= north) &
+                (self.lng[idx] >= west) & (self.lng[idx] <= east))
+        if category:
+            mask &= self.category[idx] == category
+        return np.sort(idx[mask])
+
+    def distance_m(self, lat: float, lng: float, idx) -> np.ndarray:
+        return _haversine_m(lat, lng, self.lat[idx], self.lng[idx])
+
+    def nearest(self, lat: float, lng: float, k: int = 5, category=None) -> list:
+        """近い順に (添字, 距離m) を k 件"""
+        cy, cx = self._cell(lat, lng)
+        # 1セル外側に広げたときに近づける最短距離（経度方向は cos(緯度) で縮む）
+        ring_m = np.radians(self.size) * _EARTH_M * np.cos(np.radians(lat))
+        found = []
+        for r in range(self.max_ring + max(abs(cy), abs(cx)) + 2):
+            ring = [(cy + dy, cx + dx) for dy in range(-r, r + 1) for dx in range(-r, r + 1)
+                    if max(abs(dy), abs(dx)) == r]
+            parts = [self.cells[c] for c in ring if c in self.cells]
+            if parts:
+                idx = np.concatenate(parts)
+                if category:
+                    idx = idx[self.category[idx] == category]
+                found.extend(zip(idx.tolist(), self.distance_m(lat, lng, idx).tolist()))
+            if len(found) >= k:
+                best = heapq.nsmallest(k, found, key=lambda t: t[1])
+                if best[-1][1] <= r * ring_m:
+                    return best
+        return heapq.nsmallest(k, found, key=lambda t: t[1])
+
+def get_poi_index() -> PoiGridIndex:
+    """POIデータが変わるまで同じ索引を使い回す"""
+    sig = _source_signature(POI_CSV)
+    index = _SPATIAL_CACHE.get(sig)
+    record_cache("poi_spatial", index is not None)
+    if index is None:
+        _SPATIAL_CACHE.clear()
+        index = _SPATIAL_CACHE[sig] = PoiGridIndex(load_poi_data())
+    return index
+
+def _parse_floats(text: str, n: int):
+    try:
+        vals = [float(v) for v in text.split(",")]
+    except ValueError:
+        return None
+    return vals if len(vals) == n else None
+
+@app.route("/api/pois")
+def api_pois():
+    """
+    POI検索
+      bbox=south,west,north,east  … 表示範囲内のPOI
+      name=...（複数可）           … 名前指定（表記ゆれも解決）
+      category=...                 … カテゴリで絞込み
+    """
+    index = get_poi_index()
+    category = request.args.get("category", "").strip() or None
+    names = request.args.getlist("name")
+    if names:
+        _, resolver = _load_poi_master_for_geo()
+        ids = {str(resolver.get(n.strip())) for n in names}
+        hits = [i for i, p in enumerate(index.pois) if str(p["id"]) in ids]
+        if category:
+            hits = [i for i in hits if index.pois[i]["category"] == category]
+    else:
+        bbox = _parse_floats(request.args.get("bbox", ""), 4)
+        if bbox is None:
+            return jsonify({"error": "bbox=south,west,north,east を指定してください"}), 400
+        south, west, north, east = bbox
+        if south > north or west > east:
+            return jsonify({"error": "bbox の範囲が不正です"}), 400
+        hits = index.bbox(south, west, north, east, category).tolist()
+    return jsonify({
+        "count": len(hits),
+        "truncated": len(hits) > POI_QUERY_LIMIT,
+        "pois": [index.pois[i] for i in hits[:POI_QUERY_LIMIT]],
+    })
+
+@app.route("/api/pois/nearest")
+def api_pois_nearest():
+    index = get_poi_index()
+    point = _parse_floats(f"{request.args.get('lat', '')},{request.args.get('lng', '')}", 2)
+    if point is None:
+        return jsonify({"error": "lat, lng には数値を指定してください"}), 400
+    k = request.args.get("k", "5").strip()
+    if not k.isdigit() or not 1 <= int(k) <= 100:
+        return jsonify({"error": "k は 1〜100 の範囲で指定してください"}), 400
+    category = request.args.get("category", "").strip() or None
+    return jsonify({"pois": [
+        dict(index.pois[i], distance_m=round(d, 1))
+        for i, d in index.nearest(point[0], point[1], int(k), category)
+    ]})
+
 # ---------- 一覧比較（カードUI） ----------
 @app.route("/ui/compare")
 def ui_compare():
@@ -161,6 +1392,14 @@ def _pick_col(cols, *cands):
     return None
 
 def _load_poi_master_for_geo():
+    if USE_SQLITE:
+        return _sqlite_load_poi_master()
+    snap = current_snapshot()
+    m = snap.poi_master if snap is not None else _csv_load_poi_master()
+    # POI名でも検索できるように（表記ゆれ・別名も解決）
+    return m, get_poi_resolver(m)
+
+def _csv_load_poi_master() -> dict:
     df = pd.read_csv(POI_CSV, encoding="utf-8-sig")
     idc   = _pick_col(df.columns, "PoI_ID","poi_id","id")
     namec = _pick_col(df.columns, "施設名","name","名称")
@@ -175,52 +1414,406 @@ def _load_poi_master_for_geo():
             "category": str(r[catc]) if catc else "その他",
             "lat": float(r[latc]), "lng": float(r[lngc])
         }
-    # POI名でも検索できるように
-    name_map = {}
-    for poi_id, info in m.items():
-        name_map[info["name"]] = poi_id
-    return m, name_map
+    return m
+
+# ---------- POI名の解決（NFKC正規化・別名表・3-gram近似一致） ----------
+POI_ALIAS_CSV = BASE_P / "poi_aliases.csv"
+POI_FUZZY_THRESHOLD = 0.6          # 3-gram の Dice 係数がこれ以上なら近似一致とみなす
+POI_RESOLVER_MEMO_MAX = 4096       # 表記ゆれの解決結果を覚えておく件数（古いものから捨てる）
+_NAME_STRIP_RE = re.compile(r"[\s・･]+")
+_NON_POI_KEYS = {"move", "移動", "(未指定)"}
+_RESOLVER_CACHE = {}
+
+def normalize_poi_name(name: str) -> str:
+    """全角/半角・大文字/小文字・空白・中黒の違いを吸収したキー"""
+    return _NAME_STRIP_RE.sub("", unicodedata.normalize("NFKC", str(name)).casefold())
+
+def _trigrams(key: str) -> set:
+    padded = f"##{key}#"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def load_poi_aliases() -> dict:
+    """poi_aliases.csv（alias, poi_id）を読み込み"""
+    aliases = {}
+    if not POI_ALIAS_CSV.exists():
+        return aliases
+    with open(POI_ALIAS_CSV, "r", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            alias = pick(row, "alias", "別名")
+            poi_id = pick(row, "poi_id", "PoI_ID")
+            if alias and poi_id and str(poi_id).strip().isdigit():
+                aliases[alias.strip()] = int(poi_id)
+    return aliases
+
+class PoiResolver(dict):
+    """
+    POI名 → poi_id。完全一致は dict そのもの（従来の name_map と同じ）で引き、
+    外れた名前は 正規化キー → 別名 → 3-gram 近似 の順に解決して結果をメモ化する
+    （/api/pois?name= など利用者の入力も通るので、メモは件数上限つきの LRU）
+    """
+
+    def __init__(self, poi_master: dict, aliases: dict = None):
+        super().__init__((info["name"], poi_id) for poi_id, info in poi_master.items())
+        self.canonical = {poi_id: info["name"] for poi_id, info in poi_master.items()}
+        self.keys_to_id = {}
+        for name, poi_id in self.items():
+            self.keys_to_id.setdefault(normalize_poi_name(name), poi_id)
+        for alias, poi_id in (aliases or {}).items():
+            if poi_id in poi_master:
+                self.keys_to_id.setdefault(normalize_poi_name(alias), poi_id)
+        self.grams = {}
+        for key in self.keys_to_id:
+            for gram in _trigrams(key):
+                self.grams.setdefault(gram, []).append(key)
+        self.memo = collections.OrderedDict()   # 名前 -> (poi_id, 近似一致か)
+        self.memo_lock = threading.Lock()
+
+    def _fuzzy(self, key: str):
+        grams = _trigrams(key)
+        shared = {}
+        for gram in grams:
+            for cand in self.grams.get(gram, ()):
+                shared[cand] = shared.get(cand, 0) + 1
+        if not shared:
+            return None
+        scored = sorted(((2 * n / (len(grams) + len(_trigrams(c))), c) for c, n in shared.items()), reverse=True)
+        best_score, best = scored[0]
+        ties = len(scored) > 1 and scored[1][0] == best_score and self.keys_to_id[scored[1][1]] != self.keys_to_id[best]
+        if best_score < POI_FUZZY_THRESHOLD or ties:
+            return None
+        return self.keys_to_id[best]
+
+    def lookup(self, name: str) -> tuple:
+        """(poi_id or None, 近似一致で解決したか)"""
+        poi_id = dict.get(self, name)
+        if poi_id is not None:
+            return poi_id, False
+        with self.memo_lock:
+            hit = self.memo.get(name)
+            if hit is not None:
+                self.memo.move_to_end(name)
+                return hit
+        key = normalize_poi_name(name)
+        poi_id, fuzzy = None, False
+        if key and key not in _NON_POI_KEYS:
+            poi_id = self.keys_to_id.get(key)
+            if poi_id is None:
+                poi_id = self._fuzzy(key)
+                fuzzy = poi_id is not None
+        with self.memo_lock:
+            self.memo[name] = (poi_id, fuzzy)
+            if len(self.memo) > POI_RESOLVER_MEMO_MAX:
+                self.memo.popitem(last=False)
+        return poi_id, fuzzy
+
+    def resolve(self, name: str):
+        return self.lookup(name)[0]
+
+    def get(self, name, default=None):
+        poi_id = self.resolve(name)
+        return default if poi_id is None else poi_id
+
+    def __contains__(self, name):
+        return self.resolve(name) is not None
+
+    def __missing__(self, name):
+        poi_id = self.resolve(name)
+        if poi_id is None:
+            raise KeyError(name)
+        return poi_id
+
+def get_poi_resolver(poi_master: dict) -> PoiResolver:
+    """POIデータ・別名表が変わるまで同じ索引を使い回す"""
+    # ファイル更新後もワーカーが旧版を使っている間は旧版のPOIで引く（版もシグネチャに含まれる）
+    sig = _source_signature(POI_CSV, POI_ALIAS_CSV)
+    resolver = _RESOLVER_CACHE.get(sig)
+    record_cache("poi_resolver", resolver is not None)
+    if resolver is None:
+        _RESOLVER_CACHE.clear()
+        resolver = _RESOLVER_CACHE[sig] = PoiResolver(poi_master, load_poi_aliases())
+        log_poi_name_audit(resolver)
+    return resolver
+
+def audit_plan_poi_names(paths, resolver: PoiResolver) -> dict:
+    """
+    取込み時のチェック: プランCSVのPOI名のうち、近似一致で解決したもの・解決できないものを返す
+    {"fuzzy": {名前: 採用POI名}, "unresolved": {名前: 出現行数}}
+    """
+    report = {"fuzzy": {}, "unresolved": {}}
+    for path in paths:
+        if not Path(path).exists():
+            continue
+        counts = pd.read_csv(path, encoding="utf-8-sig", usecols=["POI"], dtype=str)["POI"] \
+                   .fillna("").str.strip().value_counts()
+        for name, n in counts.items():
+            poi_id, fuzzy = resolver.lookup(name)
+            if poi_id is None:
+                if normalize_poi_name(name) not in _NON_POI_KEYS and name:
+                    report["unresolved"][name] = report["unresolved"].get(name, 0) + int(n)
+            elif fuzzy:
+                report["fuzzy"][name] = resolver.canonical[poi_id]
+    return report
+
+_POI_AUDIT_SIG = None
+_POI_AUDIT_LOCK = threading.Lock()
+
+def log_poi_name_audit(resolver: PoiResolver, background: bool = True):
+    """
+    audit_plan_poi_names の結果をログに出す（POI・別名表・プランの組合せごとに1回）
+    索引・スナップショットを作ったときに呼ぶ。プランCSV全体を読むので、リクエスト中は別スレッドで行う
+    """
+    global _POI_AUDIT_SIG
+    paths = [DESIRED_CSV, PROPOSAL_CSV, SOLUTIONS_CSV]
+    sig = _data_signature(POI_CSV, POI_ALIAS_CSV, *paths, *((SQLITE_DB,) if USE_SQLITE else ()))
+    with _POI_AUDIT_LOCK:
+        if sig == _POI_AUDIT_SIG:
+            return
+        _POI_AUDIT_SIG = sig
+
+    def run():
+        try:
+            report = audit_plan_poi_names(paths, resolver)
+        except Exception:
+            app.logger.exception("POI name audit failed")
+            return
+        for name, matched in report["fuzzy"].items():
+            app.logger.warning("POI名を近似一致で解決: %s → %s", name, matched)
+        for name, n in report["unresolved"].items():
+            app.logger.warning("POI名を解決できません: %s（%d 行）", name, n)
+    if background:
+        threading.Thread(target=run, name="poi-audit", daemon=True).start()
+    else:
+        run()
+
 
 def _read_plan_csv(path: Path, poi_master: dict, name_map: dict, user_filter=None):
     """
     CSVを読み込み、指定ユーザーのプランを返す
     Slot列: start, slot1-13, return
     """
+    return [s.as_dict(poi_master) for s in _read_plan_slots(path, name_map, user_filter)]
+
+# ---------- プランスロット（__slots__ + 文字列ID化、文字列化はシリアライズ時のみ） ----------
+class _Interner:
+    """文字列 ⇔ 整数ID（プロセス内で共有）"""
+    __slots__ = ("ids", "values", "lock")
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+        self.lock = threading.Lock()
+
+    def id(self, s: str) -> int:
+        i = self.ids.get(s)
+        if i is None:
+            with self.lock:
+                i = self.ids.get(s)
+                if i is None:
+                    i = len(self.values)
+                    self.values.append(sys.intern(s))
+                    self.ids[self.values[i]] = i
+        return i
+
+    def __getitem__(self, i: int) -> str:
+        return self.values[i]
+
+_SLOT_LABELS = _Interner()
+_POI_NAMES = _Interner()
+_MODES = _Interner()
+_SLOT_INFO = {}     # slot id -> (start/return か, 時刻表示, 時間帯ベースの混雑度)
+_MOVE_NAMES = {}    # poi_name id -> 移動行か
+
+class PlanSlot:
+    """1スロット分。POI名・スロット名・交通手段は整数ID、座標やカテゴリは poi_master から引く"""
+    __slots__ = ("slot", "name", "poi_id", "mode", "congestion", "satisfaction", "level")
+
+    def __init__(self, slot: int, name: int, poi_id, mode: int):
+        self.slot = slot
+        self.name = name
+        self.poi_id = poi_id
+        self.mode = mode
+        self.congestion = None
+        self.satisfaction = None
+        self.level = None
+
+    def as_dict(self, poi_master: dict) -> dict:
+        """_read_plan_csv 形式の辞書"""
+        info = poi_master.get(self.poi_id) if self.poi_id is not None else None
+        return {
+            "slot": _SLOT_LABELS[self.slot],
+            "poi_name": _POI_NAMES[self.name],
+            "poi_id": self.poi_id,
+            "category": info["category"] if info else "その他",
+            "mode": _MODES[self.mode],
+            "lat": info["lat"] if info else None,
+            "lng": info["lng"] if info else None,
+        }
+
+def _slot_info(slot_id: int) -> tuple:
+    info = _SLOT_INFO.get(slot_id)
+    if info is None:
+        slot = _SLOT_LABELS[slot_id]
+        match = re.search(r"\d+", slot)
+        terminal = slot in ["start", "return"]
+        time_display = TIMELINE.label(int(match.group())).replace(":", "\n") if match else ""
+        info = _SLOT_INFO[slot_id] = (terminal, time_display, _congestion_base(slot))
+    return info
+
+def _is_move(name_id: int) -> bool:
+    move = _MOVE_NAMES.get(name_id)
+    if move is None:
+        move = _MOVE_NAMES[name_id] = _POI_NAMES[name_id].lower() in ["move", "移動"]
+    return move
+
+def _read_plan_slots(path: Path, name_map: dict, user_filter=None) -> list:
+    """CSV（または SQLite ストア）から指定ユーザーのプランを PlanSlot のリストで返す"""
+    if USE_SQLITE and Path(path) in _sqlite_sources():
+        return _sqlite_read_plan(_sqlite_sources()[Path(path)], user_filter)
     df = pd.read_csv(path, encoding="utf-8-sig")
     if not {"Slot","POI","Transport"}.issubset(df.columns):
         return []
-    
+
     # ユーザーフィルタ
     if user_filter and "User" in df.columns:
         df = df[df["User"] == user_filter]
-    
+
+    slots = df["Slot"].astype(str).str.strip().str.lower()
+    names = df["POI"].astype(str).str.strip()
+    modes = df["Transport"].astype(str).str.strip().str.lower()
+    return [
+        PlanSlot(_SLOT_LABELS.id(s), _POI_NAMES.id(n), name_map.get(n), _MODES.id(m))
+        for s, n, m in zip(slots, names, modes)
+    ]
+
+def _congestion_base(slot: str) -> int:
+    """時間帯ベースの混雑度"""
+    # slotから時間を推定
+    if slot == "start" or slot == "return":
+        return 0
+    match = re.search(r"\d+", slot)
+    if not match:
+        return 25
+    # slot番号ごとに前計算した値（既定は slot1=9時, slot2=10時, ...）
+    return TIMELINE.base_congestion(int(match.group()))
+
+def _icon_sat_from_10(score: float) -> int:
+    """10点満点 → 5段階"""
+    if score >= 8: return 5  # VerySatisfied
+    if score >= 6: return 4  # Satisfied
+    if score >= 4: return 3  # Neutral
+    if score >= 2: return 2  # upset
+    return 1  # angry
+
+def _icon_cong(cong: int) -> str:
+    """混雑度 → アイコン"""
+    if cong < 20: return "/static/img/congestion/空いている.png"
+    if cong < 40: return "/static/img/congestion/やや空いている.png"
+    if cong < 60: return "/static/img/congestion/普通.png"
+    if cong < 80: return "/static/img/congestion/やや混雑.png"
+    return "/static/img/congestion/混雑.png"
+
+def _icon_sat(s: int) -> str:
+    """満足度1-5 → アイコン"""
+    if s == 1: return "/static/img/satisfaction/angry.png"
+    if s == 2: return "/static/img/satisfaction/upset.png"
+    if s == 3: return "/static/img/satisfaction/Neutral.png"
+    if s == 4: return "/static/img/satisfaction/Satisfied.png"
+    return "/static/img/satisfaction/VerySatisfied.png"
+
+MODE_JP = {
+    "walking": "徒歩", "walk": "徒歩",
+    "rental bicycle": "レンタサイクル", "bike": "自転車",
+    "city bus": "市バス", "bus": "バス",
+    "taxi": "タクシー", "car": "自家用車",
+    "stay": "滞在", "move": "移動"
+}
+
+MODE_EN = {
+    "walking": "Walking", "walk": "Walking",
+    "rental bicycle": "Rental Bicycle", "bike": "Bicycle",
+    "city bus": "City Bus", "bus": "Bus",
+    "taxi": "Taxi", "car": "Car",
+    "stay": "Stay", "move": "Move"
+}
+
+# 交通手段の正規化マップ
+TRANSPORT_NORMALIZE = {
+    "walking": "Walking",
+    "walk": "Walking",
+    "rental bicycle": "Rental Bicycle",
+    "bike": "Rental Bicycle",
+    "city bus": "City Bus",
+    "bus": "City Bus",
+    "taxi": "Taxi",
+    "car": "Taxi",
+}
+
+PLAN_LABELS = {
+    "ja": {"start": "出発", "return": "帰着", "modes": MODE_JP},
+    "en": {"start": "Depart", "return": "Return", "modes": MODE_EN},
+}
+
+def _score_plan(plan: list, user_type: str, poi_prefs: dict, transport_prefs: dict):
+    """各スロットに満足度・混雑度を付与し、総満足度を返す"""
+    total_satisfaction = 0
+    type_poi = poi_prefs.get(user_type, {})
+    type_transport = transport_prefs.get(user_type, {})
+
+    for s in plan:
+        terminal, _, congestion = _slot_info(s.slot)
+        # start/returnはスキップ
+        if terminal:
+            continue
+        penalty = (congestion - 50) / 100 * 3
+        s.congestion = congestion
+
+        # POIスロット
+        if not _is_move(s.name):
+            if s.poi_id and s.poi_id in type_poi:
+                s.satisfaction = max(0, type_poi[s.poi_id] - penalty)
+                s.level = _icon_sat_from_10(s.satisfaction)
+                total_satisfaction += s.satisfaction
+            else:
+                # POI情報がない場合
+                s.satisfaction = 3.0
+                s.level = 3
+        # 移動スロット
+        else:
+            transport_normalized = TRANSPORT_NORMALIZE.get(_MODES[s.mode], "Walking")
+            if transport_normalized in type_transport:
+                s.satisfaction = max(0, type_transport[transport_normalized] - penalty)
+                s.level = _icon_sat_from_10(s.satisfaction)
+                total_satisfaction += s.satisfaction
+            else:
+                # 交通手段情報がない場合
+                s.satisfaction = 5.0
+                s.level = 3
+
+    return total_satisfaction
+
+def _render_plan(plan: list, poi_master: dict, lang: str = "ja") -> list:
+    """スコア付きの PlanSlot → API応答の辞書（時刻表示・アイコン・表示名をここで付与）"""
+    labels = PLAN_LABELS[lang]
     out = []
-    for _, r in df.iterrows():
-        slot = str(r["Slot"]).strip().lower()
-        poi_name = str(r["POI"]).strip()
-        transport = str(r["Transport"]).strip()
-        
-        # 座標とカテゴリの取得
-        lat = lng = None
-        cat = "その他"
-        poi_id = None
-        
-        # POI名から検索
-        if poi_name in name_map:
-            poi_id = name_map[poi_name]
-            info = poi_master[poi_id]
-            lat, lng, cat = info["lat"], info["lng"], info["category"]
-        
-        out.append({
-            "slot": slot,
-            "poi_name": poi_name,
-            "poi_id": poi_id,
-            "category": cat,
-            "mode": transport.lower(),
-            "lat": lat,
-            "lng": lng
-        })
-    
+    for s in plan:
+        p = s.as_dict(poi_master)
+        terminal, time_display, _ = _slot_info(s.slot)
+        if terminal:
+            p["time_display"] = labels[p["slot"]]
+            p["congestion"] = None
+            p["satisfaction"] = None
+            p["congestion_img"] = None
+            p["satisfaction_img"] = None
+            p["mode_jp"] = p["poi_name"]
+        else:
+            p["time_display"] = time_display
+            p["congestion"] = s.congestion
+            p["satisfaction"] = s.satisfaction
+            p["satisfaction_level"] = s.level
+            p["congestion_img"] = _icon_cong(s.congestion)
+            p["satisfaction_img"] = _icon_sat(s.level)
+            p["mode_jp"] = labels["modes"].get(p["mode"], p["mode"]) if _is_move(s.name) else p["poi_name"]
+        out.append(p)
     return out
 
 
@@ -236,7 +1829,50 @@ def ui_condition_b():
 def ui_compare_map_en():
     return render_template("compare_map_en.html")
 
+COMPARE_PLAN_CACHE_MAX = int(os.environ.get("WEBAPP_COMPARE_PLAN_CACHE_MAX", "20000"))
+_COMPARE_PLAN_CACHE = collections.OrderedDict()   # (user, user_type, kind, lang) -> (signature, 結果)
+_COMPARE_PLAN_LOCK = threading.Lock()
+
+def _compare_plan(user: str, user_type: str, kind: str, lang: str):
+    """
+    希望案（kind="desired"）/提案案（"proposal"）の (描画済みスロット, 満足度合計)。
+    JSON 版・NDJSON 版の比較ビューで共有し、元データが変わるまで再利用する（件数上限つきの LRU）。
+    同じ引数の同時呼び出しは1回の計算にまとめる
+    """
+    key = (user, user_type, kind, lang)
+    sig = _compare_signature()
+    with _COMPARE_PLAN_LOCK:
+        entry = _COMPARE_PLAN_CACHE.get(key)
+        if entry is not None and entry[0] == sig:
+            _COMPARE_PLAN_CACHE.move_to_end(key)
+    record_cache("compare_plan", entry is not None and entry[0] == sig)
+    if entry is not None and entry[0] == sig:
+        return entry[1]
+
+    def run():
+        poi_master, name_map = _load_poi_master_for_geo()
+        with trace_span(f"resolve.{kind}") as sp:
+            plan = _read_plan_slots(DESIRED_CSV if kind == "desired" else PROPOSAL_CSV, name_map, user)
+            sp.set(slots=len(plan), unresolved=sum(1 for p in plan if p.poi_id is None and not _is_move(p.name)))
+        # 各スロットの混雑度・満足度は _score_plan で埋まるので、採点してから描画
+        with trace_span(f"score.{kind}"):
+            total = _score_plan(plan, user_type, load_poi_preferences(), load_transport_preferences())
+        with trace_span(f"render.{kind}"):
+            out = _render_plan(plan, poi_master, lang)
+        with _COMPARE_PLAN_LOCK:
+            _COMPARE_PLAN_CACHE[key] = (sig, (out, total))
+            _COMPARE_PLAN_CACHE.move_to_end(key)
+            while len(_COMPARE_PLAN_CACHE) > COMPARE_PLAN_CACHE_MAX:
+                _COMPARE_PLAN_CACHE.popitem(last=False)
+        return out, total
+    result, leader = _SINGLE_FLIGHT.do(("compare_plan",) + key, run)
+    record_cache("compare_plan_singleflight", not leader)
+    return result
+
 @app.route("/api/compare_geo")
+@profiled
+@cached_response(_compare_signature)
+@coalesced
 def api_compare_geo():
     # ユーザー指定（デフォルト: User_1）
     user = request.args.get("user", "User_1").strip()
@@ -245,182 +1881,39 @@ def api_compare_geo():
         return jsonify({"error": "CSVが見つかりません"}), 404
 
     # データ読み込み
-    poi_master, name_map = _load_poi_master_for_geo()
-    user_types = load_user_types()
-    poi_prefs = load_poi_preferences()
-    transport_prefs = load_transport_preferences()
-    persuasive_texts = load_persuasive_texts()
+    with trace_span("load"):
+        user_types = load_user_types()
+        persuasive_texts = load_persuasive_texts()
     
-    # ユーザータイプ取得
-    user_type = user_types.get(user, "Type A")
+    # ユーザータイプ取得（未登録なら希望案から推定）
+    user_type = resolve_user_type(user, user_types)
     
     # 説得文取得
     persuasive_text = persuasive_texts.get(user, "")
     
-    # プラン読み込み
-    desired  = _read_plan_csv(DESIRED_CSV, poi_master, name_map, user)
-    proposal = _read_plan_csv(PROPOSAL_CSV, poi_master, name_map, user)
-
-    # --- 混雑度・満足度計算 ---
-    def _congestion_base(slot: str) -> int:
-        """時間帯ベースの混雑度"""
-        # slotから時間を推定
-        if slot == "start" or slot == "return":
-            return 0
-        match = re.search(r"\d+", slot)
-        if not match:
-            return 25
-        slot_num = int(match.group())
-        # slot1=9時, slot2=10時, ..., slot13=21時
-        hour = 8 + slot_num
-        
-        if 10 <= hour <= 15:
-            return 65  # 昼ピーク
-        if 8 <= hour < 10 or 15 < hour <= 18:
-            return 45
-        return 25
-
-    def _icon_sat_from_10(score: float) -> int:
-        """10点満点 → 5段階"""
-        if score >= 8: return 5  # VerySatisfied
-        if score >= 6: return 4  # Satisfied
-        if score >= 4: return 3  # Neutral
-        if score >= 2: return 2  # upset
-        return 1  # angry
-
-    def _icon_cong(cong: int) -> str:
-        """混雑度 → アイコン"""
-        if cong < 20: return "/static/img/congestion/空いている.png"
-        if cong < 40: return "/static/img/congestion/やや空いている.png"
-        if cong < 60: return "/static/img/congestion/普通.png"
-        if cong < 80: return "/static/img/congestion/やや混雑.png"
-        return "/static/img/congestion/混雑.png"
-
-    def _icon_sat(s: int) -> str:
-        """満足度1-5 → アイコン"""
-        if s == 1: return "/static/img/satisfaction/angry.png"
-        if s == 2: return "/static/img/satisfaction/upset.png"
-        if s == 3: return "/static/img/satisfaction/Neutral.png"
-        if s == 4: return "/static/img/satisfaction/Satisfied.png"
-        return "/static/img/satisfaction/VerySatisfied.png"
-
-    MODE_JP = {
-        "walking": "徒歩", "walk": "徒歩",
-        "rental bicycle": "レンタサイクル", "bike": "自転車",
-        "city bus": "市バス", "bus": "バス",
-        "taxi": "タクシー", "car": "自家用車",
-        "stay": "滞在", "move": "移動"
-    }
-    
-    # 交通手段の正規化マップ
-    TRANSPORT_NORMALIZE = {
-        "walking": "Walking",
-        "walk": "Walking",
-        "rental bicycle": "Rental Bicycle",
-        "bike": "Rental Bicycle",
-        "city bus": "City Bus",
-        "bus": "City Bus",
-        "taxi": "Taxi",
-        "car": "Taxi",
-    }
+    trace_attributes(user=user, user_type=user_type)
 
-    def _apply_scores(plan: list, user_type: str):
-        """各スロットに満足度・混雑度を付与"""
-        total_satisfaction = 0
-        
-        for p in plan:
-            slot = p["slot"]
-            
-            # start/returnはスキップ
-            if slot in ["start", "return"]:
-                p["time_display"] = "出発" if slot == "start" else "帰着"
-                p["congestion"] = None
-                p["satisfaction"] = None
-                p["congestion_img"] = None
-                p["satisfaction_img"] = None
-                p["mode_jp"] = p["poi_name"]
-                continue
-            
-            # 時刻表示用
-            match = re.search(r"\d+", slot)
-            if match:
-                slot_num = int(match.group())
-                hour = 8 + slot_num
-                p["time_display"] = f"{hour:02d}\n00"
-            else:
-                p["time_display"] = ""
-            
-            # 混雑度計算
-            congestion = _congestion_base(slot)
-            penalty = (congestion - 50) / 100 * 3
-            
-            # POIスロット（偶数: slot2, 4, 6, 8, 10, 12）
-            if p["poi_name"].lower() not in ["move", "移動"]:
-                if p["poi_id"] and p["poi_id"] in poi_prefs.get(user_type, {}):
-                    base_sat = poi_prefs[user_type][p["poi_id"]]
-                    poi_sat = max(0, base_sat - penalty)
-                    satisfaction_level = _icon_sat_from_10(poi_sat)
-                    
-                    p["congestion"] = congestion
-                    p["satisfaction"] = poi_sat
-                    p["satisfaction_level"] = satisfaction_level
-                    p["congestion_img"] = _icon_cong(congestion)
-                    p["satisfaction_img"] = _icon_sat(satisfaction_level)
-                    p["mode_jp"] = p["poi_name"]
-                    
-                    total_satisfaction += poi_sat
-                else:
-                    # POI情報がない場合
-                    p["congestion"] = congestion
-                    p["satisfaction"] = 3.0
-                    p["satisfaction_level"] = 3
-                    p["congestion_img"] = _icon_cong(congestion)
-                    p["satisfaction_img"] = _icon_sat(3)
-                    p["mode_jp"] = p["poi_name"]
-            
-            # 移動スロット（奇数: slot1, 3, 5, 7, 9, 11, 13）
-            else:
-                transport = p["mode"].lower()
-                transport_normalized = TRANSPORT_NORMALIZE.get(transport, "Walking")
-                
-                if transport_normalized in transport_prefs.get(user_type, {}):
-                    base_sat = transport_prefs[user_type][transport_normalized]
-                    transport_sat = max(0, base_sat - penalty)
-                    satisfaction_level = _icon_sat_from_10(transport_sat)
-                    
-                    p["congestion"] = congestion
-                    p["satisfaction"] = transport_sat
-                    p["satisfaction_level"] = satisfaction_level
-                    p["congestion_img"] = _icon_cong(congestion)
-                    p["satisfaction_img"] = _icon_sat(satisfaction_level)
-                    p["mode_jp"] = MODE_JP.get(transport, transport)
-                    
-                    total_satisfaction += transport_sat
-                else:
-                    # 交通手段情報がない場合
-                    p["congestion"] = congestion
-                    p["satisfaction"] = 5.0
-                    p["satisfaction_level"] = 3
-                    p["congestion_img"] = _icon_cong(congestion)
-                    p["satisfaction_img"] = _icon_sat(3)
-                    p["mode_jp"] = MODE_JP.get(transport, transport)
-        
-        return total_satisfaction
+    # プラン読み込み（POI名 → 座標の解決）・混雑度・満足度計算・表示用に整形
+    desired_out, desired_total = _compare_plan(user, user_type, "desired", "ja")
+    proposal_out, proposal_total = _compare_plan(user, user_type, "proposal", "ja")
 
-    desired_total = _apply_scores(desired, user_type)
-    proposal_total = _apply_scores(proposal, user_type)
-
-    return jsonify({
-        "desired": desired,
-        "proposal": proposal,
-        "desired_total_satisfaction": round(desired_total, 1),
-        "proposal_total_satisfaction": round(proposal_total, 1),
-        "user": user,
-        "user_type": user_type,
-        "persuasive_text": persuasive_text
-    })
+    with trace_span("serialize") as sp:
+        response = jsonify({
+            "desired": desired_out,
+            "proposal": proposal_out,
+            "desired_total_satisfaction": round(desired_total, 1),
+            "proposal_total_satisfaction": round(proposal_total, 1),
+            "user": user,
+            "user_type": user_type,
+            "persuasive_text": persuasive_text
+        })
+        sp.set(bytes=response.calculate_content_length())
+    return response
 
 @app.route("/api/compare_geo_en")
+@profiled
+@cached_response(_compare_signature)
+@coalesced
 def api_compare_geo_en():
     # ユーザー指定（デフォルト: User_1）
     user = request.args.get("user", "User_1").strip()
@@ -429,183 +1922,490 @@ def api_compare_geo_en():
         return jsonify({"error": "CSV files not found"}), 404
 
     # データ読み込み
-    poi_master, name_map = _load_poi_master_for_geo()
-    user_types = load_user_types()
-    poi_prefs = load_poi_preferences()
-    transport_prefs = load_transport_preferences()
-    
-    # 英語版説得文取得
-    persuasive_texts = {}
-    if PERSUASIVE_TEXT_EN_JSON.exists():
-        try:
-            with open(PERSUASIVE_TEXT_EN_JSON, 'r', encoding='utf-8') as f:
-                persuasive_texts = json.load(f)
-        except:
-            pass
+    with trace_span("load"):
+        user_types = load_user_types()
+        persuasive_texts = load_persuasive_texts(PERSUASIVE_TEXT_EN_JSON)
     
-    # ユーザータイプ取得
-    user_type = user_types.get(user, "Type A")
+    # ユーザータイプ取得（未登録なら希望案から推定）
+    user_type = resolve_user_type(user, user_types)
     
     # 説得文取得
     persuasive_text = persuasive_texts.get(user, "")
     
-    # プラン読み込み
-    desired  = _read_plan_csv(DESIRED_CSV, poi_master, name_map, user)
-    proposal = _read_plan_csv(PROPOSAL_CSV, poi_master, name_map, user)
-
-    # --- 混雑度・満足度計算 ---
-    def _congestion_base(slot: str) -> int:
-        """時間帯ベースの混雑度"""
-        if slot == "start" or slot == "return":
-            return 0
-        match = re.search(r"\d+", slot)
-        if not match:
-            return 25
-        slot_num = int(match.group())
-        hour = 8 + slot_num
-        
-        if 10 <= hour <= 15:
-            return 65
-        if 8 <= hour < 10 or 15 < hour <= 18:
-            return 45
-        return 25
+    trace_attributes(user=user, user_type=user_type)
 
-    def _icon_sat_from_10(score: float) -> int:
-        """10点満点 → 5段階"""
-        if score >= 8: return 5
-        if score >= 6: return 4
-        if score >= 4: return 3
-        if score >= 2: return 2
-        return 1
-
-    def _icon_cong(cong: int) -> str:
-        """混雑度 → アイコン"""
-        if cong < 20: return "/static/img/congestion/空いている.png"
-        if cong < 40: return "/static/img/congestion/やや空いている.png"
-        if cong < 60: return "/static/img/congestion/普通.png"
-        if cong < 80: return "/static/img/congestion/やや混雑.png"
-        return "/static/img/congestion/混雑.png"
-
-    def _icon_sat(s: int) -> str:
-        """満足度1-5 → アイコン"""
-        if s == 1: return "/static/img/satisfaction/angry.png"
-        if s == 2: return "/static/img/satisfaction/upset.png"
-        if s == 3: return "/static/img/satisfaction/Neutral.png"
-        if s == 4: return "/static/img/satisfaction/Satisfied.png"
-        return "/static/img/satisfaction/VerySatisfied.png"
-
-    MODE_EN = {
-        "walking": "Walking", "walk": "Walking",
-        "rental bicycle": "Rental Bicycle", "bike": "Bicycle",
-        "city bus": "City Bus", "bus": "Bus",
-        "taxi": "Taxi", "car": "Car",
-        "stay": "Stay", "move": "Move"
-    }
-    
-    TRANSPORT_NORMALIZE = {
-        "walking": "Walking",
-        "walk": "Walking",
-        "rental bicycle": "Rental Bicycle",
-        "bike": "Rental Bicycle",
-        "city bus": "City Bus",
-        "bus": "City Bus",
-        "taxi": "Taxi",
-        "car": "Taxi",
-    }
+    # プラン読み込み（POI名 → 座標の解決）・混雑度・満足度計算・表示用に整形
+    desired_out, desired_total = _compare_plan(user, user_type, "desired", "en")
+    proposal_out, proposal_total = _compare_plan(user, user_type, "proposal", "en")
 
-    def _apply_scores(plan: list, user_type: str):
-        """各スロットに満足度・混雑度を付与"""
-        total_satisfaction = 0
-        
-        for p in plan:
-            slot = p["slot"]
-            
-            # start/returnはスキップ
-            if slot in ["start", "return"]:
-                p["time_display"] = "Depart" if slot == "start" else "Return"
-                p["congestion"] = None
-                p["satisfaction"] = None
-                p["congestion_img"] = None
-                p["satisfaction_img"] = None
-                p["mode_jp"] = p["poi_name"]
-                continue
-            
-            # 時刻表示用
-            match = re.search(r"\d+", slot)
-            if match:
-                slot_num = int(match.group())
-                hour = 8 + slot_num
-                p["time_display"] = f"{hour:02d}\n00"
-            else:
-                p["time_display"] = ""
-            
-            # 混雑度計算
-            congestion = _congestion_base(slot)
-            penalty = (congestion - 50) / 100 * 3
-            
-            # POIスロット
-            if p["poi_name"].lower() not in ["move", "移動"]:
-                if p["poi_id"] and p["poi_id"] in poi_prefs.get(user_type, {}):
-                    base_sat = poi_prefs[user_type][p["poi_id"]]
-                    poi_sat = max(0, base_sat - penalty)
-                    satisfaction_level = _icon_sat_from_10(poi_sat)
-                    
-                    p["congestion"] = congestion
-                    p["satisfaction"] = poi_sat
-                    p["satisfaction_level"] = satisfaction_level
-                    p["congestion_img"] = _icon_cong(congestion)
-                    p["satisfaction_img"] = _icon_sat(satisfaction_level)
-                    p["mode_jp"] = p["poi_name"]
-                    
-                    total_satisfaction += poi_sat
-                else:
-                    p["congestion"] = congestion
-                    p["satisfaction"] = 3.0
-                    p["satisfaction_level"] = 3
-                    p["congestion_img"] = _icon_cong(congestion)
-                    p["satisfaction_img"] = _icon_sat(3)
-                    p["mode_jp"] = p["poi_name"]
-            
-            # 移動スロット
-            else:
-                transport = p["mode"].lower()
-                transport_normalized = TRANSPORT_NORMALIZE.get(transport, "Walking")
-                
-                if transport_normalized in transport_prefs.get(user_type, {}):
-                    base_sat = transport_prefs[user_type][transport_normalized]
-                    transport_sat = max(0, base_sat - penalty)
-                    satisfaction_level = _icon_sat_from_10(transport_sat)
-                    
-                    p["congestion"] = congestion
-                    p["satisfaction"] = transport_sat
-                    p["satisfaction_level"] = satisfaction_level
-                    p["congestion_img"] = _icon_cong(congestion)
-                    p["satisfaction_img"] = _icon_sat(satisfaction_level)
-                    p["mode_jp"] = MODE_EN.get(transport, transport)
-                    
-                    total_satisfaction += transport_sat
-                else:
-                    p["congestion"] = congestion
-                    p["satisfaction"] = 5.0
-                    p["satisfaction_level"] = 3
-                    p["congestion_img"] = _icon_cong(congestion)
-                    p["satisfaction_img"] = _icon_sat(3)
-                    p["mode_jp"] = MODE_EN.get(transport, transport)
-        
-        return total_satisfaction
+    with trace_span("serialize") as sp:
+        response = jsonify({
+            "desired": desired_out,
+            "proposal": proposal_out,
+            "desired_total_satisfaction": round(desired_total, 1),
+            "proposal_total_satisfaction": round(proposal_total, 1),
+            "user": user,
+            "user_type": user_type,
+            "persuasive_text": persuasive_text
+        })
+        sp.set(bytes=response.calculate_content_length())
+    return response
 
-    desired_total = _apply_scores(desired, user_type)
-    proposal_total = _apply_scores(proposal, user_type)
+# ---------- 比較ビューの段階的レスポンス（NDJSON） ----------
+# 1行1イベント。左の地図（希望案）を先に描けるよう、計算の軽い順に送る
+#   header   … user, user_type
+#   desired  … 希望案
+#   proposal … 提案案
+#   summary  … 満足度合計・説得文
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+def _ndjson(event: str, **payload) -> str:
+    return json.dumps(dict(payload, event=event), ensure_ascii=False) + "\n"
+
+def _compare_geo_events(user: str, lang: str):
+    with trace_span("load"):
+        user_type = resolve_user_type(user, load_user_types())
+    trace_attributes(user=user, user_type=user_type)
+    yield _ndjson("header", user=user, user_type=user_type)
+
+    totals = {}
+    for kind in ("desired", "proposal"):
+        out, totals[kind] = _compare_plan(user, user_type, kind, lang)
+        yield _ndjson(kind, plan=out)
+
+    texts = load_persuasive_texts(PERSUASIVE_TEXT_EN_JSON if lang == "en" else PERSUASIVE_TEXT_JSON)
+    yield _ndjson("summary",
+                  desired_total_satisfaction=round(totals["desired"], 1),
+                  proposal_total_satisfaction=round(totals["proposal"], 1),
+                  persuasive_text=texts.get(user, ""))
+
+def _traced_stream(events):
+    """
+    本体はリクエスト終了（teardown）後に送られるため、
+    ストリーム中のスパンはルートスパンの子として送信完了時に書き出す
+    """
+    root = _CURRENT_SPAN.get()
+
+    def run():
+        _CURRENT_SPAN.set(root)
+        try:
+            with trace_span("stream"):
+                yield from events
+        finally:
+            _CURRENT_SPAN.set(None)
+            if TRACE_ENABLED:
+                _export_spans(g.pop("trace_spans", []))
+    return stream_with_context(run())
+
+def _compare_geo_stream(lang: str):
+    user = request.args.get("user", "User_1").strip()
+    if not (POI_CSV.exists() and DESIRED_CSV.exists() and PROPOSAL_CSV.exists()):
+        msg = "CSV files not found" if lang == "en" else "CSVが見つかりません"
+        return jsonify({"error": msg}), 404
+    return Response(_traced_stream(_compare_geo_events(user, lang)), mimetype=NDJSON_MIMETYPE,
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/api/compare_geo/stream")
+def api_compare_geo_stream():
+    """/api/compare_geo と同じ内容を NDJSON で段階的に返す"""
+    return _compare_geo_stream("ja")
+
+@app.route("/api/compare_geo_en/stream")
+def api_compare_geo_en_stream():
+    """/api/compare_geo_en と同じ内容を NDJSON で段階的に返す"""
+    return _compare_geo_stream("en")
+
+# ---------- 採点済みプランの一括出力（NDJSON、必要なら gzip） ----------
+# (解, ユーザー) ごとに読み進めて採点し、1スロット1行で書き出す。
+# CSVはチャンク単位で読むため、メモリ使用量はデータ規模によらずほぼ一定
+EXPORT_CHUNK_ROWS = 50_000
+EXPORT_FLUSH_BYTES = 1 << 16
+
+def iter_scored_plans(path: Path = SOLUTIONS_CSV, solution=None, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """
+    optimal_solutions.csv の全 (解, ユーザー, スロット) を採点して辞書で返すジェネレータ
+    同じ (解, ユーザー) の行は連続している前提（離れている場合は別のプランとして扱う）
+    """
+    _, name_map = _load_poi_master_for_geo()
+    user_types = with_inferred_types(load_user_types(), inferred_user_types())
+    poi_prefs = load_poi_preferences()
+    transport_prefs = load_transport_preferences()
+
+    def score(key, rows):
+        sol, user = key
+        user_type = user_types.get(user, "Type A")   # resolve_user_type と同じ順（推定済みを合成）
+        plan = [PlanSlot(_SLOT_LABELS.id(s), _POI_NAMES.id(n), name_map.get(n), _MODES.id(m))
+                for s, n, m in rows]
+        total = round(_score_plan(plan, user_type, poi_prefs, transport_prefs), 3)
+        for s, (_, name, mode) in zip(plan, rows):
+            yield {
+                "solution": sol,
+                "user": user,
+                "user_type": user_type,
+                "slot": _SLOT_LABELS[s.slot],
+                "poi": name,
+                "poi_id": s.poi_id,
+                "transport": mode,
+                "congestion": s.congestion,
+                "satisfaction": None if s.satisfaction is None else round(s.satisfaction, 3),
+                "level": s.level,
+                "total_satisfaction": total,
+            }
+
+    key, rows = None, []
+    for chunk in pd.read_csv(path, encoding="utf-8-sig", dtype=str, chunksize=chunk_rows,
+                             usecols=["Solution", "User", "Slot", "POI", "Transport"]):
+        chunk = chunk.fillna("")
+        if solution:
+            chunk = chunk[chunk["Solution"] == solution]
+        for sol, user, slot, name, mode in zip(
+                chunk["Solution"].str.strip().tolist(), chunk["User"].str.strip().tolist(),
+                chunk["Slot"].str.strip().str.lower().tolist(), chunk["POI"].str.strip().tolist(),
+                chunk["Transport"].str.strip().str.lower().tolist()):
+            if (sol, user) != key:
+                if rows:
+                    yield from score(key, rows)
+                key, rows = (sol, user), []
+            rows.append((slot, name, mode))
+    if rows:
+        yield from score(key, rows)
+
+def iter_ndjson_bytes(records, compress: bool = False, level: int = 6):
+    """辞書 → NDJSON のバイト列（EXPORT_FLUSH_BYTES ごと）。compress=True なら gzip で逐次圧縮"""
+    z = zlib.compressobj(level, zlib.DEFLATED, 31) if compress else None
+    buf, size = [], 0
+    for rec in records:
+        line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+        buf.append(line)
+        size += len(line)
+        if size >= EXPORT_FLUSH_BYTES:
+            data = b"".join(buf)
+            buf, size = [], 0
+            data = z.compress(data) if z else data
+            if data:
+                yield data
+    data = b"".join(buf)
+    if z:
+        data = z.compress(data) + z.flush()
+    if data:
+        yield data
+
+@app.route("/api/export/plans.ndjson")
+def api_export_plans():
+    """
+    全ユーザー・全解の採点済みスロットを NDJSON で逐次出力
+      solution=Solution_1 … 解で絞込み
+      gzip=1              … gzip 圧縮して返す（省略時は Accept-Encoding に従う）
+    """
+    if not SOLUTIONS_CSV.exists():
+        return jsonify({"error": "CSVが見つかりません"}), 404
+    solution = request.args.get("solution", "").strip() or None
+    flag = request.args.get("gzip", "").strip()
+    compress = flag == "1" if flag else "gzip" in request.headers.get("Accept-Encoding", "")
+    headers = {"Content-Disposition": "attachment; filename=scored_plans.ndjson" + (".gz" if compress else "")}
+    if compress and not flag:
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    body = iter_ndjson_bytes(iter_scored_plans(SOLUTIONS_CSV, solution), compress)
+    mimetype = "application/gzip" if compress and flag else NDJSON_MIMETYPE
+    return Response(body, mimetype=mimetype, headers=headers)
+
+# ---------- ルート形状キャッシュ（OSRM への問合せをサーバー側でまとめる） ----------
+# 端点は登録済みPOIの座標に限る。メモリは件数上限つきの LRU、ディスクは容量上限を超えたら
+# 古いファイルから消す。OSRM が応答しない（タイムアウト等）ときは OSRM_BACKOFF 秒間
+# 問い合わせずに直線を返す
+OSRM_URL = os.environ.get("WEBAPP_OSRM_URL", "https://router.project-osrm.org").rstrip("/")
+OSRM_TIMEOUT = float(os.environ.get("WEBAPP_OSRM_TIMEOUT_S", "2"))
+OSRM_BACKOFF = float(os.environ.get("WEBAPP_OSRM_BACKOFF_S", "60"))
+ROUTE_CACHE_DIR = Path(os.environ.get("WEBAPP_ROUTE_CACHE_DIR", BASE_P / ".route_cache"))
+ROUTE_CACHE_MAX = int(os.environ.get("WEBAPP_ROUTE_CACHE_MAX", "20000"))
+ROUTE_CACHE_DISK_MAX = int(float(os.environ.get("WEBAPP_ROUTE_CACHE_DISK_MB", "200")) * 1024 * 1024)
+ROUTE_PROFILES = ("foot", "bike", "car")
+_ROUTE_CACHE = collections.OrderedDict()   # key -> ルート形状
+_ROUTE_CACHE_LOCK = threading.Lock()
+_ROUTE_DISK_BYTES = None                   # ディスクキャッシュの使用量（このプロセスでの概算）
+_ROUTE_POINTS_CACHE = {}
+_ROUTE_FLIGHT = SingleFlight()
+_OSRM_RETRY_AT = 0.0                       # この時刻（time.monotonic）までは OSRM に問い合わせない
+
+def route_profile(mode: str):
+    """交通手段 → OSRM プロファイル（compare_map.html の modeToStyle と同じ判定、滞在は None）"""
+    m = str(mode or "").lower()
+    if "walk" in m or "徒歩" in m:
+        return "foot"
+    if "bike" in m or "自転車" in m or "レンタ" in m:
+        return "bike"
+    if "bus" in m or "バス" in m or "taxi" in m or "タク" in m or "car" in m or "車" in m:
+        return "car"
+    if "stay" in m:
+        return None
+    return "foot"
+
+def _route_key(profile: str, a, b) -> str:
+    return f"{profile}:{a[0]:.6f},{a[1]:.6f};{b[0]:.6f},{b[1]:.6f}"
+
+def get_route(profile: str, a, b) -> dict:
+    """
+    2点間のルート形状 {"coordinates": [[lat, lng], ...], "fallback": bool}
+    メモリ → ディスク（ワーカー間で共有）→ OSRM の順に引く。取得失敗時は直線（保存しない）
+    """
+    key = _route_key(profile, a, b)
+    with _ROUTE_CACHE_LOCK:
+        route = _ROUTE_CACHE.get(key)
+        if route is not None:
+            _ROUTE_CACHE.move_to_end(key)
+    record_cache("route", route is not None)
+    if route is not None:
+        return route
+
+    def fetch():
+        global _OSRM_RETRY_AT
+        path = ROUTE_CACHE_DIR / f"{hashlib.sha1(key.encode()).hexdigest()}.json"
+        try:
+            route = load_json(path)
+            os.utime(path)        # ディスクの容量整理は更新時刻の古い順
+        except (OSError, ValueError):
+            if time.monotonic() < _OSRM_RETRY_AT:
+                return {"coordinates": [list(a), list(b)], "fallback": True}
+            url = (f"{OSRM_URL}/route/v1/{profile}/{a[1]:.6f},{a[0]:.6f};{b[1]:.6f},{b[0]:.6f}"
+                   "?overview=full&geometries=geojson")
+            try:
+                with trace_span("route.fetch", profile=profile), \
+                        urllib.request.urlopen(url, timeout=OSRM_TIMEOUT) as r:
+                    body = json.load(r)
+                coords = body["routes"][0]["geometry"]["coordinates"]
+            except (OSError, ValueError, KeyError, IndexError) as e:
+                # 経路が無い（4xx）以外の失敗は OSRM が使えないとみなし、しばらく問い合わせない
+                if isinstance(e, OSError) and not (isinstance(e, urllib.error.HTTPError) and e.code < 500):
+                    _OSRM_RETRY_AT = time.monotonic() + OSRM_BACKOFF
+                    app.logger.warning("OSRM unavailable (%s); using straight lines for %.0fs", e, OSRM_BACKOFF)
+                return {"coordinates": [list(a), list(b)], "fallback": True}
+            route = {"coordinates": [[lat, lng] for lng, lat in coords], "fallback": False}
+            _write_route_file(path, route)
+        with _ROUTE_CACHE_LOCK:
+            _ROUTE_CACHE[key] = route
+            while len(_ROUTE_CACHE) > ROUTE_CACHE_MAX:
+                _ROUTE_CACHE.popitem(last=False)
+        return route
+    return _ROUTE_FLIGHT.do(key, fetch)[0]
+
+def _write_route_file(path: Path, route: dict):
+    """ディスクキャッシュに書き、容量が ROUTE_CACHE_DISK_MAX を超えたら古いファイルから消す"""
+    global _ROUTE_DISK_BYTES
+    ROUTE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    data = json.dumps(route).encode("utf-8")
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+    with _ROUTE_CACHE_LOCK:
+        if _ROUTE_DISK_BYTES is not None:
+            _ROUTE_DISK_BYTES += len(data)
+            if _ROUTE_DISK_BYTES <= ROUTE_CACHE_DISK_MAX:
+                return
+        _ROUTE_DISK_BYTES = _prune_route_files(ROUTE_CACHE_DISK_MAX)
+
+def _prune_route_files(limit: int) -> int:
+    """ディスクキャッシュを limit バイトの9割まで減らし、残りの容量を返す（他のワーカーの分も数える）"""
+    files = []
+    for p in ROUTE_CACHE_DIR.glob("*.json"):
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        files.append((st.st_mtime, st.st_size, p))
+    total = sum(size for _, size, _ in files)
+    if total <= limit:
+        return total
+    for _, size, p in sorted(files, key=lambda f: f[0]):
+        if total <= limit * 0.9:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            p.unlink()
+        total -= size
+    return total
+
+def plan_legs(plan: list) -> list:
+    """
+    描画済みプラン（/api/compare_geo の desired/proposal）→ 地図に引く区間 [(プロファイル, 始点, 終点)]
+    compare_map.html の drawPlan と同じ順序・同じ交通手段の決め方
+    """
+    def coord(p):
+        return (p["lat"], p["lng"]) if p.get("lat") and p.get("lng") else None
+
+    legs = []
+    start = next((i for i, p in enumerate(plan) if p["slot"] == "start"), None)
+    ret = next((i for i, p in enumerate(plan) if p["slot"] == "return"), None)
+    stops = [i for i, p in enumerate(plan) if p["slot"] not in ("start", "return") and coord(p)]
+    if start is not None and coord(plan[start]) and stops:
+        first = stops[0]
+        mode = next((p["mode"] for p in plan[start + 1:first] if p.get("mode")), "walk")
+        legs.append((route_profile(mode), coord(plan[start]), coord(plan[first])))
+    last, carry = None, None
+    for p in plan:
+        if p["slot"] in ("start", "return"):
+            continue
+        if not coord(p):
+            carry = p.get("mode") or carry
+            continue
+        if last is None:
+            last, carry = p, p.get("mode") or carry
+            continue
+        mode = carry or p.get("mode") or last.get("mode") or "walk"
+        legs.append((route_profile(mode), coord(last), coord(p)))
+        last, carry = p, None
+    if ret is not None and coord(plan[ret]) and last is not None:
+        i_last = plan.index(last)
+        mode = next((p["mode"] for p in reversed(plan[i_last + 1:ret]) if p.get("mode")), "walk")
+        legs.append((route_profile(mode), coord(last), coord(plan[ret])))
+    return legs
+
+def _parse_point(text: str):
+    point = _parse_floats(text, 2)
+    if point is None or not (-90 <= point[0] <= 90 and -180 <= point[1] <= 180):
+        return None
+    return tuple(point)
+
+def _point_key(lat: float, lng: float) -> tuple:
+    return (round(lat, 6), round(lng, 6))
+
+def _route_points() -> dict:
+    """ルートの端点に使える地点: 丸めた座標 → 登録済みPOIの座標（描画済みプランの lat/lng と同じ値）"""
+    sig = _source_signature(POI_CSV)
+    points = _ROUTE_POINTS_CACHE.get(sig)
+    if points is None:
+        poi_master, _ = _load_poi_master_for_geo()
+        points = {_point_key(info["lat"], info["lng"]): (info["lat"], info["lng"])
+                  for info in poi_master.values() if info.get("lat") and info.get("lng")}
+        _ROUTE_POINTS_CACHE.clear()
+        _ROUTE_POINTS_CACHE[sig] = points
+    return points
+
+@app.route("/api/route")
+def api_route():
+    """profile=foot|bike|car, from=lat,lng, to=lat,lng → ルート形状"""
+    profile = request.args.get("profile", "").strip()
+    if profile not in ROUTE_PROFILES:
+        return jsonify({"error": f"profile は {list(ROUTE_PROFILES)} のいずれかを指定してください"}), 400
+    a, b = _parse_point(request.args.get("from", "")), _parse_point(request.args.get("to", ""))
+    if a is None or b is None:
+        return jsonify({"error": "from, to には lat,lng を指定してください"}), 400
+    # 任意の座標で OSRM・キャッシュを使われないよう、プランに出てくるPOIの座標だけ受け付ける
+    points = _route_points()
+    a, b = points.get(_point_key(*a)), points.get(_point_key(*b))
+    if a is None or b is None:
+        return jsonify({"error": "from, to には登録済みPOIの座標を指定してください"}), 400
+    return jsonify(get_route(profile, a, b))
+
+# ---------- キャッシュの事前計算（起動時・元データ変更時） ----------
+# 全ユーザーの /api/compare_geo・/api/compare_geo_en の応答、NDJSON 版（/stream）が使う
+# 案ごとの計算結果、その区間のルート形状を
+# スレッドプールで先に作っておく（WEBAPP_WARM=1 で起動時に開始、以降は変更を監視）
+WARM_ON_START = os.environ.get("WEBAPP_WARM", "") == "1"
+WARM_WORKERS = int(os.environ.get("WEBAPP_WARM_WORKERS", "4"))
+WARM_POLL_INTERVAL = float(os.environ.get("WEBAPP_WARM_POLL_S", "5"))
+WARM_ROUTES = os.environ.get("WEBAPP_WARM_ROUTES", "1") == "1"
+_WARM_STATUS = {"state": "idle"}
+_WARM_LOCK = threading.Lock()
+_WARM_THREAD = None
+
+def _warm_users() -> list:
+    users = set(load_user_types())
+    for path in (DESIRED_CSV, PROPOSAL_CSV):
+        if path.exists():
+            users.update(pd.read_csv(path, encoding="utf-8-sig", usecols=["User"], dtype=str)["User"].dropna().str.strip())
+    return sorted(users, key=lambda u: (len(u), u))
+
+def _warm_user(user: str) -> set:
+    """1ユーザー分の比較応答（JSON 版・NDJSON 版）を作り、その区間（プロファイル付き）を返す"""
+    legs = set()
+    for view, path, lang in ((api_compare_geo, "/api/compare_geo", "ja"),
+                             (api_compare_geo_en, "/api/compare_geo_en", "en")):
+        with app.test_request_context(path, query_string={"user": user}):
+            response = app.make_response(view())
+        if response.status_code != 200:
+            continue
+        # JSON 版が応答キャッシュに当たった場合も、NDJSON 版の案ごとの計算はここで埋める
+        with app.test_request_context(f"{path}/stream", query_string={"user": user}):
+            events = [json.loads(line) for line in _compare_geo_events(user, lang)]
+        for e in events:
+            if e["event"] in ("desired", "proposal"):
+                legs.update(leg for leg in plan_legs(e["plan"]) if leg[0] is not None)
+    return legs
+
+def _warmup_call(fn, *args):
+    """事前計算としての呼び出し（スレッドプールの各スレッドで _WARMING を立てる）"""
+    token = _WARMING.set(True)
+    try:
+        return fn(*args)
+    finally:
+        _WARMING.reset(token)
+
+def warm_caches(workers: int = WARM_WORKERS, routes: bool = WARM_ROUTES) -> dict:
+    """全ユーザー分を事前計算し、進捗を _WARM_STATUS に書き込む。最終状態を返す"""
+    return _warmup_call(_warm_caches, workers, routes)
+
+def _warm_caches(workers: int, routes: bool) -> dict:
+    t0 = time.perf_counter()
+    users = _warm_users()
+    status = {"state": "running", "users": len(users),
+              "users_done": 0, "routes": 0, "routes_done": 0, "routes_fallback": 0, "errors": 0,
+              "started": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    _WARM_STATUS.clear()
+    _WARM_STATUS.update(status)
+
+    legs = set()
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for future in as_completed([ex.submit(_warmup_call, _warm_user, u) for u in users]):
+            try:
+                legs |= future.result()
+            except Exception as e:
+                _WARM_STATUS["errors"] += 1
+                app.logger.warning("cache warm failed: %s", e)
+            _WARM_STATUS["users_done"] += 1
+        if routes:
+            _WARM_STATUS["routes"] = len(legs)
+            for future in as_completed([ex.submit(_warmup_call, get_route, *leg) for leg in legs]):
+                try:
+                    _WARM_STATUS["routes_fallback"] += future.result()["fallback"]
+                except Exception:
+                    _WARM_STATUS["errors"] += 1
+                _WARM_STATUS["routes_done"] += 1
+
+    _WARM_STATUS.update(state="done", duration_s=round(time.perf_counter() - t0, 3),
+                        finished=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    app.logger.info("cache warm: %d users, %d routes in %.1fs",
+                    _WARM_STATUS["users"], _WARM_STATUS["routes"], _WARM_STATUS["duration_s"])
+    return dict(_WARM_STATUS)
+
+def _warm_loop():
+    """元データが変わるたびに事前計算をやり直す"""
+    done = None
+    while True:
+        sig = _compare_signature()
+        if sig != done:
+            try:
+                warm_caches()
+            except Exception as e:
+                _WARM_STATUS.update(state="failed", error=str(e))
+            done = sig
+        time.sleep(WARM_POLL_INTERVAL)
+
+def start_cache_warmer():
+    """事前計算スレッドを起動（プロセスにつき1つ）"""
+    global _WARM_THREAD
+    with _WARM_LOCK:
+        if _WARM_THREAD is None or not _WARM_THREAD.is_alive():
+            _WARM_THREAD = threading.Thread(target=_warm_loop, name="cache-warmer", daemon=True)
+            _WARM_THREAD.start()
+
+@app.route("/debug/warm", methods=["GET", "POST"])
+@debug_only
+def debug_warm():
+    """GET: 進捗、POST: 事前計算スレッドを起動（起動済みなら何もしない）"""
+    if request.method == "POST":
+        start_cache_warmer()
+    return jsonify(dict(_WARM_STATUS, thread_alive=_WARM_THREAD is not None and _WARM_THREAD.is_alive()))
 
-    return jsonify({
-        "desired": desired,
-        "proposal": proposal,
-        "desired_total_satisfaction": round(desired_total, 1),
-        "proposal_total_satisfaction": round(proposal_total, 1),
-        "user": user,
-        "user_type": user_type,
-        "persuasive_text": persuasive_text
-    })
 def export_satisfaction_congestion_data(output_filename='data/satisfaction_congestion_example.csv'):
     """
     各ユーザーの希望案と提案案の満足度・混雑度データをCSVに出力（起動時に1回のみ）
@@ -622,7 +2422,7 @@ def export_satisfaction_congestion_data(output_filename='data/satisfaction_conge
     users = ["User_1", "User_2", "User_3"]
     
     for user in users:
-        user_type = user_types.get(user, "Type A")
+        user_type = resolve_user_type(user, user_types)
         
         # 希望案の処理
         desired = _read_plan_csv(DESIRED_CSV, poi_master, name_map, user)
@@ -684,22 +2484,9 @@ def _calculate_route_satisfaction(plan, user_type, poi_prefs, transport_prefs):
     }
     
     def _congestion_penalty(slot):
-        if slot in ["start", "return"]:
-            return 0
-        match = re.search(r"\d+", slot)
-        if not match:
+        if slot in ["start", "return"] or not re.search(r"\d+", slot):
             return 0
-        slot_num = int(match.group())
-        hour = 8 + slot_num
-        
-        if 10 <= hour <= 15:
-            congestion = 65
-        elif 8 <= hour < 10 or 15 < hour <= 18:
-            congestion = 45
-        else:
-            congestion = 25
-        
-        return (congestion - 50) / 100 * 3
+        return (_congestion_base(slot) - 50) / 100 * 3
     
     total_sat = 0
     for p in plan:
@@ -730,21 +2517,6 @@ def _calculate_route_satisfaction(plan, user_type, poi_prefs, transport_prefs):
 
 def _calculate_route_congestion(plan):
     """ルート全体の混雑度を計算"""
-    def _congestion_base(slot):
-        if slot in ["start", "return"]:
-            return 0
-        match = re.search(r"\d+", slot)
-        if not match:
-            return 25
-        slot_num = int(match.group())
-        hour = 8 + slot_num
-        
-        if 10 <= hour <= 15:
-            return 65
-        if 8 <= hour < 10 or 15 < hour <= 18:
-            return 45
-        return 25
-    
     total_cong = 0
     for p in plan:
         if p["slot"] not in ["start", "return"]:
@@ -753,7 +2525,1047 @@ def _calculate_route_congestion(plan):
     return total_cong
 
 
+# ---------- 混雑均衡割当（計画訪問数を混雑度へフィードバック） ----------
+def _slot_order_key(slot: str) -> int:
+    """start → 先頭, return → 末尾, slotN → N"""
+    if slot == "start":
+        return -1
+    if slot == "return":
+        return 10**6
+    match = re.search(r"\d+", slot)
+    return int(match.group()) if match else 10**6 - 1
+
+def _congestion_base_array(slots) -> np.ndarray:
+    """_congestion_base のベクトル版（slot列 → 混雑度）"""
+    return np.array([_congestion_base(slot) for slot in slots], dtype=np.float64)
+
+def _build_pref_matrices(poi_prefs: dict, transport_prefs: dict):
+    """
+    嗜好辞書 → 行列
+    poi_mat[type, poi_id], trans_mat[type, mode]（未定義はNaN）
+    """
+    types = sorted(set(poi_prefs) | set(transport_prefs))
+    max_id = max((pid for col in poi_prefs.values() for pid in col), default=0)
+    modes = sorted({m for col in transport_prefs.values() for m in col})
+    poi_mat = np.full((len(types), max_id + 1), np.nan)
+    trans_mat = np.full((len(types), len(modes)), np.nan)
+    for ti, t in enumerate(types):
+        for pid, v in poi_prefs.get(t, {}).items():
+            poi_mat[ti, pid] = v
+        for mi, m in enumerate(modes):
+            if m in transport_prefs.get(t, {}):
+                trans_mat[ti, mi] = transport_prefs[t][m]
+    return types, modes, poi_mat, trans_mat
+
+SOLUTION_COLUMNS = ["Solution", "User", "Slot", "POI", "Transport"]
+
+def _read_solutions_csv(path: Path) -> pd.DataFrame:
+    """複数解CSVを読み、Slot/POI/Transport を正規化（空ファイル・ヘッダのみは0行）"""
+    try:
+        df = pd.read_csv(path, encoding="utf-8-sig", dtype=str).fillna("")
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame(columns=SOLUTION_COLUMNS, dtype=str)
+    df["Slot"] = df["Slot"].str.strip().str.lower()
+    df["POI"] = df["POI"].str.strip()
+    df["Transport"] = df["Transport"].str.strip()
+    return df
+
+def _load_solution_tensors(path: Path, name_map: dict, user_types: dict,
+                           poi_prefs: dict, transport_prefs: dict):
+    """
+    複数解CSV（Solution, User, Slot, POI, Transport）→ (ユーザー, 解, スロット) テンソル
+    start/return は満足度・混雑度の対象外なので除外する
+    user_types は推定タイプを合成済みのもの（with_inferred_types）、それでもないユーザーは "Type A"
+    """
+    df = _read_solutions_csv(path)
+    rows = df[~df["Slot"].isin(["start", "return"])]
+
+    u_codes, users = pd.factorize(rows["User"])
+    s_codes, solutions = pd.factorize(rows["Solution"])
+    slots = sorted(rows["Slot"].unique(), key=_slot_order_key)
+    t_codes = rows["Slot"].map({s: i for i, s in enumerate(slots)}).to_numpy(dtype=int)
+    U, S, T = len(users), len(solutions), len(slots)
+
+    types, modes, poi_mat, trans_mat = _build_pref_matrices(poi_prefs, transport_prefs)
+    type_index = {t: i for i, t in enumerate(types)}
+    user_type_idx = np.array([type_index.get(user_types.get(u, "Type A"), -1) for u in users], dtype=int)
+    row_type = user_type_idx[u_codes]
+
+    is_move = rows["POI"].str.lower().isin(["move", "移動"]).to_numpy()
+    lookup = {n: name_map.get(n) for n in rows["POI"].unique()}
+    poi_id = np.array(rows["POI"].map(lookup).fillna(-1).astype(int))
+    poi_id[is_move] = -1
+    mode_index = {m: i for i, m in enumerate(modes)}
+    mode_idx = np.array(rows["Transport"].str.lower()
+                        .map(lambda t: mode_index.get(TRANSPORT_NORMALIZE.get(t, "Walking"), -1)), dtype=int)
+
+    # 基準満足度（混雑ペナルティ前）とペナルティ適用有無
+    base = np.where(is_move, 5.0, 3.0)
+    penalized = np.zeros(len(rows), dtype=bool)
+    ok = (~is_move) & (poi_id >= 0) & (poi_id < poi_mat.shape[1]) & (row_type >= 0)
+    vals = np.full(len(rows), np.nan)
+    vals[ok] = poi_mat[row_type[ok], poi_id[ok]]
+    ok &= ~np.isnan(vals)
+    base[ok], penalized[ok] = vals[ok], True
+    ok = is_move & (mode_idx >= 0) & (row_type >= 0)
+    vals = np.full(len(rows), np.nan)
+    vals[ok] = trans_mat[row_type[ok], mode_idx[ok]]
+    ok &= ~np.isnan(vals)
+    base[ok], penalized[ok] = vals[ok], True
+
+    t_poi = np.full((U, S, T), -1, dtype=np.int32)
+    t_base = np.zeros((U, S, T))
+    t_pen = np.zeros((U, S, T), dtype=bool)
+    t_valid = np.zeros((U, S, T), dtype=bool)
+    t_mode = np.full((U, S, T), -1, dtype=np.int16)
+    t_poi[u_codes, s_codes, t_codes] = np.where(poi_id >= 0, poi_id, -1)
+    t_mode[u_codes, s_codes, t_codes] = np.where(is_move, mode_idx, -1)
+    t_base[u_codes, s_codes, t_codes] = base
+    t_pen[u_codes, s_codes, t_codes] = penalized
+    t_valid[u_codes, s_codes, t_codes] = True
+
+    return {
+        "users": list(users),
+        "solutions": list(solutions),
+        "slots": slots,
+        "poi": t_poi,
+        "mode": t_mode,          # 移動スロットの交通手段（_build_pref_matrices の modes の添字、滞在は -1）
+        "base": t_base,
+        "penalized": t_pen,
+        "valid": t_valid,
+        "available": t_valid.any(axis=2),
+        "slot_congestion": _congestion_base_array(slots),
+        "n_poi": max(poi_mat.shape[1], int(t_poi.max(initial=-1)) + 1),
+    }
+
+def _occupancy(tensors: dict, choice: np.ndarray) -> np.ndarray:
+    """現在の割当から (POI, スロット) ごとの計画訪問者数を集計"""
+    U = len(choice)
+    T = len(tensors["slots"])
+    poi = tensors["poi"][np.arange(U), choice]              # (U, T)
+    t_idx = np.broadcast_to(np.arange(T), poi.shape)
+    hit = poi >= 0
+    flat = poi[hit].astype(np.int64) * T + t_idx[hit]
+    return np.bincount(flat, minlength=tensors["n_poi"] * T).reshape(tensors["n_poi"], T)
+
+def _crowd_congestion(tensors: dict, occ: np.ndarray, choice: np.ndarray, capacity: float) -> np.ndarray:
+    """
+    全ユーザー×全解×スロットの混雑度 (U, S, T)
+    時間帯ベース + 自分以外の計画訪問者数（+自分）による上乗せ（上限100）
+    """
+    poi = tensors["poi"]
+    U, _, T = poi.shape
+    own = poi[np.arange(U), choice][:, None, :]              # 現在の自分の訪問先
+    visitors = occ[np.maximum(poi, 0), np.arange(T)] + 1 - ((poi == own) & (poi >= 0))
+    slot_cong = tensors["slot_congestion"]
+    return np.where(poi >= 0, np.minimum(100.0, slot_cong + 100.0 * visitors / capacity), slot_cong)
+
+def _score_candidates(tensors: dict, occ: np.ndarray, choice: np.ndarray, capacity: float) -> np.ndarray:
+    """
+    全ユーザー×全解の総満足度 (U, S)。存在しない解は -inf（混雑度は _crowd_congestion）
+    """
+    cong = _crowd_congestion(tensors, occ, choice, capacity)
+    penalty = (cong - 50) / 100 * 3
+    sat = np.where(tensors["penalized"], np.maximum(0, tensors["base"] - penalty), tensors["base"])
+    totals = np.where(tensors["valid"], sat, 0.0).sum(axis=2)
+    return np.where(tensors["available"], totals, -np.inf)
+
+def _initial_choice(tensors: dict) -> np.ndarray:
+    """初期割当: Solution_1（なければ最初に存在する解）"""
+    if tensors["available"].shape[1] == 0:
+        return np.zeros(len(tensors["users"]), dtype=int)
+    choice = tensors["available"].argmax(axis=1)
+    if "Solution_1" in tensors["solutions"]:
+        s1 = tensors["solutions"].index("Solution_1")
+        choice = np.where(tensors["available"][:, s1], s1, choice)
+    return choice
+
+def run_crowd_equilibrium(path: Path = SOLUTIONS_CSV, capacity: float = 20.0,
+                          batch_frac: float = 0.25, max_iter: int = 200, tol: float = 0.01,
+                          seed: int = 0):
+    """
+    混雑均衡モード
+    現在の割当から訪問者数を集計 → POI別混雑度を更新 → 改善できるユーザーのうち
+    batch_frac 分を無作為に選んで一括で最良解へ切替、を切替がなくなるまで繰り返す
+    （切替数が減らなくなったらバッチを縮小して振動を抑える）
+    """
+    if Path(path) == SOLUTIONS_CSV:
+        tensors = get_solution_tensors()
+    else:
+        _, name_map = _load_poi_master_for_geo()
+        tensors = _load_solution_tensors(path, name_map, with_inferred_types(load_user_types(), inferred_user_types()),
+                                         load_poi_preferences(), load_transport_preferences())
+    U = len(tensors["users"])
+    users_idx = np.arange(U)
+
+    choice = _initial_choice(tensors)
+    initial = choice.copy()
+    initial_peak = int(_occupancy(tensors, initial).max()) if U else 0
+
+    history = []
+    converged = False
+    step = batch_frac
+    rng = np.random.default_rng(seed)
+    for _ in range(max_iter if U and len(tensors["solutions"]) else 0):
+        occ = _occupancy(tensors, choice)
+        totals = _score_candidates(tensors, occ, choice, capacity)
+        best = totals.argmax(axis=1)
+        gain = totals[users_idx, best] - totals[users_idx, choice]
+        movers = np.flatnonzero(gain > tol)
+        history.append(int(len(movers)))
+        if len(movers) == 0:
+            converged = True
+            break
+        # 切替数が減らない＝振動しているので、バッチを半分に絞る
+        if len(history) > 1 and history[-1] >= history[-2]:
+            step = max(step / 2, 0.01)
+        else:
+            step = min(step * 1.5, batch_frac)
+        k = max(1, int(np.ceil(step * len(movers))))
+        batch = rng.choice(movers, size=k, replace=False)
+        choice[batch] = best[batch]
+
+    occ = _occupancy(tensors, choice)
+    totals = _score_candidates(tensors, occ, choice, capacity)
+    return {
+        "path": Path(path),
+        "tensors": tensors,
+        "choice": choice,
+        "assignments": {
+            u: tensors["solutions"][choice[i]] for i, u in enumerate(tensors["users"])
+        },
+        "satisfaction": {
+            u: round(float(totals[i, choice[i]]), 2) for i, u in enumerate(tensors["users"])
+        },
+        "iterations": len(history),
+        "switches": history,
+        "converged": converged,
+        "changed_users": int((choice != initial).sum()),
+        "peak_occupancy_before": initial_peak,
+        "peak_occupancy_after": int(occ.max()) if U else 0,
+    }
+
+def write_equilibrium_csv(result: dict, output_path: Path):
+    """均衡割当の解を提案CSV（Solution, User, Slot, POI, Transport）として書き出し"""
+    df = _read_solutions_csv(result["path"])
+    keep = df["Solution"] == df["User"].map(result["assignments"])
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    df[keep].to_csv(output_path, index=False, encoding="utf-8")
+    return int(keep.sum())
+
+@app.route("/api/equilibrium")
+@coalesced
+def api_equilibrium():
+    if not (POI_CSV.exists() and SOLUTIONS_CSV.exists()):
+        return jsonify({"error": "CSVが見つかりません"}), 404
+    try:
+        capacity = float(request.args.get("capacity", 20))
+    except ValueError:
+        return jsonify({"error": "capacity には数値を指定してください"}), 400
+    if not (math.isfinite(capacity) and capacity > 0):     # nan・inf は float() を通ってしまう
+        return jsonify({"error": "capacity は正の有限値を指定してください"}), 400
+
+    result = run_crowd_equilibrium(capacity=capacity)
+    return jsonify({
+        "assignments": result["assignments"],
+        "satisfaction": result["satisfaction"],
+        "iterations": result["iterations"],
+        "switches": result["switches"],
+        "converged": result["converged"],
+        "changed_users": result["changed_users"],
+        "peak_occupancy_before": result["peak_occupancy_before"],
+        "peak_occupancy_after": result["peak_occupancy_after"],
+    })
+
+
+# ---------- 複数解の順位付け（/api/plan?k=...） ----------
+# (ユーザー, 解) ごとの目的値（満足度合計・平均混雑度）を先に計算しておき、
+# 要求ごとにスコア順（同点は解の並び順）に並べて上位 k 件を返す（結果もキャッシュ）
+PLAN_RANKS = ("satisfaction", "congestion", "mix")
+PLAN_RANK_CAPACITY = 20.0
+PLAN_TOPK_MAX = 50
+_PLAN_RANK_CACHE = {}
+
+def _plan_mode(transport: str, poi: str) -> str:
+    """交通手段の表記（scripts/csv_to_plans.py の norm_mode と同じ）"""
+    t = str(transport).strip().lower()
+    if t == "stay" or str(poi).strip().lower() != "move":
+        return "stay"
+    if t in ("walking", "walk"):
+        return "walk"
+    if t in ("rental bicycle", "bicycle", "bike", "cycling"):
+        return "bicycle"
+    if t in ("bus", "transit", "public", "public_transit"):
+        return "bus"
+    if t in ("car", "drive", "driving"):
+        return "car"
+    return t or "walk"
+
+def _plan_satisfaction(tensors: dict) -> np.ndarray:
+    """
+    全ユーザー×全解の総満足度 (U, S)。_score_plan と同じく時間帯ペナルティだけを引き（0未満は0）、
+    嗜好値のないスロット（不明なPOI・交通手段）は加算しない
+    """
+    penalty = (tensors["slot_congestion"] - 50) / 100 * 3
+    sat = np.maximum(0.0, tensors["base"] - penalty)
+    return np.where(tensors["valid"] & tensors["penalized"], sat, 0.0).sum(axis=2)
+
+def _build_plan_ranks() -> dict:
+    """
+    目的値ベクトルと、各 (ユーザー, 解) の行範囲を持つコンパクトな行配列
+      satisfaction[u, s] … _score_plan と同じ満足度合計（存在しない解は NaN）
+      congestion[u, s]   … 滞在スロットの平均混雑度（計画訪問者数を反映）
+    """
+    tensors = get_solution_tensors()
+    choice = _initial_choice(tensors)
+    occ = _occupancy(tensors, choice)
+    sat = _plan_satisfaction(tensors)
+    cong = _crowd_congestion(tensors, occ, choice, PLAN_RANK_CAPACITY)
+    stay = tensors["poi"] >= 0
+    n_stay = stay.sum(axis=2)
+    mean_cong = np.where(n_stay > 0, np.where(stay, cong, 0.0).sum(axis=2) / np.maximum(n_stay, 1), 0.0)
+    available = tensors["available"]
+
+    # 行配列（csv_to_plans と同じく slotN の行だけ、(ユーザー, 解, slot番号, 出現順) で並べる）
+    df = pd.read_csv(SOLUTIONS_CSV, encoding="utf-8-sig", dtype=str).fillna("")
+    slot_num = pd.to_numeric(df["Slot"].str.extract(r"(\d+)", expand=False), errors="coerce")
+    keep = slot_num.notna().to_numpy()
+    df, slot_num = df[keep], slot_num[keep].astype(int).to_numpy()
+    user_index = {u: i for i, u in enumerate(tensors["users"])}
+    sol_index = {s: i for i, s in enumerate(tensors["solutions"])}
+    u_idx = df["User"].map(user_index).fillna(-1).astype(int).to_numpy()
+    s_idx = df["Solution"].map(sol_index).fillna(-1).astype(int).to_numpy()
+    modes = [_plan_mode(t, p) for t, p in zip(df["Transport"].tolist(), df["POI"].tolist())]
+    names = df["POI"].str.strip().tolist()
+    order = np.lexsort((np.arange(len(df)), slot_num, s_idx, u_idx))
+    order = order[u_idx[order] >= 0]
+    S = len(tensors["solutions"])
+    group = u_idx[order].astype(np.int64) * S + s_idx[order]
+    bounds = np.searchsorted(group, np.arange(len(tensors["users"]) * S + 1))
+
+    mode_codes, mode_values = pd.factorize(pd.Series(modes).iloc[order])
+    name_codes, name_values = pd.factorize(pd.Series(names).iloc[order])
+    return {
+        "users": {int(m.group()): i for i, u in enumerate(tensors["users"])
+                  if (m := re.search(r"\d+", str(u)))},
+        "solutions": tensors["solutions"],
+        "satisfaction": np.where(available, sat, np.nan),
+        "congestion": np.where(available, mean_cong, np.nan),
+        "bounds": bounds,
+        "slot": slot_num[order].astype(np.int32),
+        "mode": mode_codes.astype(np.int16), "mode_values": list(mode_values),
+        "name": name_codes.astype(np.int32), "name_values": list(name_values),
+    }
+
+def _plan_rank_signature() -> tuple:
+    return _source_signature(SOLUTIONS_CSV, POI_CSV, POI_ALIAS_CSV, USER_TYPE_CSV, DESIRED_CSV, POI_PREF_CSV, TRANSPORT_PREF_CSV)
+
+def get_plan_ranks(sig: tuple = None) -> dict:
+    sig = sig or _plan_rank_signature()
+    ranks = _PLAN_RANK_CACHE.get(sig)
+    record_cache("plan_ranks", ranks is not None)
+    if ranks is None:
+        _PLAN_RANK_CACHE.clear()
+        ranks = _PLAN_RANK_CACHE[sig] = _build_plan_ranks()
+    return ranks
+
+@functools.lru_cache(maxsize=4096)
+def _ranked_solutions(sig: tuple, u: int, rank: str, weight: float, k: int) -> tuple:
+    """
+    ユーザー u の解を rank で並べた上位 k 件 ((解の添字, スコア), ...)
+    mix は満足度・混雑度をユーザー内で 0〜1 に正規化し weight : (1 - weight) で合成
+    """
+    ranks = get_plan_ranks(sig)
+    sat, cong = ranks["satisfaction"][u], ranks["congestion"][u]
+    ok = ~np.isnan(sat)
+    if rank == "satisfaction":
+        score = sat
+    elif rank == "congestion":
+        score = -cong
+    else:
+        def unit(v):
+            lo, hi = np.nanmin(v[ok]), np.nanmax(v[ok])
+            return (v - lo) / (hi - lo) if hi > lo else np.zeros_like(v)
+        score = weight * unit(sat) - (1 - weight) * unit(cong)
+    idx = np.flatnonzero(ok)
+    k = min(k, len(idx))
+    if k == 0:
+        return ()
+    top = idx[np.lexsort((idx, -score[idx]))[:k]]    # 同点は解の添字順（実行ごとに同じ順位）
+    return tuple((int(s), float(score[s])) for s in top)
+
+def _plan_items(ranks: dict, u: int, s: int) -> list:
+    """/api/plan（best.pack）と同じ形式の items"""
+    g = u * len(ranks["solutions"]) + s
+    items = []
+    for i in range(ranks["bounds"][g], ranks["bounds"][g + 1]):
+        mode = ranks["mode_values"][ranks["mode"][i]]
+        slot = int(ranks["slot"][i])
+        item = {"slot": slot, "time": TIMELINE.label(slot), "mode": mode}
+        if mode == "stay":
+            name = ranks["name_values"][ranks["name"][i]]
+            item["poi_name"] = "（未指定）" if name == "" or name.lower() == "move" else name
+        items.append(item)
+    return items
+
+def plan_topk(uid: int, k: int, rank: str = "satisfaction", weight: float = 0.5):
+    """ユーザー番号 uid の上位 k 解（ユーザーがいなければ None）"""
+    sig = _plan_rank_signature()
+    ranks = get_plan_ranks(sig)
+    u = ranks["users"].get(uid)
+    if u is None:
+        return None
+    out = []
+    for s, score in _ranked_solutions(sig, u, rank, round(weight, 3), k):
+        out.append({
+            "solution": ranks["solutions"][s],
+            "score": round(score, 4),
+            "satisfaction": round(float(ranks["satisfaction"][u, s]), 2),
+            "congestion": round(float(ranks["congestion"][u, s]), 2),
+            "items": _plan_items(ranks, u, s),
+        })
+    return out
+
+def _api_plan_topk(uid: int):
+    k = request.args.get("k", "").strip()
+    if not k.isdigit() or not 1 <= int(k) <= PLAN_TOPK_MAX:
+        return jsonify({"error": f"k は 1〜{PLAN_TOPK_MAX} の範囲で指定してください"}), 400
+    rank = request.args.get("rank", "satisfaction").strip()
+    if rank not in PLAN_RANKS:
+        return jsonify({"error": f"rank は {list(PLAN_RANKS)} のいずれかを指定してください"}), 400
+    try:
+        weight = float(request.args.get("weight", 0.5))
+    except ValueError:
+        weight = -1
+    if not 0 <= weight <= 1:
+        return jsonify({"error": "weight は 0〜1 の数値を指定してください"}), 400
+    if not SOLUTIONS_CSV.exists():
+        return jsonify({"error": "CSVが見つかりません"}), 404
+    solutions = plan_topk(uid, int(k), rank, weight)
+    if solutions is None:
+        return jsonify({"error": f"plan not found: user {uid}"}), 404
+    return jsonify({"user": uid, "rank": rank, "weight": weight if rank == "mix" else None,
+                    "solutions": solutions})
+
+# ---------- ユーザータイプ感度（解 × ユーザー × タイプの満足度） ----------
+# 「このユーザーが別のタイプだったら各解の満足度はいくつか」を全組合せで一度に計算する。
+# 嗜好行列を (POI, タイプ)・(交通手段, タイプ) に転置し、スロットのPOI・交通手段で
+# まとめて引いて（gather）時間帯ペナルティを引き、スロット方向に合計する
+SENSITIVITY_CHUNK_USERS = 20_000   # 中間配列 (ユーザー, 解, スロット, タイプ) の大きさを抑える
+_SENSITIVITY_CACHE = {}
+
+def user_type_sensitivity(tensors: dict, poi_prefs: dict, transport_prefs: dict):
+    """
+    (解, ユーザー, タイプ) の満足度合計テンソルとタイプ名の一覧を返す
+    各スロットの値は _score_plan と同じ（嗜好値 - 時間帯ペナルティ、0未満は0、嗜好値のないスロットは加算しない）
+    """
+    types, _, poi_mat, trans_mat = _build_pref_matrices(poi_prefs, transport_prefs)
+    poi_t = np.vstack([poi_mat.T, np.full((1, len(types)), np.nan)])      # 末尾行 = 該当なし
+    trans_t = np.vstack([trans_mat.T, np.full((1, len(types)), np.nan)])
+    penalty = (tensors["slot_congestion"] - 50) / 100 * 3                   # (T,)
+
+    poi, mode, valid = tensors["poi"], tensors["mode"], tensors["valid"]
+    U, S, _ = poi.shape
+    out = np.zeros((S, U, len(types)))
+    for lo in range(0, U, SENSITIVITY_CHUNK_USERS):
+        hi = min(U, lo + SENSITIVITY_CHUNK_USERS)
+        p = np.where((poi[lo:hi] >= 0) & (poi[lo:hi] < poi_mat.shape[1]), poi[lo:hi], len(poi_t) - 1)
+        m = np.where(mode[lo:hi] >= 0, mode[lo:hi], len(trans_t) - 1)
+        pref = np.where((mode[lo:hi] >= 0)[..., None], trans_t[m], poi_t[p])  # (u, S, T, タイプ)
+        sat = np.maximum(0.0, pref - penalty[None, None, :, None])
+        sat = np.where(valid[lo:hi, ..., None] & ~np.isnan(sat), sat, 0.0)
+        out[:, lo:hi] = sat.sum(axis=2).transpose(1, 0, 2)
+    return out, types
+
+def get_user_type_sensitivity() -> dict:
+    """元データが変わるまで感度テンソルを使い回す"""
+    sig = _source_signature(SOLUTIONS_CSV, POI_CSV, POI_ALIAS_CSV, USER_TYPE_CSV, DESIRED_CSV, POI_PREF_CSV, TRANSPORT_PREF_CSV)
+    sens = _SENSITIVITY_CACHE.get(sig)
+    record_cache("type_sensitivity", sens is not None)
+    if sens is None:
+        tensors = get_solution_tensors()
+        values, types = user_type_sensitivity(tensors, load_poi_preferences(), load_transport_preferences())
+        _SENSITIVITY_CACHE.clear()
+        sens = _SENSITIVITY_CACHE[sig] = {
+            "values": values, "types": types,
+            "users": tensors["users"], "solutions": tensors["solutions"],
+            "available": tensors["available"],
+        }
+    return sens
+
+@app.route("/api/type_sensitivity")
+def api_type_sensitivity():
+    """
+    user=User_N     … そのユーザーの 解 × タイプ 満足度（解は solution= で絞込み可）
+    （user 省略時）  … 解 × タイプ ごとの全ユーザー平均
+    """
+    if not SOLUTIONS_CSV.exists():
+        return jsonify({"error": "CSVが見つかりません"}), 404
+    sens = get_user_type_sensitivity()
+    solutions = sens["solutions"]
+    sol = request.args.get("solution", "").strip()
+    if sol and sol not in solutions:
+        return jsonify({"error": f"solution が見つかりません: {sol}"}), 404
+    s_idx = [solutions.index(sol)] if sol else list(range(len(solutions)))
+
+    user = request.args.get("user", "").strip()
+    if not user:
+        avail = sens["available"].T[s_idx]                       # (解, ユーザー)
+        total = np.where(avail[..., None], sens["values"][s_idx], 0.0).sum(axis=1)
+        mean = total / np.maximum(avail.sum(axis=1), 1)[:, None]
+        return jsonify({"types": sens["types"], "solutions": [solutions[i] for i in s_idx],
+                        "mean_satisfaction": np.round(mean, 2).tolist()})
+
+    if user not in sens["users"]:
+        return jsonify({"error": f"user が見つかりません: {user}"}), 404
+    u = sens["users"].index(user)
+    s_idx = [i for i in s_idx if sens["available"][u, i]]
+    return jsonify({
+        "user": user,
+        "user_type": resolve_user_type(user, load_user_types()),
+        "types": sens["types"],
+        "solutions": [solutions[i] for i in s_idx],
+        "satisfaction": np.round(sens["values"][s_idx, u], 2).tolist(),
+    })
+
+# ---------- ユーザータイプ推定（希望案 → タイプ別の確率） ----------
+# user_type.csv にないユーザーを一律 "Type A" とせず、希望案の訪問先・交通手段から推定する。
+# 嗜好表をタイプ間で中心化した重み W（POI × タイプ、交通手段 × タイプ）を用意し、
+# プランの訪問回数ベクトルとの積（実装はスロットごとに W の行を引いてユーザー別に合計）を
+# スロット数で割ってソフトマックスに通す
+TYPE_INFER_TEMPERATURE = 1.0
+_TYPE_MODEL_CACHE = {}
+_INFERRED_TYPES_CACHE = {}
+
+def _build_type_model(poi_prefs: dict, transport_prefs: dict) -> dict:
+    """推定用の重み"""
+    types, modes, poi_mat, trans_mat = _build_pref_matrices(poi_prefs, transport_prefs)
+
+    def centered(mat):
+        # タイプ間の平均を引き、どのタイプも同程度に好む項目の影響を消す（未定義は 0）
+        valid = ~np.isnan(mat)
+        mean = np.where(valid, mat, 0.0).sum(axis=0) / np.maximum(valid.sum(axis=0), 1)
+        return np.where(valid, mat - mean, 0.0).T                       # (項目, タイプ)
+
+    return {
+        "types": types,
+        "mode_index": {m: i for i, m in enumerate(modes)},
+        # 末尾行 = 該当なし（0）
+        "poi": np.vstack([centered(poi_mat), np.zeros((1, len(types)))]),
+        "mode": np.vstack([centered(trans_mat), np.zeros((1, len(types)))]),
+    }
+
+def _type_model() -> dict:
+    """推定用の重み（嗜好表が変わるまで使い回す）"""
+    sig = _source_signature(POI_PREF_CSV, TRANSPORT_PREF_CSV)
+    model = _TYPE_MODEL_CACHE.get(sig)
+    record_cache("type_model", model is not None)
+    if model is None:
+        _TYPE_MODEL_CACHE.clear()
+        model = _TYPE_MODEL_CACHE[sig] = _build_type_model(load_poi_preferences(), load_transport_preferences())
+    return model
+
+def infer_user_types(plan_id, poi, transport, name_map: dict, model: dict = None):
+    """
+    プラン行の列（同じ長さ）→ (プランID一覧, タイプ一覧, 確率 (プラン数, タイプ数))
+      plan_id   … 行が属するプラン（ユーザー名など）
+      poi       … POI名（"move" なら移動行）
+      transport … 交通手段
+    評価できる行がないプランは一様分布
+    """
+    model = model or _type_model()
+    types = model["types"]
+    codes, plans = pd.factorize(pd.Series(plan_id, dtype=object))
+    names = pd.Series(poi, dtype=object).fillna("").astype(str).str.strip()
+    modes = pd.Series(transport, dtype=object).fillna("").astype(str).str.strip().str.lower()
+    is_move = names.str.lower().isin(["move", "移動"]).to_numpy()
+
+    n_poi_rows = len(model["poi"]) - 1
+    lookup = {n: name_map.get(n) for n in names.unique()}
+    pid = np.array(names.map(lookup).fillna(-1).astype(int))
+    pid = np.where(is_move | (pid < 0) | (pid >= n_poi_rows), n_poi_rows, pid)
+    mid = np.array(modes.map(lambda t: model["mode_index"].get(TRANSPORT_NORMALIZE.get(t, "Walking"), -1)))
+    mid = np.where(is_move & (mid >= 0), mid, len(model["mode"]) - 1)
+    used = (pid < n_poi_rows) | (mid < len(model["mode"]) - 1)
+
+    rows = np.where(is_move[:, None], model["mode"][mid], model["poi"][pid])  # (行, タイプ)
+    n = np.bincount(codes, weights=used, minlength=len(plans))
+    logits = np.stack([np.bincount(codes, weights=rows[:, k], minlength=len(plans))
+                       for k in range(len(types))], axis=1) if len(types) else np.zeros((len(plans), 0))
+    logits = logits / np.maximum(n, 1)[:, None] / TYPE_INFER_TEMPERATURE
+    logits -= logits.max(axis=1, keepdims=True) if len(types) else 0
+    prob = np.exp(logits)
+    prob /= prob.sum(axis=1, keepdims=True)
+    return list(plans), types, prob
+
+def inferred_user_types() -> dict:
+    """desired_example.csv の全ユーザーの推定タイプ（データが変わるまで使い回す）"""
+    sig = _source_signature(DESIRED_CSV, POI_CSV, POI_ALIAS_CSV, POI_PREF_CSV, TRANSPORT_PREF_CSV)
+    inferred = _INFERRED_TYPES_CACHE.get(sig)
+    if inferred is None:
+        _, name_map = _load_poi_master_for_geo()
+        inferred = _infer_desired_types(name_map, _type_model())
+        _INFERRED_TYPES_CACHE.clear()
+        _INFERRED_TYPES_CACHE[sig] = inferred
+    return inferred
+
+def _infer_desired_types(name_map: dict, model: dict) -> dict:
+    """desired_example.csv のユーザー → 推定タイプ（スナップショット作成時は CSV の値から直接呼ぶ）"""
+    if not DESIRED_CSV.exists():
+        return {}
+    df = pd.read_csv(DESIRED_CSV, encoding="utf-8-sig", dtype=str).fillna("")
+    df = df[~df["Slot"].str.strip().str.lower().isin(["start", "return"])]
+    users, types, prob = infer_user_types(df["User"].str.strip(), df["POI"], df["Transport"], name_map, model)
+    return {u: types[i] for u, i in zip(users, prob.argmax(axis=1))} if types else {}
+
+def with_inferred_types(user_types: dict, inferred: dict) -> dict:
+    """登録済みタイプに推定タイプを補った辞書（.get(user, "Type A") で resolve_user_type と同じ結果）"""
+    return {**inferred, **{u: t for u, t in user_types.items() if t}}
+
+def resolve_user_type(user: str, user_types: dict) -> str:
+    """user_type.csv → 希望案からの推定 → "Type A" の順"""
+    return user_types.get(user) or inferred_user_types().get(user) or "Type A"
+
+@app.route("/api/infer_type", methods=["GET", "POST"])
+def api_infer_type():
+    """
+    GET  ?user=User_N … desired_example.csv のそのユーザーの希望案から推定
+    POST {"plans": {"<id>": [{"poi": "平安神宮", "transport": "stay"}, {"poi": "move", "transport": "Walking"}, ...]}}
+    """
+    if request.method == "GET":
+        user = request.args.get("user", "").strip()
+        if not DESIRED_CSV.exists():
+            return jsonify({"error": "CSVが見つかりません"}), 404
+        df = pd.read_csv(DESIRED_CSV, encoding="utf-8-sig", dtype=str).fillna("")
+        df = df[(df["User"].str.strip() == user) & ~df["Slot"].str.strip().str.lower().isin(["start", "return"])]
+        if df.empty:
+            return jsonify({"error": f"希望案が見つかりません: {user}"}), 404
+        ids, poi, transport = [user] * len(df), df["POI"].tolist(), df["Transport"].tolist()
+    else:
+        body = request.get_json(silent=True) or {}
+        plans = body.get("plans")
+        if not isinstance(plans, dict) or not plans or \
+                not all(isinstance(v, list) and all(isinstance(r, dict) for r in v) for v in plans.values()):
+            return jsonify({"error": 'plans には {"<id>": [{"poi": ..., "transport": ...}, ...]} を指定してください'}), 400
+        ids = [pid for pid, rows in plans.items() for _ in rows]
+        poi = [r.get("poi", "") for rows in plans.values() for r in rows]
+        transport = [r.get("transport", "") for rows in plans.values() for r in rows]
+        if not ids:
+            return jsonify({"error": "plans の行が空です"}), 400
+
+    _, name_map = _load_poi_master_for_geo()
+    plan_ids, types, prob = infer_user_types(ids, poi, transport, name_map)
+    return jsonify({
+        "types": types,
+        "results": {
+            str(pid): {"type": types[int(p.argmax())] if types else None,
+                       "probabilities": {t: round(float(v), 4) for t, v in zip(types, p)}}
+            for pid, p in zip(plan_ids, prob)
+        },
+    })
+
+# ---------- 混雑ヒートマップ（POI周辺の格子へ集計） ----------
+HEATMAP_RESOLUTIONS = (8, 16, 32)   # 1辺あたりのセル数（細かい格子を集約して粗い格子を作る）
+_HEATMAP_CACHE = {}
+
+def _data_signature(*paths) -> tuple:
+    """データファイルの更新時刻（キャッシュ無効化用）"""
+    return tuple(p.stat().st_mtime_ns if p.exists() else None for p in paths)
+
+def _source_signature(*paths) -> tuple:
+    """
+    ローダー経由で読む元データのシグネチャ（キャッシュ無効化用）。
+    WEBAPP_STORE=sqlite では SQLite ファイル、スナップショット有効時は使っている版も含める
+    （CSV を更新して DB・版がまだ古い間に作った結果を、新しいデータの分として使い回さないように）
+    """
+    sig = _data_signature(*paths, SQLITE_DB) if USE_SQLITE else _data_signature(*paths)
+    snap = current_snapshot()
+    return sig if snap is None else (sig, snap.version)
+
+def _slot_hour(slot: str):
+    """slotN → 開始時刻の時（既定は slot1=9時）。start/return は None"""
+    match = re.search(r"\d+", slot)
+    if slot in ["start", "return"] or not match:
+        return None
+    return TIMELINE.hour(int(match.group()))
+
+def _hour_columns(slots) -> tuple:
+    """
+    スロット列 → (時刻一覧, スロット×時刻の平均化行列)
+    1時間より細かいスロットでは同じ時台のスロットを平均して時刻ごとの値にする
+    """
+    slot_hours = [_slot_hour(s) for s in slots]
+    hours = sorted({h for h in slot_hours if h is not None})
+    w = np.zeros((len(slots), len(hours)))
+    for i, h in enumerate(slot_hours):
+        if h is not None:
+            w[i, hours.index(h)] = 1.0
+    return hours, w / np.maximum(w.sum(axis=0), 1.0)
+
+def _build_heatmap(capacity: float = 20.0) -> dict:
+    """
+    計画訪問者数と混雑度を (時刻, 行, 列) 格子へ集計
+    visits は合計、congestion はセル内POIの最大値。最も細かい格子から粗い格子を作る
+    """
+    poi_master, _ = _load_poi_master_for_geo()
+    tensors = get_solution_tensors()
+    hours, to_hour = _hour_columns(tensors["slots"])
+    occ = _occupancy(tensors, _initial_choice(tensors)) @ to_hour        # (POI, 時刻)
+    congestion = np.minimum(100.0, (tensors["slot_congestion"] @ to_hour)[None, :] + 100.0 * occ / capacity)
+    ids = np.array([pid for pid in poi_master if pid < occ.shape[0]], dtype=int)
+    lat = np.array([poi_master[pid]["lat"] for pid in ids])
+    lng = np.array([poi_master[pid]["lng"] for pid in ids])
+
+    # POIの外接矩形を10%広げた範囲
+    pad_lat = max((lat.max() - lat.min()) * 0.1, 1e-3)
+    pad_lng = max((lng.max() - lng.min()) * 0.1, 1e-3)
+    south, north = lat.min() - pad_lat, lat.max() + pad_lat
+    west, east = lng.min() - pad_lng, lng.max() + pad_lng
+
+    n = max(HEATMAP_RESOLUTIONS)
+    row = np.clip(((lat - south) / (north - south) * n).astype(int), 0, n - 1)
+    col = np.clip(((lng - west) / (east - west) * n).astype(int), 0, n - 1)
+    cell = row * n + col
+
+    H = len(hours)
+    flat = (np.arange(H)[:, None] * n * n + cell[None, :]).ravel()
+    visits = np.bincount(flat, weights=occ[ids].T.ravel(),
+                         minlength=H * n * n).reshape(H, n, n)
+    cong = np.zeros(H * n * n)
+    np.maximum.at(cong, flat, congestion[ids].T.ravel())
+    cong = cong.reshape(H, n, n)
+
+    grids = {}
+    for res in HEATMAP_RESOLUTIONS:
+        f = n // res
+        grids[res] = {
+            "visits": visits.reshape(H, res, f, res, f).sum(axis=(2, 4)).astype(np.int32),
+            "congestion": cong.reshape(H, res, f, res, f).max(axis=(2, 4)).round().astype(np.uint8),
+        }
+    return {
+        "bbox": [south, west, north, east], "hours": hours, "grids": grids,
+        # POI別・時刻別の計画訪問者数（マーカークラスタでも使う）
+        "poi_ids": ids, "poi_visits": occ[ids].round().astype(np.int64),
+    }
+
+def get_heatmap(capacity: float = 20.0) -> dict:
+    """データファイルが変わるまで格子を使い回す"""
+    sig = _source_signature(POI_CSV, SOLUTIONS_CSV, USER_TYPE_CSV, DESIRED_CSV, POI_PREF_CSV, TRANSPORT_PREF_CSV)
+    key = (sig, capacity)
+    hit = key in _HEATMAP_CACHE
+    record_cache("heatmap", hit)
+    if not hit:
+        _HEATMAP_CACHE.clear()
+        _HEATMAP_CACHE[key] = _build_heatmap(capacity)
+    return _HEATMAP_CACHE[key]
+
+@app.route("/api/heatmap")
+def api_heatmap():
+    if not (POI_CSV.exists() and SOLUTIONS_CSV.exists()):
+        return jsonify({"error": "CSVが見つかりません"}), 404
+    res = request.args.get("res", "16").strip()
+    if not res.isdigit() or int(res) not in HEATMAP_RESOLUTIONS:
+        return jsonify({"error": f"res は {list(HEATMAP_RESOLUTIONS)} のいずれかを指定してください"}), 400
+    res = int(res)
+
+    heat = get_heatmap()
+    hours = heat["hours"]
+    hour = request.args.get("hour", "").strip()
+    if hour:
+        if not hour.isdigit() or int(hour) not in hours:
+            return jsonify({"error": f"hour は {hours} のいずれかを指定してください"}), 400
+        idx = [hours.index(int(hour))]
+    else:
+        idx = list(range(len(hours)))
+
+    grid = heat["grids"][res]
+    return jsonify({
+        "bbox": [round(v, 6) for v in heat["bbox"]],   # [south, west, north, east]
+        "rows": res,
+        "cols": res,
+        "hours": [hours[i] for i in idx],
+        # 時刻ごとに行優先で平坦化したセル値（行0が南端・列0が西端）
+        "visits": [grid["visits"][i].ravel().tolist() for i in idx],
+        "congestion": [grid["congestion"][i].ravel().tolist() for i in idx],
+    })
+
+
+# ---------- マーカークラスタ（ズームごとの階層クラスタ） ----------
+CLUSTER_RADIUS_PX = 60      # この画面距離（px）以内の点をまとめる
+CLUSTER_TILE_PX = 256
+CLUSTER_MAX_ZOOM = 17       # これより大きいズームでは個別のPOIを返す
+_CLUSTER_CACHE = {}
+
+def _merc_x(lng):
+    return np.asarray(lng) / 360.0 + 0.5
+
+def _merc_y(lat):
+    s = np.clip(np.sin(np.radians(lat)), -0.9999, 0.9999)
+    return 0.5 - 0.25 * np.log((1 + s) / (1 - s)) / np.pi
+
+def _merc_lat(y):
+    return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y)))))
+
+def _cluster_level(x, y, count, visits, origin, z: int):
+    """
+    1つ上のズームの点を半径内で貪欲にまとめる（supercluster と同じ手順）
+    半径と同じ幅の格子に振り分け、近傍3x3セルだけを調べる
+    """
+    r = CLUSTER_RADIUS_PX / (CLUSTER_TILE_PX * 2 ** z)
+    cx, cy = (x // r).astype(int).tolist(), (y // r).astype(int).tolist()
+    cells = {}
+    for i, key in enumerate(zip(cx, cy)):
+        cells.setdefault(key, []).append(i)
+    xs, ys = x.tolist(), y.tolist()
+    done = [False] * len(xs)
+    groups = []
+    for i in range(len(xs)):
+        if done[i]:
+            continue
+        done[i] = True
+        members = [i]
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for j in cells.get((cx[i] + dx, cy[i] + dy), ()):
+                    if not done[j] and (xs[j] - xs[i]) ** 2 + (ys[j] - ys[i]) ** 2 <= r * r:
+                        done[j] = True
+                        members.append(j)
+        groups.append(members)
+
+    sizes = np.array([len(m) for m in groups])
+    order = np.concatenate([np.array(m) for m in groups])
+    label = np.repeat(np.arange(len(groups)), sizes)
+    w = count[order].astype(np.float64)
+    total = np.bincount(label, weights=w)
+    level = {
+        "x": np.bincount(label, weights=x[order] * w) / total,
+        "y": np.bincount(label, weights=y[order] * w) / total,
+        "count": total.astype(np.int64),
+        "visits": np.add.reduceat(visits[order], np.r_[0, np.cumsum(sizes)[:-1]], axis=0),
+        # まとめなかった点は元の添字・元のズームを引き継ぐ
+        "poi": np.where(sizes == 1, np.array([m[0] for m in groups]), -1),
+        "origin": np.where(sizes == 1, origin[[m[0] for m in groups]], z),
+    }
+    return level
+
+def _build_clusters() -> dict:
+    """
+    POI（計画訪問者数つき）を最大ズームから順にまとめ、ズームごとの点集合を作る
+    poi は単独点のときだけ元POIの添字、origin はその点が最後に存在する（=展開される手前の）ズーム
+    """
+    index = get_poi_index()
+    heat = get_heatmap()
+    by_id = dict(zip(heat["poi_ids"].tolist(), heat["poi_visits"]))
+    n_hours = len(heat["hours"])
+    zero = np.zeros(n_hours, dtype=np.int64)
+    visits = np.array([by_id.get(int(p["id"]) if str(p["id"]).isdigit() else None, zero)
+                       for p in index.pois], dtype=np.int64).reshape(len(index.pois), n_hours)
+
+    x, y = _merc_x(index.lng), _merc_y(index.lat)
+    points = {
+        "x": x, "y": y,
+        "count": np.ones(len(x), dtype=np.int64),
+        "visits": visits,
+        "poi": np.arange(len(x)),
+        "origin": np.full(len(x), CLUSTER_MAX_ZOOM + 1),
+    }
+    levels = {CLUSTER_MAX_ZOOM + 1: points}
+    prev_poi = points["poi"]
+    for z in range(CLUSTER_MAX_ZOOM, -1, -1):
+        if len(points["x"]) == 0:
+            levels[z] = points
+            continue
+        level = _cluster_level(points["x"], points["y"], points["count"], points["visits"],
+                               points["origin"], z)
+        # 単独点の poi は上のズームでの添字 → 元POIの添字へ
+        level["poi"] = np.where(level["poi"] >= 0, prev_poi[np.maximum(level["poi"], 0)], -1)
+        prev_poi = level["poi"]
+        levels[z] = points = level
+    for level in levels.values():
+        level["lat"] = _merc_lat(level["y"])
+        level["lng"] = (level["x"] - 0.5) * 360.0
+    return {"levels": levels, "hours": heat["hours"], "pois": index.pois}
+
+def get_clusters() -> dict:
+    """POI・計画データが変わるまでクラスタ階層を使い回す"""
+    sig = _source_signature(POI_CSV, SOLUTIONS_CSV, USER_TYPE_CSV, DESIRED_CSV, POI_PREF_CSV, TRANSPORT_PREF_CSV)
+    clusters = _CLUSTER_CACHE.get(sig)
+    record_cache("clusters", clusters is not None)
+    if clusters is None:
+        _CLUSTER_CACHE.clear()
+        clusters = _CLUSTER_CACHE[sig] = _build_clusters()
+    return clusters
+
+@app.route("/api/clusters")
+def api_clusters():
+    """
+    表示中のズーム・範囲に入るクラスタ
+      zoom=...                    … 地図のズーム（CLUSTER_MAX_ZOOM を超えると個別POI）
+      bbox=south,west,north,east  … 表示範囲
+      hour=...                    … 計画訪問者数の時刻（省略時は全時刻の合計）
+    """
+    if not (POI_CSV.exists() and SOLUTIONS_CSV.exists()):
+        return jsonify({"error": "CSVが見つかりません"}), 404
+    zoom = request.args.get("zoom", "").strip()
+    if not zoom.isdigit():
+        return jsonify({"error": "zoom には 0 以上の整数を指定してください"}), 400
+    zoom = min(int(zoom), CLUSTER_MAX_ZOOM + 1)
+    bbox = _parse_floats(request.args.get("bbox", ""), 4)
+    if bbox is None:
+        return jsonify({"error": "bbox=south,west,north,east を指定してください"}), 400
+    south, west, north, east = bbox
+
+    clusters = get_clusters()
+    hours = clusters["hours"]
+    hour = request.args.get("hour", "").strip()
+    if hour and (not hour.isdigit() or int(hour) not in hours):
+        return jsonify({"error": f"hour は {hours} のいずれかを指定してください"}), 400
+
+    level = clusters["levels"][zoom]
+    hits = np.flatnonzero((level["lat"] >= south) & (level["lat"] <= north) &
+                          (level["lng"] >= west) & (level["lng"] <= east))
+    visits = level["visits"][hits]
+    visits = visits[:, hours.index(int(hour))] if hour else visits.sum(axis=1)
+    out = []
+    for i, v in zip(hits.tolist(), visits.tolist()):
+        item = {"lat": round(float(level["lat"][i]), 7), "lng": round(float(level["lng"][i]), 7),
+                "count": int(level["count"][i]), "visits": int(v)}
+        if level["poi"][i] >= 0:
+            item.update(clusters["pois"][level["poi"][i]])
+        else:
+            item["expansion_zoom"] = int(level["origin"][i]) + 1
+        out.append(item)
+    return jsonify({"zoom": zoom, "hour": int(hour) if hour else None, "clusters": out})
+
+
+# ---------- おすすめPOI（タイプ × 時刻ごとの上位k件） ----------
+# スコア = そのタイプの嗜好 − 混雑ペナルティ（_score_plan と同じ式、計画訪問者数 + 自分で混雑度を計算）
+# (タイプ, 時刻) ごとにスコア降順の並びを前計算しておき、
+# 現在地が指定されたときは距離の減点を加えた上位k件を、並びの先頭からヒープで選ぶ
+RECOMMEND_CAPACITY = 20.0
+RECOMMEND_DISTANCE_PENALTY = 1.0     # 現在地からの距離 1km あたりの減点
+RECOMMEND_TOPK_MAX = 50
+RECOMMEND_EXCLUDE_CATEGORIES = {"宿泊"}
+_RECOMMEND_BLOCK = 32                # 距離をまとめて計算する件数
+_RECOMMEND_CACHE = {}
+
+def _build_recommend_table(capacity: float) -> dict:
+    poi_master, _ = _load_poi_master_for_geo()
+    tensors = get_solution_tensors()
+    types, _, poi_mat, _ = _build_pref_matrices(load_poi_preferences(), load_transport_preferences())
+    hours, to_hour = _hour_columns(tensors["slots"])
+    occ = _occupancy(tensors, _initial_choice(tensors)) @ to_hour        # (POI, 時刻)
+
+    ids = np.array([pid for pid, p in poi_master.items()
+                    if pid < poi_mat.shape[1] and p["category"] not in RECOMMEND_EXCLUDE_CATEGORIES], dtype=int)
+    visitors = np.zeros((len(ids), len(hours)))
+    inside = ids < occ.shape[0]
+    visitors[inside] = occ[ids[inside]]
+    congestion = np.minimum(100.0, (tensors["slot_congestion"] @ to_hour)[None, :] + 100.0 * (visitors + 1) / capacity)
+    penalty = (congestion - 50) / 100 * 3                                # (P, H)
+
+    pref = poi_mat[:, ids]                                               # (K, P)
+    score = np.maximum(0.0, pref[:, None, :] - penalty.T[None, :, :])    # (K, H, P)
+    score = np.where(np.isnan(pref)[:, None, :], -np.inf, score)         # 嗜好が未定義のPOIは末尾へ
+    order = np.argsort(-score, axis=2, kind="stable")
+    return {
+        "types": types, "hours": hours, "ids": ids,
+        "lat": np.array([poi_master[pid]["lat"] for pid in ids]),
+        "lng": np.array([poi_master[pid]["lng"] for pid in ids]),
+        "pref": pref, "congestion": congestion,
+        "order": order,
+        "score": np.take_along_axis(score, order, axis=2),
+        "valid": np.isfinite(score).sum(axis=2),
+    }
+
+def get_recommend_table(capacity: float = RECOMMEND_CAPACITY) -> dict:
+    """データファイルが変わるまで並びを使い回す"""
+    key = (_source_signature(POI_CSV, SOLUTIONS_CSV, USER_TYPE_CSV, DESIRED_CSV, POI_PREF_CSV, TRANSPORT_PREF_CSV), capacity)
+    table = _RECOMMEND_CACHE.get(key)
+    record_cache("recommend", table is not None)
+    if table is None:
+        _RECOMMEND_CACHE.clear()
+        table = _RECOMMEND_CACHE[key] = _build_recommend_table(capacity)
+    return table
+
+def recommend_pois(table: dict, type_idx: int, hour_idx: int, k: int, lat=None, lng=None) -> list:
+    """
+    上位k件の (POIの添字, スコア, 距離m or None)
+    距離の減点は 0 以上なので、並びの先頭から見て元のスコアが k 位以下になった時点で打ち切れる
+    """
+    order = table["order"][type_idx, hour_idx]
+    score = table["score"][type_idx, hour_idx]
+    n = int(table["valid"][type_idx, hour_idx])
+    if lat is None:
+        return [(int(i), float(s), None) for i, s in zip(order[:k], score[:k])]
+
+    heap = []   # (距離込みスコア, -順位, 添字, 距離) の最小ヒープ（同点は順位が上のものを残す）
+    for start in range(0, n, _RECOMMEND_BLOCK):
+        if len(heap) == k and score[start] <= heap[0][0]:
+            break
+        idx = order[start:min(n, start + _RECOMMEND_BLOCK)]
+        dist = _haversine_m(lat, lng, table["lat"][idx], table["lng"][idx])
+        adjusted = score[start:start + len(idx)] - RECOMMEND_DISTANCE_PENALTY * dist / 1000
+        for r, (i, s, d) in enumerate(zip(idx.tolist(), adjusted.tolist(), dist.tolist()), start):
+            item = (s, -r, i, d)
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+    return [(i, s, d) for s, _, i, d in sorted(heap, reverse=True)]
+
+@app.route("/api/recommend")
+def api_recommend():
+    """
+    ある時刻に行くとよいPOI
+      type=Type A | user=User_N  … ユーザータイプ（user なら登録済み or 希望案から推定）
+      hour=...                    … 時刻
+      k=5                         … 件数
+      lat=...&lng=...             … 現在地（指定時は距離で減点）
+    """
+    if not (POI_CSV.exists() and SOLUTIONS_CSV.exists()):
+        return jsonify({"error": "CSVが見つかりません"}), 404
+    table = get_recommend_table()
+    user = request.args.get("user", "").strip()
+    user_type = resolve_user_type(user, load_user_types()) if user else request.args.get("type", "").strip()
+    if user_type not in table["types"]:
+        return jsonify({"error": f"type は {table['types']} のいずれかを指定してください"}), 400
+    hours = table["hours"]
+    hour = request.args.get("hour", "").strip()
+    if not hour.isdigit() or int(hour) not in hours:
+        return jsonify({"error": f"hour は {hours} のいずれかを指定してください"}), 400
+    k = request.args.get("k", "5").strip()
+    if not k.isdigit() or not 1 <= int(k) <= RECOMMEND_TOPK_MAX:
+        return jsonify({"error": f"k は 1〜{RECOMMEND_TOPK_MAX} の範囲で指定してください"}), 400
+    lat = lng = None
+    if request.args.get("lat") or request.args.get("lng"):
+        point = _parse_floats(f"{request.args.get('lat', '')},{request.args.get('lng', '')}", 2)
+        if point is None:
+            return jsonify({"error": "lat, lng には数値を指定してください"}), 400
+        lat, lng = point
+
+    ti, hi = table["types"].index(user_type), hours.index(int(hour))
+    poi_master, _ = _load_poi_master_for_geo()
+    out = []
+    for i, s, d in recommend_pois(table, ti, hi, int(k), lat, lng):
+        pid = int(table["ids"][i])
+        item = {"poi_id": pid, **poi_master[pid],
+                "preference": round(float(table["pref"][ti, i]), 3),
+                "congestion": int(round(table["congestion"][i, hi])),
+                "score": round(s, 3)}
+        if d is not None:
+            item["distance_m"] = round(d, 1)
+        out.append(item)
+    return jsonify({"type": user_type, "hour": int(hour), "pois": out})
+
+
+# 開発サーバーのリロード親プロセスでは起動しない（子プロセス側で起動する）
+if WARM_ON_START and (__name__ != "__main__" or os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+    start_cache_warmer()
+
 if __name__ == "__main__":
+    # POI名の監査結果は索引を作ったとき（get_poi_resolver）にログへ出る
     print("Generating satisfaction & congestion data...")
     export_satisfaction_congestion_data()
     print("Starting Flask server...")
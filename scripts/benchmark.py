@@ -0,0 +1,188 @@
+# web_app/scripts/benchmark.py
+# ベンチマーク: ローダー・スコア計算・csv_to_plans・API（Flask test client）の所要時間を計測
+#   - データセット: 同梱データ（shipped）と合成データ（generate_synthetic_data.py、ユーザー数 1k/10k/100k など）
+#   - データセットごとに WEBAPP_DATA_DIR を切替えた子プロセスで計測（import時の状態を分離）
+#   - 各データセットを warm（WEBAPP_SNAPSHOT=1、応答キャッシュ有効）と
+#     cold（WEBAPP_SNAPSHOT=0、計測ごとに応答キャッシュ・比較案のキャッシュを空にする）の2通りで計測し並べて表示
+#   - 結果は JSON で保存し、--compare で前後比較
+#
+# 実行:
+#   cd web_app
+#   python scripts/benchmark.py --sizes 1000,10000,100000 --out bench_results/before.json
+#   python scripts/benchmark.py --sizes 1000 --out bench_results/after.json
+#   python scripts/benchmark.py --compare bench_results/before.json bench_results/after.json
+
+import argparse, json, os, platform, statistics, subprocess, sys, tempfile, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from csv_to_plans import write_plans  # noqa: E402
+from generate_synthetic_data import generate  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+SHIPPED = ROOT / "data"
+
+# ---------- 計測（子プロセス側） ----------
+def _timeit(fn, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {
+        "repeat": repeat,
+        "min_s": round(min(times), 6),
+        "median_s": round(statistics.median(times), 6),
+        "mean_s": round(statistics.mean(times), 6),
+    }
+
+def run_worker(repeat: int, cold: bool = False) -> dict:
+    sys.path.insert(0, str(ROOT))
+    import app
+
+    def _clear_caches():
+        with app._RESPONSE_CACHE_LOCK:
+            app._RESPONSE_CACHE.clear()
+        with app._COMPARE_PLAN_LOCK:
+            app._COMPARE_PLAN_CACHE.clear()
+
+    poi_master, name_map = app._load_poi_master_for_geo()
+    user_types = app.load_user_types()
+    poi_prefs = app.load_poi_preferences()
+    transport_prefs = app.load_transport_preferences()
+    plan = app._read_plan_csv(app.DESIRED_CSV, poi_master, name_map, "User_1")
+    all_plans = app._read_plan_csv(app.DESIRED_CSV, poi_master, name_map)
+    user_type = user_types.get("User_1", "Type A")
+    client = app.app.test_client()
+
+    def _csv_to_plans():
+        with tempfile.TemporaryDirectory() as tmp:
+            write_plans(app.SOLUTIONS_CSV, Path(tmp), "1")
+
+    def _get(url):
+        def call():
+            r = client.get(url)
+            assert r.status_code == 200, (url, r.status_code)
+        return call
+
+    # /api/plan 用の best.pack がなければ用意
+    if not app.PLAN_ARCHIVE.exists():
+        write_plans(app.SOLUTIONS_CSV, app.BASE_P / "plans", "1")
+
+    tensors = app._load_solution_tensors(app.SOLUTIONS_CSV, name_map, user_types, poi_prefs, transport_prefs)
+    choice = app._initial_choice(tensors)
+    occ = app._occupancy(tensors, choice)
+
+    cases = {
+        "load_poi_preferences": lambda: app.load_poi_preferences(),
+        "_load_poi_master_for_geo": lambda: app._load_poi_master_for_geo(),
+        "_read_plan_csv[user]": lambda: app._read_plan_csv(app.DESIRED_CSV, poi_master, name_map, "User_1"),
+        "_calculate_route_satisfaction[user]":
+            lambda: app._calculate_route_satisfaction(plan, user_type, poi_prefs, transport_prefs),
+        "_calculate_route_satisfaction[all]":
+            lambda: app._calculate_route_satisfaction(all_plans, user_type, poi_prefs, transport_prefs),
+        "_calculate_route_congestion[all]": lambda: app._calculate_route_congestion(all_plans),
+        "_score_candidates[all]": lambda: app._score_candidates(tensors, occ, choice, 20.0),
+        "csv_to_plans.write_plans": _csv_to_plans,
+        "GET /api/compare_geo": _get("/api/compare_geo?user=User_1"),
+        "GET /api/plan": _get("/api/plan?user=1"),
+    }
+    slow = {"csv_to_plans.write_plans"}
+    results = {}
+    for name, fn in cases.items():
+        if cold:
+            fn = (lambda f: lambda: (_clear_caches(), f()))(fn)
+        fn()  # ウォームアップ（cold でも import 直後の初回コストは除く）
+        results[name] = _timeit(fn, 1 if name in slow else repeat)
+    return {
+        "users": len(user_types),
+        "plan_rows": len(all_plans),
+        "solutions": len(tensors["solutions"]),
+        "cases": results,
+    }
+
+# ---------- 親プロセス ----------
+def _run_worker_process(data_dir: Path, repeat: int, cold: bool) -> dict:
+    env = dict(os.environ, WEBAPP_DATA_DIR=str(data_dir))
+    args = [sys.executable, __file__, "--worker", "--repeat", str(repeat)]
+    env["WEBAPP_SNAPSHOT"] = "0" if cold else "1"
+    if cold:
+        args.append("--cold")
+    out = subprocess.run(args, env=env, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def run_dataset(label: str, data_dir: Path, repeat: int) -> dict:
+    t0 = time.perf_counter()
+    res = _run_worker_process(data_dir, repeat, cold=False)
+    res["cold_cases"] = _run_worker_process(data_dir, repeat, cold=True)["cases"]
+    res["wall_s"] = round(time.perf_counter() - t0, 3)
+    print(f"[OK] {label}: {res['users']} ユーザー / {res['plan_rows']} 行 / {res['wall_s']}s")
+    print(f"    {'':40s} {'warm median':>14s} {'cold median':>14s}")
+    for name, r in res["cases"].items():
+        cold = res["cold_cases"].get(name)
+        cold_ms = f"{cold['median_s'] * 1000:11.2f} ms" if cold else f"{'-':>14s}"
+        print(f"    {name:40s} {r['median_s'] * 1000:11.2f} ms {cold_ms}")
+    return res
+
+def compare(before_path: Path, after_path: Path):
+    before = json.loads(before_path.read_text(encoding="utf-8"))["datasets"]
+    after = json.loads(after_path.read_text(encoding="utf-8"))["datasets"]
+    for label in before:
+        if label not in after:
+            continue
+        print(f"== {label}")
+        for key, tag in [("cases", "warm"), ("cold_cases", "cold")]:
+            for name, b in before[label].get(key, {}).items():
+                a = after[label].get(key, {}).get(name)
+                if not a:
+                    continue
+                ratio = b["median_s"] / a["median_s"] if a["median_s"] else float("inf")
+                print(f"    {tag} {name:40s} {b['median_s'] * 1000:10.2f} → {a['median_s'] * 1000:10.2f} ms  ×{ratio:.2f}")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="1000,10000,100000", help="合成データのユーザー数（カンマ区切り、空で同梱データのみ）")
+    ap.add_argument("--solutions", type=int, default=3, help="合成データの1ユーザーあたり解の数")
+    ap.add_argument("--pois", type=int, default=19, help="合成データのPOI数")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--out", default=f"bench_results/{time.strftime('%Y%m%d-%H%M%S')}.json")
+    ap.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    ap.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    ap.add_argument("--cold", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.repeat, args.cold)))
+        return
+    if args.compare:
+        compare(Path(args.compare[0]), Path(args.compare[1]))
+        return
+
+    datasets = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        # 同梱データは plans/ を書き換えないようにコピーして使う
+        shipped = Path(tmp) / "shipped"
+        shipped.mkdir()
+        for p in SHIPPED.glob("*.*"):
+            if p.is_file():   # .snapshots / .route_cache 等のディレクトリは除く
+                (shipped / p.name).write_bytes(p.read_bytes())
+        datasets["shipped"] = run_dataset("shipped", shipped, args.repeat)
+
+        for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            d = Path(tmp) / f"synthetic_{size}"
+            generate(d, n_pois=args.pois, n_users=size, n_solutions=args.solutions, plans=False)
+            label = f"synthetic_{size}"
+            datasets[label] = run_dataset(label, d, args.repeat if size < 100000 else 1)
+
+    out = Path(args.out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps({
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "datasets": datasets,
+    }, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"出力先: {out.resolve()}")
+
+if __name__ == "__main__":
+    main()
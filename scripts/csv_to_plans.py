@@ -2,18 +2,33 @@
 # CSV: columns = Solution, User, Slot, POI, Transport
 #   - Solution: "Solution_1" 等 → 解1のみ採用
 #   - User: "User_12" 等 → 数字 12 を抽出（1〜20 を想定）
-#   - Slot: "slot7" 等 → 数字 7 に変換（6:00 起点で 1..15）
+#   - Slot: "slot7" 等 → 数字 7 に変換。開始時刻 "time"（HH:MM）は timeline.py の設定から付与
+#     （既定は slot1=9:00 の1時間刻み、WEBAPP_SLOT_START / WEBAPP_SLOT_MINUTES で変更）
 #   - POI: 滞在時は施設名、移動行は "move"
 #   - Transport: "stay", "Walking", "Rental Bicycle" など
+# 出力: <out>/best.pack（全ユーザー分を1ファイルにまとめたアーカイブ、/api/plan が mmap で参照）
+#   --json-dirs で従来の <out>/<user>/best.json も書き出す
+#
+# best.pack の構成（リトルエンディアン）
+#   先頭    : magic "PLANPAK1"(8) / ユーザー数 uint32 / 索引の位置 uint64
+#   本体    : ユーザーごとの /api/plan 応答本文（キー順ソート・空白なしの JSON + 改行）
+#   索引    : (user uint32, offset uint64, length uint32) × ユーザー数、user 昇順
 #
 # 実行:
 #   cd web_app
 #   python scripts/csv_to_plans.py --csv ./data/optimal_solutions.csv --out ./data/plans --solution 1
 
-import argparse, csv, json, re
+import argparse, csv, json, os, re, struct, sys
 from pathlib import Path
 from collections import defaultdict
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from timeline import timeline_from_env  # noqa: E402
+
+PACK_MAGIC = b"PLANPAK1"
+PACK_HEADER = struct.Struct("<8sIQ")
+PACK_ENTRY = struct.Struct("<IQI")
+
 def user_to_num(u: str):
     m = re.search(r"\d+", str(u))
     return int(m.group(0)) if m else None
@@ -36,16 +51,31 @@ def norm_mode(transport: str, poi: str):
         return "car"
     return t or "walk"
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--csv", default="data/optimal_solutions.csv")
-    ap.add_argument("--out", default="data/plans")
-    ap.add_argument("--solution", default="1")
-    args = ap.parse_args()
+def write_plan_archive(plans: dict, path: Path):
+    """{user番号: items} → best.pack（一時ファイルに書いてから置換）"""
+    tmp = path.with_name(path.name + ".tmp")
+    entries = []
+    with tmp.open("wb") as f:
+        f.write(PACK_HEADER.pack(PACK_MAGIC, 0, 0))
+        for uid in sorted(plans):
+            body = json.dumps({"items": plans[uid]}, separators=(",", ":"), sort_keys=True).encode("ascii") + b"\n"
+            entries.append((uid, f.tell(), len(body)))
+            f.write(body)
+        index_offset = f.tell()
+        for entry in entries:
+            f.write(PACK_ENTRY.pack(*entry))
+        f.seek(0)
+        f.write(PACK_HEADER.pack(PACK_MAGIC, len(entries), index_offset))
+    os.replace(tmp, path)
 
-    src = Path(args.csv)
-    out_root = Path(args.out)
-    sol_pick = f"solution_{str(args.solution).lstrip('0')}".lower()
+def write_plans(src: Path, out_root: Path, solution="1", json_dirs=False, timeline=None):
+    """
+    CSVの指定解を <out_root>/best.pack（json_dirs=True なら <out_root>/<user>/best.json も）に書き出す
+    timeline 省略時は環境変数の設定（app.py と同じ）
+    戻り値: (読込行数, 採用行数, 出力ユーザー数)
+    """
+    timeline = timeline or timeline_from_env()
+    sol_pick = f"solution_{str(solution).lstrip('0')}".lower()
 
     if not src.exists():
         raise FileNotFoundError(f"CSV not found: {src}")
@@ -72,7 +102,7 @@ def main():
             if uid is None or slot is None:
                 continue
             mode = norm_mode(row["Transport"], row["POI"])
-            item = {"slot": slot, "mode": mode}
+            item = {"slot": slot, "time": timeline.label(slot), "mode": mode}
             if mode == "stay":
                 name = str(row["POI"]).strip()
                 item["poi_name"] = "（未指定）" if name == "" or name.lower() == "move" else name
@@ -80,17 +110,43 @@ def main():
             n_used += 1
 
     # write
-    for uid, items in plans.items():
-        items_sorted = sorted(items, key=lambda x: x["slot"])
-        out_dir = out_root / str(uid)
-        out_dir.mkdir(parents=True, exist_ok=True)
-        (out_dir / "best.json").write_text(
-            json.dumps({"items": items_sorted}, ensure_ascii=False, indent=2),
-            encoding="utf-8"
-        )
-
-    print(f"[OK] 読込 {n_rows} / 採用（解{args.solution}）{n_used} → {len(plans)} ユーザー出力")
-    print(f"出力先: {out_root.resolve()} / <user>/best.json")
+    plans = {uid: sorted(items, key=lambda x: x["slot"]) for uid, items in plans.items()}
+    write_plan_archive(plans, out_root / "best.pack")
+    if json_dirs:
+        for uid, items_sorted in plans.items():
+            out_dir = out_root / str(uid)
+            out_dir.mkdir(parents=True, exist_ok=True)
+            (out_dir / "best.json").write_text(
+                json.dumps({"items": items_sorted}, ensure_ascii=False, indent=2),
+                encoding="utf-8"
+            )
+
+    return n_rows, n_used, len(plans)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--csv", default="data/optimal_solutions.csv")
+    ap.add_argument("--out", default="data/plans")
+    ap.add_argument("--solution", default="1")
+    ap.add_argument("--json-dirs", action="store_true", help="従来の <user>/best.json も出力")
+    args = ap.parse_args()
+
+    out_root = Path(args.out)
+    n_rows, n_used, n_users = write_plans(Path(args.csv), out_root, args.solution, args.json_dirs)
+
+    print(f"[OK] 読込 {n_rows} / 採用（解{args.solution}）{n_used} → {n_users} ユーザー出力")
+    print(f"出力先: {out_root.resolve()} / best.pack" + (" / <user>/best.json" if args.json_dirs else ""))
+
+    # 取込み時のチェック: POI一覧・別名表で解決できない／近似一致で解決したPOI名
+    # （app の読込みは重いので write_plans ではなくここで行う）
+    import app
+    if app.POI_CSV.exists():
+        resolver = app.PoiResolver(app._csv_load_poi_master(), app.load_poi_aliases())
+        report = app.audit_plan_poi_names([Path(args.csv)], resolver)
+        for name, matched in report["fuzzy"].items():
+            print(f"[WARN] POI名を近似一致で解決: {name} → {matched}")
+        for name, n in report["unresolved"].items():
+            print(f"[WARN] POI名を解決できません: {name}（{n} 行）")
 
 if __name__ == "__main__":
     main()
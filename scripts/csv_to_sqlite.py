@@ -0,0 +1,35 @@
+# web_app/scripts/csv_to_sqlite.py
+# CSV一式（POI・嗜好表・ユーザータイプ・希望案/提案案/複数解）を SQLite に取込む
+#   - 索引: plan_slots(source, user, solution, slot_order) / plan_slots(poi_id, slot_order)
+#   - 取込後は WEBAPP_STORE=sqlite で起動するとCSVの代わりに参照される
+#
+# 実行:
+#   cd web_app
+#   python scripts/csv_to_sqlite.py --out ./data/webapp.sqlite3
+#   WEBAPP_STORE=sqlite python app.py
+
+import argparse, sys, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import app  # noqa: E402
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--out", default=str(app.SQLITE_DB))
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    counts = app.build_sqlite_store(Path(args.out))
+    print(f"[OK] 取込 {time.perf_counter() - t0:.2f}s")
+    report = counts.pop("poi_names")
+    for name, n in counts.items():
+        print(f"    {name}: {n}")
+    for name, matched in report["fuzzy"].items():
+        print(f"[WARN] POI名を近似一致で解決: {name} → {matched}")
+    for name, n in report["unresolved"].items():
+        print(f"[WARN] POI名を解決できません: {name}（{n} 行）")
+    print(f"出力先: {Path(args.out).resolve()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+# web_app/scripts/export_scored_plans.py
+# 採点済みプランの一括出力: optimal_solutions.csv の全 (解, ユーザー, スロット) を
+# 満足度・混雑度つきの NDJSON（1スロット1行）で書き出す
+#   - CSVはチャンク単位で読み、(解, ユーザー) ごとに採点して逐次書き込む（メモリ一定）
+#   - 出力先が .gz なら gzip で圧縮しながら書き込む
+#
+# 実行:
+#   cd web_app
+#   python scripts/export_scored_plans.py --out exports/scored_plans.ndjson.gz
+#   python scripts/export_scored_plans.py --out exports/solution1.ndjson --solution Solution_1
+
+import argparse, sys, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import app  # noqa: E402
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--csv", default=str(app.SOLUTIONS_CSV), help="入力CSV（Solution, User, Slot, POI, Transport）")
+    ap.add_argument("--out", required=True, help="出力先（.gz なら gzip 圧縮）")
+    ap.add_argument("--solution", help="解で絞込み（例: Solution_1）")
+    ap.add_argument("--chunk-rows", type=int, default=app.EXPORT_CHUNK_ROWS)
+    args = ap.parse_args()
+
+    out = Path(args.out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    t0 = time.perf_counter()
+    n = 0
+
+    def counted(records):
+        nonlocal n
+        for rec in records:
+            n += 1
+            yield rec
+
+    records = counted(app.iter_scored_plans(Path(args.csv), args.solution, args.chunk_rows))
+    with out.open("wb") as f:
+        for data in app.iter_ndjson_bytes(records, compress=out.suffix == ".gz"):
+            f.write(data)
+
+    elapsed = time.perf_counter() - t0
+    print(f"[OK] {n} 行 / {out.stat().st_size:,} bytes / {elapsed:.1f}s（{n / elapsed:,.0f} 行/s）")
+    print(f"出力先: {out.resolve()}")
+
+if __name__ == "__main__":
+    main()
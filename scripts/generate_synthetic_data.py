@@ -0,0 +1,142 @@
+# web_app/scripts/generate_synthetic_data.py
+# 合成データ生成: 性能検証用に data/ と同じ構成のデータセットを任意の規模で作る
+#   - poi_list.csv / poi_preference_by_type.csv / transport_preference_by_type.csv
+#   - user_type.csv / persuasive_text.json / persuasive_text_en.json
+#   - desired_example.csv / optimal_solutions_example.csv（start, slot1..N, return）
+#   - optimal_solutions.csv（解 × ユーザー × slot1..N）
+#   - plans/best.pack（csv_to_plans と同じ形式、--no-plans で省略）
+#   POI名・ユーザー名・タイプ名は各ファイル間で整合する
+#
+# 実行:
+#   cd web_app
+#   python scripts/generate_synthetic_data.py --out ./synthetic/10k --users 10000 --pois 200 --types 6 --solutions 5 --slots 13
+
+import argparse, csv, json, math, random, string, sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from csv_to_plans import write_plans  # noqa: E402
+
+CENTER = (35.0135, 135.7840)   # 岡崎周辺
+CATEGORIES = ["歴史神社仏閣", "文化・美術", "自然・公園", "グルメ", "体験施設", "買い物・ショッピング"]
+TRANSPORT_MODES = ["Walking", "Rental Bicycle", "Taxi", "City Bus"]
+HEADER = ["Solution", "User", "Slot", "POI", "Transport"]
+
+def type_names(n: int):
+    """Type A..Type Z, 以降は Type 27, Type 28, ..."""
+    letters = string.ascii_uppercase
+    return [f"Type {letters[i]}" if i < len(letters) else f"Type {i + 1}" for i in range(n)]
+
+def _route(rng: random.Random, spots: list, n_slots: int, with_hotel: bool, hotel: str):
+    """
+    1ユーザー1解分の行（Slot, POI, Transport）
+    with_hotel=True なら start/return を付け、奇数slotを移動にする（*_example.csv 形式）
+    """
+    mode = rng.choice(TRANSPORT_MODES)
+    rows = [("start", hotel, "stay")] if with_hotel else []
+    for n in range(1, n_slots + 1):
+        moving = (n % 2 == 1) if with_hotel else (n % 2 == 0)
+        if moving:
+            rows.append((f"slot{n}", "move", mode))
+        else:
+            rows.append((f"slot{n}", rng.choice(spots), "stay"))
+    if with_hotel:
+        rows.append(("return", hotel, "stay"))
+    return rows
+
+def generate(out_dir: Path, n_pois: int = 19, n_types: int = 6, n_users: int = 30,
+             n_solutions: int = 3, n_slots: int = 13, seed: int = 0, plans: bool = True) -> dict:
+    """データセット一式を書き出し、各ファイルの行数を返す"""
+    if n_pois < 2:
+        raise ValueError("pois は 2 以上を指定してください（宿泊1件 + 観光地1件以上）")
+    rng = random.Random(seed)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    types = type_names(n_types)
+    counts = {}
+
+    # POI: 約1割を宿泊、残りを観光地。POI数に応じて範囲を広げる
+    n_hotels = max(1, n_pois // 10)
+    spread = 0.004 * math.sqrt(n_pois)
+    pois = []
+    for pid in range(1, n_pois + 1):
+        hotel = pid > n_pois - n_hotels
+        pois.append({
+            "poi_id": pid,
+            "name": f"{'Hotel' if hotel else 'POI'}_{pid:06d}",
+            "latitude": round(CENTER[0] + rng.uniform(-spread, spread), 7),
+            "longitude": round(CENTER[1] + rng.uniform(-spread, spread), 7),
+            "category": "宿泊" if hotel else rng.choice(CATEGORIES),
+        })
+    with (out_dir / "poi_list.csv").open("w", encoding="utf-8-sig", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=["poi_id", "name", "latitude", "longitude", "category"])
+        w.writeheader()
+        w.writerows(pois)
+    counts["poi_list.csv"] = len(pois)
+
+    # 嗜好表（0〜10）
+    with (out_dir / "poi_preference_by_type.csv").open("w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["PoI_ID"] + types)
+        for p in pois:
+            w.writerow([p["poi_id"]] + [round(rng.uniform(0, 10), 3) for _ in types])
+    with (out_dir / "transport_preference_by_type.csv").open("w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["transport mode"] + types)
+        for m in TRANSPORT_MODES:
+            w.writerow([m] + [round(rng.uniform(0, 10), 3) for _ in types])
+
+    # ユーザー
+    users = [f"User_{i}" for i in range(1, n_users + 1)]
+    with (out_dir / "user_type.csv").open("w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["User_ID", "User_Type"])
+        w.writerows([i, rng.choice(types)] for i in range(1, n_users + 1))
+    counts["user_type.csv"] = n_users
+    for name, text in [("persuasive_text.json", "混雑を避けたルートを提案します。"),
+                       ("persuasive_text_en.json", "We suggest a less crowded route.")]:
+        (out_dir / name).write_text(json.dumps({u: text for u in users}, ensure_ascii=False), encoding="utf-8")
+
+    # 希望案・提案案・複数解
+    hotels = [p["name"] for p in pois if p["category"] == "宿泊"]
+    spots = [p["name"] for p in pois if p["category"] != "宿泊"]
+    for name, n_sol, with_hotel in [("desired_example.csv", 1, True),
+                                    ("optimal_solutions_example.csv", 1, True),
+                                    ("optimal_solutions.csv", n_solutions, False)]:
+        n = 0
+        with (out_dir / name).open("w", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(HEADER)
+            for s in range(1, n_sol + 1):
+                sol = f"Solution_{s}"
+                for u in users:
+                    for slot, poi, transport in _route(rng, spots, n_slots, with_hotel, rng.choice(hotels)):
+                        w.writerow([sol, u, slot, poi, transport])
+                        n += 1
+        counts[name] = n
+
+    if plans:
+        _, _, counts["plans"] = write_plans(out_dir / "optimal_solutions.csv", out_dir / "plans", "1")
+    return counts
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--out", required=True)
+    ap.add_argument("--pois", type=int, default=19)
+    ap.add_argument("--types", type=int, default=6)
+    ap.add_argument("--users", type=int, default=30)
+    ap.add_argument("--solutions", type=int, default=3)
+    ap.add_argument("--slots", type=int, default=13)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--no-plans", action="store_true", help="plans/best.pack を出力しない")
+    args = ap.parse_args()
+
+    out = Path(args.out)
+    counts = generate(out, args.pois, args.types, args.users, args.solutions, args.slots,
+                      args.seed, plans=not args.no_plans)
+    print(f"[OK] POI {args.pois} / タイプ {args.types} / ユーザー {args.users} / 解 {args.solutions} / slot {args.slots}")
+    for name, n in counts.items():
+        print(f"    {name}: {n}")
+    print(f"出力先: {out.resolve()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# web_app/scripts/load_test.py
+# 負荷試験: 起動中のサーバーに対して実験セッションのアクセスを同時多数で再現
+#   1セッション = 条件ページ → そのページが読む比較データ → /api/plan
+#     /ui/condition-a（compare_map_simple.html）→ /api/compare_geo
+#     /ui/condition-b（compare_map.html）      → /api/compare_geo/stream（NDJSON を最後まで読む）
+#   - 参加者（スレッド）ごとにセッションを繰り返し、エンドポイント別に
+#     スループットと p50/p95/p99 レイテンシを集計
+#
+# 実行:
+#   cd web_app
+#   python app.py                      # 別ターミナルでサーバー起動
+#   python scripts/load_test.py --url http://127.0.0.1:5001 --concurrency 40 --duration 30 --users 30
+
+import argparse, json, math, random, threading, time, urllib.error, urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# 条件ページごとに、ページのスクリプトが読む比較データのエンドポイント
+COMPARE_ENDPOINTS = {
+    "/ui/condition-a": "/api/compare_geo",
+    "/ui/condition-b": "/api/compare_geo/stream",
+}
+
+def percentile(sorted_vals: list, p: float) -> float:
+    """最近傍順位法によるパーセンタイル（sorted_vals は昇順）"""
+    if not sorted_vals:
+        return 0.0
+    k = max(0, min(len(sorted_vals) - 1, math.ceil(p / 100 * len(sorted_vals)) - 1))
+    return sorted_vals[k]
+
+class Recorder:
+    """エンドポイント別のレイテンシ・エラー件数（スレッド間で共有）"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+    def add(self, endpoint: str, seconds: float, ok: bool, size: int):
+        with self.lock:
+            self.latency[endpoint].append(seconds)
+            self.bytes[endpoint] += size
+            if not ok:
+                self.errors[endpoint] += 1
+
+def fetch(rec: Recorder, base: str, endpoint: str, path: str, timeout: float):
+    t0 = time.perf_counter()
+    ok, size = True, 0
+    try:
+        with urllib.request.urlopen(base + path, timeout=timeout) as r:
+            size = len(r.read())
+            ok = r.status == 200
+    except (urllib.error.URLError, OSError):
+        ok = False
+    rec.add(endpoint, time.perf_counter() - t0, ok, size)
+
+def participant(rec: Recorder, args, deadline: float, seed: int):
+    """1人の参加者: 期限まで（または --sessions 回）セッションを繰り返す"""
+    rng = random.Random(seed)
+    done = 0
+    while time.time() < deadline and (args.sessions == 0 or done < args.sessions):
+        uid = rng.randint(1, args.users)
+        page = rng.choice(["/ui/condition-a", "/ui/condition-b"])
+        fetch(rec, args.url, page, page, args.timeout)
+        data = COMPARE_ENDPOINTS[page]
+        fetch(rec, args.url, data, f"{data}?user=User_{uid}", args.timeout)
+        fetch(rec, args.url, "/api/plan", f"/api/plan?user={uid}", args.timeout)
+        done += 1
+        if args.think > 0:
+            time.sleep(rng.uniform(0, args.think))
+
+def summarize(rec: Recorder, elapsed: float) -> dict:
+    out = {}
+    for endpoint, vals in sorted(rec.latency.items()):
+        vals = sorted(vals)
+        out[endpoint] = {
+            "requests": len(vals),
+            "errors": rec.errors[endpoint],
+            "throughput_rps": round(len(vals) / elapsed, 2),
+            "p50_ms": round(percentile(vals, 50) * 1000, 2),
+            "p95_ms": round(percentile(vals, 95) * 1000, 2),
+            "p99_ms": round(percentile(vals, 99) * 1000, 2),
+            "max_ms": round(vals[-1] * 1000, 2),
+            "avg_bytes": rec.bytes[endpoint] // len(vals),
+        }
+    return out
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", default="http://127.0.0.1:5001")
+    ap.add_argument("--concurrency", type=int, default=20, help="同時参加者数")
+    ap.add_argument("--duration", type=float, default=30.0, help="秒")
+    ap.add_argument("--sessions", type=int, default=0, help="参加者あたりのセッション数（0 で期間いっぱい）")
+    ap.add_argument("--users", type=int, default=30, help="User_1..N からランダムに選ぶ")
+    ap.add_argument("--think", type=float, default=0.0, help="セッション間の待ち時間の上限（秒）")
+    ap.add_argument("--timeout", type=float, default=30.0)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", help="結果JSONの出力先")
+    args = ap.parse_args()
+    args.url = args.url.rstrip("/")
+
+    rec = Recorder()
+    t0 = time.time()
+    deadline = t0 + args.duration
+    with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
+        for i in range(args.concurrency):
+            ex.submit(participant, rec, args, deadline, args.seed + i)
+    elapsed = time.time() - t0
+
+    result = summarize(rec, elapsed)
+    total = sum(r["requests"] for r in result.values())
+    print(f"[OK] 同時 {args.concurrency} / {elapsed:.1f}s / {total} リクエスト（{total / elapsed:.1f} req/s）")
+    print(f"    {'endpoint':22s} {'req':>7s} {'err':>5s} {'rps':>8s} {'p50ms':>9s} {'p95ms':>9s} {'p99ms':>9s}")
+    for endpoint, r in result.items():
+        print(f"    {endpoint:22s} {r['requests']:7d} {r['errors']:5d} {r['throughput_rps']:8.1f} "
+              f"{r['p50_ms']:9.1f} {r['p95_ms']:9.1f} {r['p99_ms']:9.1f}")
+
+    if args.out:
+        out = Path(args.out)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_text(json.dumps({
+            "url": args.url, "concurrency": args.concurrency, "elapsed_s": round(elapsed, 2),
+            "endpoints": result,
+        }, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"出力先: {out.resolve()}")
+
+if __name__ == "__main__":
+    main()
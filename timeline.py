@@ -0,0 +1,65 @@
+# web_app/timeline.py
+# タイムライン: slot番号 → 開始時刻・時間帯ベースの混雑度
+#   slot1 の開始時刻・1スロットの長さ・スロット数で決まり、
+#   取込み（scripts/csv_to_plans.py）・採点・表示（app.py / templates）で共有する
+#   スロット数ぶんの 時刻・混雑度 は配列に前計算しておき、範囲外の slot は都度計算する
+#
+# 環境変数（既定は slot1=9:00 の1時間刻み）:
+#   WEBAPP_SLOT_START=09:00  WEBAPP_SLOT_MINUTES=60  WEBAPP_SLOT_COUNT=15
+#   15分刻みにする例: WEBAPP_SLOT_MINUTES=15 WEBAPP_SLOT_COUNT=60
+
+import os
+import numpy as np
+
+def parse_hhmm(text: str) -> int:
+    """HH:MM → 0時からの分"""
+    h, _, m = str(text).strip().partition(":")
+    if not (h.isdigit() and (m == "" or m.isdigit())) or int(m or 0) >= 60:
+        raise ValueError(f"時刻は HH:MM で指定してください: {text}")
+    return int(h) * 60 + int(m or 0)
+
+def format_hhmm(minutes: int) -> str:
+    h, m = divmod(int(minutes) % (24 * 60), 60)
+    return f"{h:02d}:{m:02d}"
+
+def congestion_at(minutes) -> np.ndarray:
+    """時刻（分）→ 時間帯ベースの混雑度（10〜15時台が昼ピーク、8〜9時台・16〜18時台が中程度）"""
+    hour = np.asarray(minutes) // 60
+    return np.where((10 <= hour) & (hour <= 15), 65,
+                    np.where(((8 <= hour) & (hour < 10)) | ((15 < hour) & (hour <= 18)), 45, 25))
+
+class Timeline:
+    """slot1 の開始時刻 start・1スロットの長さ slot_minutes・スロット数 slots"""
+
+    def __init__(self, start: str = "09:00", slot_minutes: int = 60, slots: int = 15):
+        if slot_minutes <= 0 or slots <= 0:
+            raise ValueError("slot_minutes, slots は 1 以上を指定してください")
+        self.start = parse_hhmm(start)
+        self.slot_minutes = int(slot_minutes)
+        self.slots = int(slots)
+        # 添字 = slot番号（0 は slot1 の直前）
+        self.minutes = self.start + (np.arange(self.slots + 1) - 1) * self.slot_minutes
+        self.congestion = congestion_at(self.minutes)
+        self.labels = [format_hhmm(m) for m in self.minutes]
+
+    def minute(self, n: int) -> int:
+        """slot n の開始時刻（0時からの分）"""
+        return int(self.minutes[n]) if 0 <= n <= self.slots else self.start + (n - 1) * self.slot_minutes
+
+    def hour(self, n: int) -> int:
+        return self.minute(n) // 60
+
+    def label(self, n: int) -> str:
+        """slot n の開始時刻（HH:MM）"""
+        return self.labels[n] if 0 <= n <= self.slots else format_hhmm(self.minute(n))
+
+    def base_congestion(self, n: int) -> int:
+        return int(self.congestion[n]) if 0 <= n <= self.slots else int(congestion_at(self.minute(n)))
+
+    def to_dict(self) -> dict:
+        return {"start": format_hhmm(self.start), "slot_minutes": self.slot_minutes, "slots": self.slots}
+
+def timeline_from_env() -> Timeline:
+    return Timeline(os.environ.get("WEBAPP_SLOT_START", "09:00"),
+                    int(os.environ.get("WEBAPP_SLOT_MINUTES", "60")),
+                    int(os.environ.get("WEBAPP_SLOT_COUNT", "15")))